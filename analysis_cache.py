@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animal Health Diary - Cache delle analisi AI
+Cache indirizzata per contenuto: LRU in memoria e livello opzionale su SQLite
+"""
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Campi dei dati che entrano nel prompt (la data non cambia la risposta)
+CAMPI_PROMPT = ('nome', 'specie', 'peso', 'eta', 'alimentazione', 'attivita', 'sintomi', 'note')
+
+
+def normalizza_dati(dati):
+    """
+    Versione normalizzata dei campi del prompt: testo minuscolo con spazi
+    compattati, numeri come float. Input quasi identici (maiuscole, spazi
+    in più) producono la stessa chiave.
+    """
+    normalizzati = {}
+    for campo in CAMPI_PROMPT:
+        valore = dati.get(campo, '')
+        if isinstance(valore, (int, float)):
+            normalizzati[campo] = float(valore)
+        else:
+            normalizzati[campo] = ' '.join(str(valore).lower().split())
+    return normalizzati
+
+
+def chiave_cache(parametri):
+    """Hash SHA-256 dei parametri completi della richiesta (modello, messaggi, ...)"""
+    parametri = {k: v for k, v in parametri.items() if k != 'timeout'}
+    payload = json.dumps(parametri, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class AnalysisCache:
+    """
+    Cache delle risposte AI a due livelli:
+    - memoria: LRU con al massimo `max_entries` elementi
+    - disco (opzionale): tabella SQLite con al massimo `max_disk_entries`
+      righe, eliminando quelle usate meno di recente
+
+    Ogni elemento scade dopo `ttl` secondi. Thread-safe.
+    """
+
+    def __init__(self, max_entries=256, ttl=86400, db_path=None, max_disk_entries=10000):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_path = db_path
+        self.max_disk_entries = max_disk_entries
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()
+        self._db = None
+        self.stats = {'hits_memory': 0, 'hits_disk': 0, 'misses': 0, 'bypass': 0}
+
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analisi ("
+                " chiave TEXT PRIMARY KEY, risposta TEXT NOT NULL,"
+                " creata REAL NOT NULL, usata REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS analisi_usata ON analisi (usata)")
+            self._db.commit()
+
+    @classmethod
+    def from_env(cls, default_db=None):
+        """
+        Crea la cache dalle variabili d'ambiente:
+            AI_CACHE_SIZE       elementi in memoria (default 256, 0 = disattivata)
+            AI_CACHE_TTL        secondi di validità (default 86400)
+            AI_CACHE_DB         file SQLite del livello su disco ('' = nessuno)
+            AI_CACHE_DISK_MAX   righe massime su disco (default 10000)
+        """
+        return cls(
+            max_entries=int(os.getenv('AI_CACHE_SIZE', '256')),
+            ttl=float(os.getenv('AI_CACHE_TTL', '86400')),
+            db_path=os.getenv('AI_CACHE_DB', default_db) or None,
+            max_disk_entries=int(os.getenv('AI_CACHE_DISK_MAX', '10000')),
+        )
+
+    def get(self, chiave):
+        """Risposta in cache per la chiave (None se assente o scaduta)"""
+        adesso = time.time()
+        with self._lock:
+            elemento = self._memoria.get(chiave)
+            if elemento is not None:
+                risposta, creata = elemento
+                if adesso - creata <= self.ttl:
+                    self._memoria.move_to_end(chiave)
+                    self.stats['hits_memory'] += 1
+                    return risposta
+                del self._memoria[chiave]
+
+            if self._db is not None:
+                riga = self._db.execute(
+                    "SELECT risposta, creata FROM analisi WHERE chiave = ?", (chiave,)
+                ).fetchone()
+                if riga is not None and adesso - riga[1] <= self.ttl:
+                    self._db.execute("UPDATE analisi SET usata = ? WHERE chiave = ?", (adesso, chiave))
+                    self._db.commit()
+                    self._ricorda(chiave, riga[0], riga[1])
+                    self.stats['hits_disk'] += 1
+                    return riga[0]
+
+            self.stats['misses'] += 1
+            return None
+
+    def set(self, chiave, risposta):
+        """Salva una risposta in memoria e, se configurato, su disco"""
+        adesso = time.time()
+        with self._lock:
+            self._ricorda(chiave, risposta, adesso)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO analisi (chiave, risposta, creata, usata) VALUES (?, ?, ?, ?)",
+                    (chiave, risposta, adesso, adesso)
+                )
+                # Scadute e, oltre il limite, le meno usate di recente
+                self._db.execute("DELETE FROM analisi WHERE creata < ?", (adesso - self.ttl,))
+                self._db.execute(
+                    "DELETE FROM analisi WHERE chiave IN ("
+                    " SELECT chiave FROM analisi ORDER BY usata DESC LIMIT -1 OFFSET ?)",
+                    (self.max_disk_entries,)
+                )
+                self._db.commit()
+
+    def _ricorda(self, chiave, risposta, creata):
+        """Inserisce nel livello in memoria rispettando la dimensione massima"""
+        if self.max_entries <= 0:
+            return
+        self._memoria[chiave] = (risposta, creata)
+        self._memoria.move_to_end(chiave)
+        while len(self._memoria) > self.max_entries:
+            self._memoria.popitem(last=False)
+
+    def bypass(self):
+        """Registra una richiesta che ha saltato la cache"""
+        with self._lock:
+            self.stats['bypass'] += 1
+
+    def info(self):
+        """Contatori hit/miss e dimensioni, per /api/status"""
+        with self._lock:
+            info = dict(self.stats)
+            info['memory_entries'] = len(self._memoria)
+            info['disk_entries'] = (
+                self._db.execute("SELECT COUNT(*) FROM analisi").fetchone()[0]
+                if self._db is not None else 0
+            )
+        richieste = info['hits_memory'] + info['hits_disk'] + info['misses']
+        info['hit_rate'] = round((info['hits_memory'] + info['hits_disk']) / richieste, 3) if richieste else 0.0
+        return info
@@ -7,9 +7,29 @@ Accetta input su animale e fornisce consigli basati su regole IA semplici
 
 from datetime import datetime
 
+from health_rules import tabella_predefinita
+from symptom_matcher import classifica_sintomi
+
+CONSIGLIO_NESSUN_SINTOMO = "✓ Nessun sintomo rilevato - continuare monitoraggio regolare"
+
+
+def avviso_sintomo_grave(sintomo):
+    return f"⚠️  SINTOMO GRAVE: {sintomo.upper()} - CONSULTARE URGENTEMENTE IL VETERINARIO"
+
+
+def avviso_sintomo_moderato(sintomo):
+    return f"Sintomo da monitorare: {sintomo} - se persiste, consultare veterinario"
+
+
 class AnimalHealthDiary:
-    def __init__(self):
+    def __init__(self, regole=None):
+        """
+        Args:
+            regole: RuleTable con le regole su peso/età/alimentazione
+                    (default: tabella condivisa da regole_salute.json)
+        """
         self.entries = []
+        self.regole = regole or tabella_predefinita()
     
     def raccolta_dati(self):
         """Raccoglie i dati dell'animale dall'utente"""
@@ -43,48 +63,20 @@ class AnimalHealthDiary:
     
     def analisi_ia(self, dati):
         """Analizza i dati con regole semplici e genera consigli"""
-        consigli = []
-        avvisi = []
-        
-        # Analisi peso
-        if dati['specie'] == 'cane':
-            if dati['peso'] < 5:
-                consigli.append("Cane di taglia piccola: attenzione a non sovralimentare")
-            elif dati['peso'] > 30:
-                consigli.append("Cane di taglia grande: monitorare articolazioni e mobilità")
-        elif dati['specie'] == 'gatto':
-            if dati['peso'] < 3:
-                avvisi.append("Peso sotto la media per un gatto adulto")
-            elif dati['peso'] > 6:
-                avvisi.append("Possibile sovrappeso - consultare veterinario")
-        
-        # Analisi età
-        if dati['eta'] < 1:
-            consigli.append("Cucciolo/giovane: necessarie vaccinazioni e controlli frequenti")
-        elif dati['eta'] > 10:
-            consigli.append("Animale anziano: raccomandati controlli veterinari ogni 6 mesi")
-            consigli.append("Considerare dieta senior e integratori per articolazioni")
-        
-        # Analisi alimentazione
-        if dati['alimentazione'] == 'casalinga':
-            consigli.append("Dieta casalinga: assicurarsi che sia bilanciata e completa")
-        elif dati['alimentazione'] == 'crocchette':
-            consigli.append("Crocchette: verificare qualità ingredienti e adeguatezza all'età")
+        # Regole su peso, età e alimentazione (tabella regole_salute.json)
+        consigli, avvisi = self.regole.valuta(dati)
         
         # Analisi sintomi
-        sintomi_gravi = ['vomito', 'diarrea', 'sangue', 'letargia', 'febbre', 'convulsioni']
-        sintomi_moderati = ['tosse', 'starnuti', 'prurito', 'perdita appetito', 'sete eccessiva']
-        
-        sintomi_lista = [s.strip() for s in dati['sintomi'].split(',')]
-        
-        if 'nessuno' not in dati['sintomi']:
-            for sintomo in sintomi_lista:
-                if any(grave in sintomo for grave in sintomi_gravi):
-                    avvisi.append(f"⚠️  SINTOMO GRAVE: {sintomo.upper()} - CONSULTARE URGENTEMENTE IL VETERINARIO")
-                elif any(mod in sintomo for mod in sintomi_moderati):
-                    avvisi.append(f"Sintomo da monitorare: {sintomo} - se persiste, consultare veterinario")
+        sintomi = classifica_sintomi(dati['sintomi'])
+        
+        if not sintomi['nessuno']:
+            for sintomo, gravita, _ in sintomi['segmenti']:
+                if gravita == 'grave':
+                    avvisi.append(avviso_sintomo_grave(sintomo))
+                else:
+                    avvisi.append(avviso_sintomo_moderato(sintomo))
         else:
-            consigli.append("✓ Nessun sintomo rilevato - continuare monitoraggio regolare")
+            consigli.append(CONSIGLIO_NESSUN_SINTOMO)
         
         return consigli, avvisi
     
@@ -117,6 +109,20 @@ class AnimalHealthDiary:
         print("consultare sempre un veterinario professionista.")
         print("="*60 + "\n")
     
+    def analisi_ia_batch(self, colonne):
+        """
+        Come analisi_ia, ma su molti record in forma colonnare (richiede NumPy)
+        
+        Args:
+            colonne: Mapping (dict di liste/array o DataFrame) con le colonne
+                     peso, eta, specie, alimentazione, sintomi
+        
+        Returns:
+            Lista di tuple (consigli, avvisi), una per riga
+        """
+        from animal_diary_vector import analisi_ia_vettoriale
+        return analisi_ia_vettoriale(colonne, self.regole)
+    
     def esegui(self):
         """Metodo principale per eseguire il diario"""
         dati = self.raccolta_dati()
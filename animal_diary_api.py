@@ -7,28 +7,139 @@ Sistema di monitoraggio salute animali con intelligenza artificiale avanzata
 
 import os
 import json
+import time
+import threading
+from types import SimpleNamespace
 from datetime import datetime
-from openai import OpenAI
+from analysis_cache import normalizza_dati, chiave_cache
+from symptom_matcher import classifica_sintomi
+from triage import Triage
+from rate_limits import LimitiAI, LimiteSuperato, BudgetEsaurito
+from metrics import REGISTRO
+
+# Metriche delle analisi AI (esportate dalla webapp su /metrics)
+DURATA_CHIAMATE = REGISTRO.istogramma(
+    'animal_diary_ai_request_seconds',
+    "Durata di una chiamata all'API OpenAI (in streaming: fino all'inizio della risposta)",
+    ('level', 'stream'))
+DURATA_ANALISI = REGISTRO.istogramma(
+    'animal_diary_ai_analysis_seconds',
+    "Durata di un'analisi, attese nei limiti e ritentativi compresi, per livello e origine della risposta",
+    ('level', 'source'))
+ERRORI_API = REGISTRO.contatore(
+    'animal_diary_ai_errors_total', "Chiamate all'API OpenAI fallite, per tipo di errore", ('error',))
+
+# Client OpenAI condivisi nel processo, uno per (api_key, base_url, max_retries)
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def get_openai_client(api_key=None, base_url=None, max_retries=None):
+    """
+    Ritorna il client OpenAI condiviso dal processo, creandolo al primo uso.
+    
+    Riusare lo stesso client mantiene aperto il pool di connessioni HTTP
+    (keep-alive), evitando handshake TCP+TLS a ogni analisi. Il pool viene
+    ricreato dopo un fork (es. worker WSGI), perché le connessioni non
+    possono essere condivise tra processi.
+    
+    openai e httpx vengono importati qui, alla prima creazione di un client:
+    la CLI senza chiave, i worker che non chiamano l'API e l'avvio della
+    webapp non ne pagano l'import.
+    
+    Configurazione tramite variabili d'ambiente:
+        OPENAI_POOL_SIZE          connessioni massime nel pool (default 10)
+        OPENAI_KEEPALIVE          secondi di vita delle connessioni inattive (default 30)
+        OPENAI_TIMEOUT            timeout di lettura in secondi (default 60)
+        OPENAI_CONNECT_TIMEOUT    timeout di connessione in secondi (default 5)
+        OPENAI_MAX_RETRIES        tentativi con backoff esponenziale su errori
+                                  di rete, 429 e 5xx (default 2)
+    
+    max_retries, se indicato, prevale su OPENAI_MAX_RETRIES: con i limiti di
+    LimitiAI vale 0, perché attese e ritentativi siano solo quelli condivisi.
+    """
+    global _clients_pid
+    api_key = api_key or os.getenv('OPENAI_API_KEY')
+    base_url = base_url or os.getenv('OPENAI_BASE_URL')
+    if max_retries is None:
+        max_retries = int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+    
+    with _clients_lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+        
+        client = _clients.get((api_key, base_url, max_retries))
+        if client is None:
+            import httpx
+            from openai import OpenAI
+            
+            pool_size = int(os.getenv('OPENAI_POOL_SIZE', '10'))
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=pool_size,
+                    max_keepalive_connections=pool_size,
+                    keepalive_expiry=float(os.getenv('OPENAI_KEEPALIVE', '30'))
+                ),
+                timeout=httpx.Timeout(
+                    float(os.getenv('OPENAI_TIMEOUT', '60')),
+                    connect=float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5'))
+                )
+            )
+            client = OpenAI(
+                api_key=api_key,
+                base_url=base_url,
+                max_retries=max_retries,
+                http_client=http_client
+            )
+            _clients[(api_key, base_url, max_retries)] = client
+        return client
+
 
 class AnimalHealthDiaryAPI:
-    def __init__(self, api_key=None):
+    def __init__(self, api_key=None, client=None, timeout=None, cache=None, triage=None, limiti=None,
+                 chiave_obbligatoria=True):
         """
         Inizializza il diario con integrazione OpenAI
         
         Args:
             api_key: Chiave API OpenAI (se None, viene letta da variabile d'ambiente)
+            client: Client compatibile con OpenAI già pronto (es. client finto per i test)
+            timeout: Timeout in secondi della singola chiamata API (None = default client)
+            cache: AnalysisCache per riusare risposte a input equivalenti (opzionale)
+            triage: Triage che sceglie tra risposta locale, prompt breve e analisi
+                    completa (None = sempre analisi completa)
+            limiti: LimitiAI con limiti al minuto, budget e registro dell'uso,
+                    condivisi tra le istanze (None = chiamate senza limiti)
+            chiave_obbligatoria: Se False la chiave mancante è un errore solo
+                    alla prima chiamata API (es. risposte locali del triage)
         """
         self.api_key = api_key or os.getenv('OPENAI_API_KEY')
-        if not self.api_key:
-            raise ValueError(
-                "API Key mancante! Impostare OPENAI_API_KEY come variabile d'ambiente "
-                "o passarla al costruttore."
-            )
+        if client is None and not self.api_key and chiave_obbligatoria:
+            raise ValueError(self._CHIAVE_MANCANTE)
         
-        self.client = OpenAI(api_key=self.api_key)
+        self._client = client
+        self.timeout = timeout
+        self.cache = cache
+        self.triage = triage
+        self.limiti = limiti
         self.entries = []
         self.model = "gpt-4o-mini"  # Modello economico e veloce
     
+    _CHIAVE_MANCANTE = ("API Key mancante! Impostare OPENAI_API_KEY come variabile d'ambiente "
+                        "o passarla al costruttore.")
+    
+    @property
+    def client(self):
+        """Client OpenAI, ottenuto dal pool condiviso alla prima chiamata API"""
+        if self._client is None:
+            if not self.api_key:
+                raise ValueError(self._CHIAVE_MANCANTE)
+            # Con i limiti i ritentativi sono tutti in _crea: nessuno nascosto nel client
+            self._client = get_openai_client(self.api_key, max_retries=0 if self.limiti is not None else None)
+        return self._client
+    
     def raccolta_dati(self):
         """Raccoglie i dati dell'animale dall'utente"""
         print("\n=== DIARIO SALUTE ANIMALE - AI VERSION ===")
@@ -86,12 +197,27 @@ Ricorda di specificare sempre che questi sono consigli generali e non sostituisc
 """
         return prompt
     
-    def analisi_ai(self, dati):
+    def crea_prompt_breve(self, dati, valutazione):
+        """Prompt ridotto per i casi semplici, con l'esito delle regole locali"""
+        esito = '\n'.join(f"- {messaggio}" for messaggio in valutazione.avvisi + valutazione.consigli) or "- nessuno"
+        return f"""Sei un assistente veterinario. In al massimo 5 frasi, in italiano, commenta questi dati e l'esito dei controlli automatici.
+
+Animale: {dati['nome']}, {dati['specie']}, {dati['peso']} kg, {dati['eta']} anni, alimentazione {dati['alimentazione']}, attività {dati['attivita']}
+Sintomi: {dati['sintomi']}
+Note: {dati['note']}
+Controlli automatici:
+{esito}
+
+Ricorda che sono consigli generali e non sostituiscono una visita veterinaria.
+"""
+    
+    def analisi_ai(self, dati, usa_cache=True):
         """
         Invia i dati all'API OpenAI e ottiene una risposta intelligente
         
         Args:
             dati: Dizionario con i dati dell'animale
+            usa_cache: Se False ignora la risposta in cache (che viene aggiornata)
             
         Returns:
             Risposta dell'AI come stringa
@@ -99,31 +225,198 @@ Ricorda di specificare sempre che questi sono consigli generali e non sostituisc
         print("\n🤖 Analisi AI in corso...")
         
         try:
-            prompt = self.crea_prompt(dati)
-            
-            # Chiamata all'API OpenAI
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Sei un assistente veterinario esperto e premuroso. "
-                                   "Fornisci consigli utili e professionali sulla salute degli animali."
-                    },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.7,
-                max_tokens=800
-            )
-            
-            risposta_ai = response.choices[0].message.content
+            return self.richiesta_ai(dati, usa_cache)
+        except Exception as e:
+            return f"Errore nella chiamata API: {str(e)}"
+    
+    def richiesta_ai(self, dati, usa_cache=True):
+        """
+        Come analisi_ai, ma gli errori dell'API vengono propagati come eccezioni
+        (per chi deve distinguerli, es. l'analisi batch con ritentativi)
+        """
+        inizio = time.perf_counter()
+        valutazione = self.valuta(dati)
+        if valutazione is not None and valutazione.livello == 'locale':
+            risposta_ai = self.triage.risposta_locale(valutazione)
+            self._registra(valutazione, inizio)
+            return risposta_ai
+        
+        chiave, risposta_ai = self._leggi_cache(dati, usa_cache, valutazione)
+        if risposta_ai is not None:
+            self._registra(valutazione, inizio, da_cache=True)
             return risposta_ai
+        
+        # Chiamata all'API OpenAI
+        parametri = self.parametri_richiesta(dati, valutazione)
+        response, prenotazione = self._crea(dati, valutazione, parametri)
+        
+        risposta_ai = response.choices[0].message.content
+        if chiave is not None:
+            self.cache.set(chiave, risposta_ai)
+        self._registra(valutazione, inizio, parametri, risposta_ai, getattr(response, 'usage', None),
+                       prenotazione=prenotazione)
+        return risposta_ai
+    
+    def analisi_ai_stream(self, dati, usa_cache=True):
+        """
+        Come analisi_ai, ma in streaming: genera i frammenti di testo man mano
+        che arrivano dal modello (la risposta completa è la loro concatenazione)
+        
+        Args:
+            dati: Dizionario con i dati dell'animale
+            usa_cache: Se False ignora la risposta in cache (che viene aggiornata)
             
+        Yields:
+            Frammenti di testo della risposta
+        """
+        try:
+            yield from self.richiesta_ai_stream(dati, usa_cache)
         except Exception as e:
-            return f"Errore nella chiamata API: {str(e)}"
+            yield f"Errore nella chiamata API: {str(e)}"
+    
+    def richiesta_ai_stream(self, dati, usa_cache=True):
+        """
+        Come analisi_ai_stream, ma gli errori dell'API vengono propagati come
+        eccezioni (es. la webapp, che non salva le analisi fallite)
+        """
+        inizio = time.perf_counter()
+        valutazione = self.valuta(dati)
+        if valutazione is not None and valutazione.livello == 'locale':
+            self._registra(valutazione, inizio)
+            yield self.triage.risposta_locale(valutazione)
+            return
+        
+        chiave, risposta_ai = self._leggi_cache(dati, usa_cache, valutazione)
+        if risposta_ai is not None:
+            self._registra(valutazione, inizio, da_cache=True)
+            yield risposta_ai
+            return
+        
+        frammenti = []
+        usage = None
+        parametri = self.parametri_richiesta(dati, valutazione)
+        # include_usage: l'ultimo chunk (senza choices) riporta i token effettivi
+        stream, prenotazione = self._crea(dati, valutazione, parametri, stream=True,
+                                          stream_options={'include_usage': True})
+        try:
+            for chunk in stream:
+                usage = getattr(chunk, 'usage', None) or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    frammenti.append(chunk.choices[0].delta.content)
+                    yield chunk.choices[0].delta.content
+        except BaseException:
+            # Anche interrotta, la risposta ha consumato token
+            if prenotazione is not None:
+                self.limiti.concludi(prenotazione, usage or self._stima_usage(parametri, ''.join(frammenti)))
+            raise
+        if chiave is not None:
+            self.cache.set(chiave, ''.join(frammenti))
+        self._registra(valutazione, inizio, parametri, ''.join(frammenti), usage, prenotazione=prenotazione)
+    
+    def valuta(self, dati):
+        """Valutazione del triage (caso e livello di analisi), None senza triage"""
+        return self.triage.valuta(dati) if self.triage is not None else None
+    
+    def livello(self, dati):
+        """Livello di analisi che riceverà il record: locale, breve o completa"""
+        valutazione = self.valuta(dati)
+        return valutazione.livello if valutazione is not None else 'completa'
+    
+    def _crea(self, dati, valutazione, parametri, **opzioni):
+        """
+        Chiamata chat.completions.create. Con i limiti configurati prima
+        prenota budget e turno nei limiti al minuto (attendendo, se serve),
+        poi ritenta gli errori temporanei (429, rete, 5xx) dopo il
+        Retry-After o il backoff condiviso da tutti i worker.
+        
+        Returns:
+            (risposta dell'API, prenotazione da concludere o None)
+        """
+        livello = valutazione.livello if valutazione is not None else 'completa'
+        if self.limiti is None:
+            return self._chiama(livello, parametri, opzioni), None
+        for tentativo in range(self.limiti.tentativi):
+            prenotazione = self.limiti.prenota(dati['nome'], livello, parametri)
+            try:
+                return self._chiama(livello, parametri, opzioni), prenotazione
+            except Exception as e:
+                attesa = self.limiti.annulla(prenotazione, e, tentativo)
+                if attesa is None or tentativo == self.limiti.tentativi - 1:
+                    raise
+            time.sleep(attesa)
+    
+    def _chiama(self, livello, parametri, opzioni):
+        """Una chiamata chat.completions.create, con durata ed errori nelle metriche"""
+        with DURATA_CHIAMATE.misura(level=livello, stream='true' if opzioni.get('stream') else 'false'):
+            try:
+                return self.client.chat.completions.create(**opzioni, **parametri)
+            except Exception as e:
+                ERRORI_API.inc(error=type(e).__name__)
+                raise
+    
+    @staticmethod
+    def _stima_usage(parametri, risposta_ai):
+        """Token di una chiamata stimati in circa 4 caratteri ciascuno (se l'API non li riporta)"""
+        return SimpleNamespace(
+            prompt_tokens=sum(len(messaggio['content']) for messaggio in parametri['messages']) // 4,
+            completion_tokens=len(risposta_ai) // 4,
+        )
+    
+    def _registra(self, valutazione, inizio, parametri=None, risposta_ai='', usage=None, da_cache=False,
+                  prenotazione=None):
+        """
+        Durata dell'analisi nelle metriche, uso della chiamata nel registro
+        dei limiti e statistiche per livello del triage, se configurati.
+        Senza parametri la risposta è locale; senza l'uso riportato
+        dall'API (es. streaming interrotto) i token sono stimati.
+        """
+        secondi = time.perf_counter() - inizio
+        DURATA_ANALISI.osserva(
+            secondi, level=valutazione.livello if valutazione is not None else 'completa',
+            source='cache' if da_cache else 'api' if parametri is not None else 'local')
+        if usage is None and parametri is not None:
+            usage = self._stima_usage(parametri, risposta_ai)
+        if prenotazione is not None:
+            self.limiti.concludi(prenotazione, usage)
+        if valutazione is not None:
+            self.triage.registra(valutazione, secondi, usage=usage, da_cache=da_cache)
+    
+    def _leggi_cache(self, dati, usa_cache, valutazione=None):
+        """Ritorna (chiave, risposta in cache o None); chiave None senza cache"""
+        if self.cache is None:
+            return None, None
+        chiave = chiave_cache(self.parametri_richiesta(normalizza_dati(dati), valutazione))
+        if not usa_cache:
+            self.cache.bypass()
+            return chiave, None
+        return chiave, self.cache.get(chiave)
+    
+    def parametri_richiesta(self, dati, valutazione=None):
+        """
+        Parametri della chiamata chat.completions per un'analisi: prompt
+        completo, o prompt breve con meno token se il triage ha scelto il
+        livello 'breve'
+        """
+        breve = valutazione is not None and valutazione.livello == 'breve'
+        parametri = {
+            'model': self.model,
+            'messages': [
+                {
+                    "role": "system",
+                    "content": "Sei un assistente veterinario esperto e premuroso. "
+                               "Fornisci consigli utili e professionali sulla salute degli animali."
+                },
+                {
+                    "role": "user",
+                    "content": self.crea_prompt_breve(dati, valutazione) if breve else self.crea_prompt(dati)
+                }
+            ],
+            'temperature': 0.7,
+            'max_tokens': self.triage.max_tokens[valutazione.livello] if valutazione is not None else 800
+        }
+        if self.timeout:
+            parametri['timeout'] = self.timeout
+        return parametri
     
     def genera_report(self, dati, risposta_ai):
         """Genera e stampa il report finale con l'analisi AI"""
@@ -142,6 +435,12 @@ Ricorda di specificare sempre che questi sono consigli generali e non sostituisc
         if dati['note']:
             print(f"  Note: {dati['note']}")
         
+        # Sintomi gravi evidenziati comunque, indipendentemente dalla risposta AI
+        gravi = [sintomo for sintomo, gravita, _ in classifica_sintomi(dati['sintomi'])['segmenti']
+                 if gravita == 'grave']
+        if gravi:
+            print(f"\n⚠️  SINTOMI GRAVI: {', '.join(gravi).upper()} - CONSULTARE IL VETERINARIO")
+        
         print(f"\n🤖 ANALISI INTELLIGENTE AI:")
         print("-" * 70)
         print(risposta_ai)
@@ -177,7 +476,16 @@ Ricorda di specificare sempre che questi sono consigli generali e non sostituisc
         if dati is None:
             return
         
-        risposta_ai = self.analisi_ai(dati)
+        print("\n🤖 Analisi AI in corso...")
+        try:
+            risposta_ai = self.richiesta_ai(dati)
+        except (LimiteSuperato, BudgetEsaurito) as e:
+            # Rifiutata dai limiti: nessuna analisi da mostrare né da salvare
+            print(f"\n⏳ {str(e)}")
+            return
+        except Exception as e:
+            print(f"\n❌ Errore nella chiamata API: {str(e)}")
+            return
         self.genera_report(dati, risposta_ai)
         
         if salva:
@@ -197,7 +505,7 @@ def test_api_connection():
         return False
     
     try:
-        client = OpenAI(api_key=api_key)
+        client = get_openai_client(api_key)
         response = client.chat.completions.create(
             model="gpt-4o-mini",
             messages=[{"role": "user", "content": "Test"}],
@@ -221,7 +529,7 @@ def main():
         return
     
     try:
-        diario = AnimalHealthDiaryAPI()
+        diario = AnimalHealthDiaryAPI(triage=Triage.from_env(), limiti=LimitiAI.from_env())
         diario.esegui()
     except ValueError as e:
         print(f"\n❌ Errore: {str(e)}")
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animal Health Diary - Analisi batch
+Analizza molti animali da CSV/JSONL in parallelo, con risultati in JSONL
+"""
+
+import os
+import sys
+import csv
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from animal_diary_api import AnimalHealthDiaryAPI
+from triage import Triage
+from rate_limits import LimitiAI
+
+# Stesse colonne scritte da DataExporter.export_to_csv (webapp/utils.py)
+COLONNE_CSV = {
+    'ID': 'id',
+    'Data': 'data',
+    'Nome': 'nome',
+    'Specie': 'specie',
+    'Peso (kg)': 'peso',
+    'Età (anni)': 'eta',
+    'Alimentazione': 'alimentazione',
+    'Attività': 'attivita',
+    'Sintomi': 'sintomi',
+    'Note': 'note',
+}
+
+CAMPI_TESTO = ('nome', 'specie', 'alimentazione', 'attivita', 'sintomi', 'note', 'data')
+
+
+def _riga_json(riga):
+    """Record da una riga JSONL, o ValueError se la riga non è leggibile"""
+    try:
+        return json.loads(riga)
+    except ValueError as e:
+        return ValueError(f"JSON non valido: {e}")
+
+
+def leggi_record(path):
+    """
+    Legge i record da CSV (colonne dell'export della webapp o nomi dei campi)
+    o JSONL (dizionari dati, o entry dello storico con chiave 'dati').
+
+    Yields:
+        (chiave, record) dove chiave è l'ID del record o il numero di riga;
+        record è un ValueError se la riga non è leggibile (le altre righe
+        proseguono e la riga risulta non valida)
+    """
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            righe = (
+                {COLONNE_CSV.get(colonna, colonna): valore for colonna, valore in riga.items()}
+                for riga in csv.DictReader(f)
+            )
+        else:
+            righe = (_riga_json(riga) for riga in f if riga.strip())
+
+        for numero, riga in enumerate(righe, start=1):
+            if not isinstance(riga, dict):
+                if not isinstance(riga, ValueError):
+                    riga = ValueError("Record non valido: atteso un oggetto")
+                yield f"riga-{numero}", riga
+                continue
+            if isinstance(riga.get('dati'), dict):
+                riga = dict(riga['dati'], id=riga.get('id'))
+            chiave = str(riga.get('id') or f"riga-{numero}")
+            yield chiave, riga
+
+
+def valida_record(record):
+    """Converte un record nel formato dati di AnimalHealthDiaryAPI (ValueError se non valido)"""
+    dati = {campo: str(record.get(campo) or '') for campo in CAMPI_TESTO}
+    dati['specie'] = dati['specie'].lower()
+    dati['peso'] = float(record.get('peso') or 0)
+    dati['eta'] = int(float(record.get('eta') or 0))
+    if not dati['nome']:
+        raise ValueError("Nome animale mancante")
+    return dati
+
+
+def chiavi_completate(path):
+    """Chiavi già analizzate con successo in un file di risultati JSONL"""
+    completate = set()
+    if not os.path.exists(path):
+        return completate
+    with open(path, 'r', encoding='utf-8') as f:
+        for riga in f:
+            try:
+                risultato = json.loads(riga)
+            except ValueError:
+                continue  # Riga troncata da un'esecuzione interrotta
+            if risultato.get('status') == 'ok':
+                completate.add(risultato['id'])
+    return completate
+
+
+def _analizza(api, chiave, record):
+    """
+    Analizza un record; ritorna il risultato JSONL. Attese, ritentativi e
+    budget sono quelli dei limiti dell'API (api.limiti), condivisi da tutti
+    i worker: le risposte locali del triage non li consumano.
+    """
+    if isinstance(record, ValueError):
+        return {'id': chiave, 'status': 'invalid', 'error': str(record)}
+    try:
+        dati = valida_record(record)
+    except ValueError as e:
+        return {'id': chiave, 'status': 'invalid', 'error': str(e), 'record': record}
+
+    try:
+        risposta_ai = api.richiesta_ai(dati)
+        return {'id': chiave, 'status': 'ok', 'dati': dati, 'analisi_ai': risposta_ai}
+    except Exception as e:
+        return {'id': chiave, 'status': 'error', 'error': str(e), 'dati': dati}
+
+
+def analizza_batch(api, record, workers=4, salta=()):
+    """
+    Analizza i record in parallelo con al massimo `workers` richieste in volo.
+
+    I record vengono letti man mano (l'input non è caricato tutto in memoria)
+    e i risultati generati nell'ordine in cui si completano.
+
+    Args:
+        api: AnimalHealthDiaryAPI da usare (client condiviso, cache, triage e
+             limiti al minuto/budget opzionali)
+        record: Iterabile di (chiave, record) come da leggi_record()
+        workers: Richieste concorrenti
+        salta: Chiavi da non rianalizzare (es. già completate)
+
+    Yields:
+        Dizionari risultato con 'id', 'status' (ok/error/invalid) e dati/analisi
+    """
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch') as executor:
+        in_volo = set()
+        for chiave, riga in record:
+            if chiave in salta:
+                continue
+            if len(in_volo) >= workers * 2:
+                completati, in_volo = wait(in_volo, return_when=FIRST_COMPLETED)
+                for future in completati:
+                    yield future.result()
+            in_volo.add(executor.submit(_analizza, api, chiave, riga))
+        for future in in_volo:
+            yield future.result()
+
+
+def stampa_livelli(info):
+    """Riepilogo per livello di analisi del triage: richieste, latenza, token e costo"""
+    print("\nLivello     Richieste  Da cache  Latenza media  Token in/out      Costo stimato")
+    for livello, voce in info['livelli'].items():
+        if voce['richieste']:
+            print(f"{livello:<11} {voce['richieste']:>9}  {voce['da_cache']:>8}  {voce['latenza_media_ms']:>10.1f} ms"
+                  f"  {voce['token_input']:>7}/{voce['token_output']:<8}  ${voce['costo_usd']:.4f}")
+
+
+def stampa_uso(info):
+    """Riepilogo dei limiti: attese, sospensioni dopo un 429 e uso del giorno"""
+    limiti, oggi = info['limiti'], info['oggi']
+    print(f"\nChiamate AI oggi: {oggi['chiamate']}  Token: {oggi['token_input']}/{oggi['token_output']}"
+          f"  Costo: ${oggi['costo_usd']:.4f}")
+    print(f"Attese nei limiti: {limiti['attese']} (media {limiti['attesa_media_ms']:.0f} ms)"
+          f"  Sospensioni dopo 429: {limiti['sospensioni']}")
+
+
+def main():
+    """Funzione principale"""
+    parser = argparse.ArgumentParser(description="Analisi AI batch di record da CSV/JSONL")
+    parser.add_argument('input', help="File CSV (export della webapp) o JSONL")
+    parser.add_argument('-o', '--output', default='analisi_batch.jsonl',
+                        help="File JSONL dei risultati (riprende le righe già completate)")
+    parser.add_argument('-w', '--workers', type=int, default=4, help="Richieste concorrenti")
+    parser.add_argument('--rpm', type=int, default=None, help="Limite di richieste al minuto (default AI_RPM)")
+    parser.add_argument('--tentativi', type=int, default=None,
+                        help="Tentativi su errori temporanei (default AI_RETRIES o 3)")
+    args = parser.parse_args()
+
+    try:
+        limiti = LimitiAI.from_env(richieste_al_minuto=args.rpm, tentativi=args.tentativi)
+        api = AnimalHealthDiaryAPI(triage=Triage.from_env(), limiti=limiti)
+    except ValueError as e:
+        print(f"\n❌ Errore: {str(e)}")
+        return 1
+
+    completate = chiavi_completate(args.output)
+    if completate:
+        print(f"↩️  {len(completate)} record già completati in {args.output}: verranno saltati")
+
+    conteggi = {'ok': 0, 'error': 0, 'invalid': 0}
+    with open(args.output, 'a', encoding='utf-8') as out:
+        risultati = analizza_batch(api, leggi_record(args.input), workers=args.workers, salta=completate)
+        for risultato in risultati:
+            out.write(json.dumps(risultato, ensure_ascii=False) + '\n')
+            out.flush()
+            conteggi[risultato['status']] += 1
+            simbolo = '✅' if risultato['status'] == 'ok' else '❌'
+            print(f"{simbolo} {risultato['id']}: {risultato['status']}", file=sys.stderr)
+
+    print(f"\nCompletati: {conteggi['ok']}  Errori: {conteggi['error']}  Non validi: {conteggi['invalid']}")
+    stampa_livelli(api.triage.info())
+    stampa_uso(limiti.info())
+    if conteggi['error'] or conteggi['invalid']:
+        print("Rilanciare lo stesso comando per ritentare solo i record non completati.")
+    return 0 if not conteggi['error'] else 2
+
+
+if __name__ == "__main__":
+    sys.exit(main())
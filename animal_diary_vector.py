@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animal Health Diary - Analisi vettoriale
+Applica le regole di AnimalHealthDiary.analisi_ia a molti record insieme con NumPy
+"""
+
+import numbers
+
+import numpy as np
+
+from animal_diary import CONSIGLIO_NESSUN_SINTOMO, avviso_sintomo_grave, avviso_sintomo_moderato
+from health_rules import tabella_predefinita
+from symptom_matcher import classifica_sintomi
+
+COLONNE = ('peso', 'eta', 'specie', 'alimentazione', 'sintomi')
+
+# Bit disponibili per il codice delle regole di un gruppo (specie, razza)
+MAX_REGOLE = 62
+
+# Cella di un campo assente dal record (come KeyError nella valutazione scalare)
+MANCANTE = object()
+
+
+def colonne_da_record(records):
+    """
+    Converte una lista di dizionari dati nelle colonne attese da
+    analisi_ia_vettoriale; i campi assenti da un record diventano MANCANTE
+    """
+    colonne = {colonna: [dati.get(colonna, MANCANTE) for dati in records] for colonna in COLONNE}
+    colonne['sintomi'] = [dati['sintomi'] for dati in records]
+    if any('razza' in dati for dati in records):
+        colonne['razza'] = [dati.get('razza') or '' for dati in records]
+    return colonne
+
+
+def _confrontabile(valore, numerica):
+    """Se la valutazione scalare può confrontare la cella senza TypeError"""
+    if numerica:
+        return isinstance(valore, (numbers.Real, np.bool_))
+    return isinstance(valore, str)
+
+
+class _Colonne:
+    """
+    Colonne convertite in array una volta sola, numeriche o testuali secondo
+    il confronto, con la maschera delle celle confrontabili: come in
+    RuleTable.valuta, un campo assente o di tipo diverso (es. peso '4' da un
+    CSV) non soddisfa la condizione.
+    """
+
+    def __init__(self, colonne):
+        self._colonne = colonne
+        self._array = {}
+
+    def _converti(self, campo, numerica):
+        """(valori, validi) della colonna; le celle non valide hanno un valore neutro"""
+        chiave = (campo, numerica)
+        if chiave not in self._array:
+            colonna = self._colonne[campo]
+            # Nessun controllo per cella se il tipo è certo: colonne numeriche
+            # (NumPy ne deduce il dtype solo se tutti i valori sono numeri) o
+            # testuali già tipizzate (una lista mista come ['a', 5] verrebbe
+            # invece convertita tutta in testo)
+            grezza = np.asarray(colonna)
+            if numerica:
+                tipo_certo = grezza.dtype.kind in 'biuf'
+            else:
+                tipo_certo = hasattr(colonna, 'dtype') and grezza.dtype.kind == 'U'
+            if tipo_certo:
+                valori, validi = grezza, np.ones(len(grezza), dtype=bool)
+            else:
+                celle = np.asarray(self._colonne[campo], dtype=object).ravel()
+                validi = np.fromiter((_confrontabile(v, numerica) for v in celle), dtype=bool, count=len(celle))
+                valori = np.where(validi, celle, 0.0 if numerica else '')
+            self._array[chiave] = (valori.astype(float if numerica else str), validi)
+        return self._array[chiave]
+
+    def confronta(self, campo, confronto, valore, righe):
+        """Maschera delle righe indicate che soddisfano la condizione"""
+        if campo not in self._colonne:
+            return np.zeros(len(righe), dtype=bool)
+        numerica = isinstance(valore, (int, float)) and not isinstance(valore, bool)
+        if numerica or isinstance(valore, str):
+            valori, validi = self._converti(campo, numerica)
+            return validi[righe] & confronto(valori[righe], valore)
+        # Valori di altro tipo nella tabella (es. booleani): confronto cella per cella
+        celle = np.asarray(self._colonne[campo], dtype=object).ravel()[righe]
+        return np.fromiter((_soddisfa(confronto, cella, valore) for cella in celle), dtype=bool, count=len(celle))
+
+    def testo(self, campo, righe_totali):
+        """Colonna testuale minuscola per i raggruppamenti; assente o non testo -> ''"""
+        if campo not in self._colonne:
+            return np.full(righe_totali, '')
+        valori, validi = self._converti(campo, False)
+        return np.char.lower(np.where(validi, valori, ''))
+
+
+def _soddisfa(confronto, cella, valore):
+    """Confronto scalare di una cella, False se assente o non confrontabile"""
+    if cella is MANCANTE:
+        return False
+    try:
+        return bool(confronto(cella, valore))
+    except TypeError:
+        return False
+
+
+def _avvisi_sintomi(sintomi):
+    """
+    Avvisi per ogni stringa di sintomi distinta, classificata una sola volta.
+
+    Args:
+        sintomi: Array delle stringhe di sintomi distinte
+
+    Returns:
+        (nessuno, avvisi): per ogni stringa, se indica "nessuno" sintomo
+        e la lista dei suoi avvisi
+    """
+    nessuno, avvisi = [], []
+    for testo in sintomi.tolist():
+        classificazione = classifica_sintomi(testo)
+        nessuno.append(classificazione['nessuno'])
+        avvisi.append([] if classificazione['nessuno'] else [
+            avviso_sintomo_grave(sintomo) if gravita == 'grave' else avviso_sintomo_moderato(sintomo)
+            for sintomo, gravita, _ in classificazione['segmenti']
+        ])
+    return nessuno, avvisi
+
+
+def _codici_gruppo(regole, righe, colonne):
+    """
+    Codice a bit delle regole soddisfatte per le righe di un gruppo: il bit i
+    è acceso se la riga soddisfa tutte le condizioni della regola i.
+    """
+    if len(regole) > MAX_REGOLE:
+        raise ValueError(f"Più di {MAX_REGOLE} regole per una specie: non supportato in forma vettoriale")
+    codici = np.zeros(len(righe), dtype=np.int64)
+    for bit, (condizioni, _, _) in enumerate(regole):
+        maschera = np.ones(len(righe), dtype=bool)
+        for campo, confronto, valore in condizioni:
+            maschera &= colonne.confronta(campo, confronto, valore, righe)
+        codici |= maschera.astype(np.int64) << bit
+    return codici
+
+
+def _messaggi(regole, codice):
+    """Consigli e avvisi delle regole accese nel codice, nell'ordine della tabella"""
+    consigli, avvisi = [], []
+    for bit, (_, consigli_regola, avvisi_regola) in enumerate(regole):
+        if codice >> bit & 1:
+            consigli.extend(consigli_regola)
+            avvisi.extend(avvisi_regola)
+    return consigli, avvisi
+
+
+def analisi_ia_vettoriale(colonne, regole=None):
+    """
+    Stesso risultato di AnimalHealthDiary.analisi_ia riga per riga, calcolato
+    con poche passate vettoriali sull'intero insieme di record.
+
+    Le righe vengono raggruppate per (specie, razza); in ogni gruppo le regole
+    della tabella diventano un codice a bit per riga. I messaggi si
+    costruiscono una volta per ogni combinazione distinta di codice e
+    stringa di sintomi.
+
+    Args:
+        colonne: Mapping con le colonne peso, eta, specie, alimentazione,
+                 sintomi e, se serve, razza (liste, array NumPy o colonne
+                 di un DataFrame). Colonne assenti e celle non confrontabili
+                 non soddisfano le regole, come nella valutazione scalare.
+        regole: RuleTable da applicare (default: tabella condivisa)
+
+    Returns:
+        Lista di tuple (consigli, avvisi), una per riga. Le righe con lo
+        stesso esito condividono le stesse liste: copiarle prima di modificarle.
+    """
+    regole = regole or tabella_predefinita()
+    sintomi = np.asarray(colonne['sintomi'], dtype=str)
+    if not len(sintomi):
+        return []
+    array = _Colonne(colonne)
+
+    specie = array.testo('specie', len(sintomi))
+    razza = array.testo('razza', len(sintomi))
+    specie_distinte, indice_specie = np.unique(specie, return_inverse=True)
+    razze_distinte, indice_razza = np.unique(razza, return_inverse=True)
+    gruppi = indice_specie.ravel() * len(razze_distinte) + indice_razza.ravel()
+
+    # Un indice globale per ogni coppia distinta (gruppo, codice delle regole)
+    esito_regole = np.empty(len(sintomi), dtype=np.int64)
+    messaggi = []
+    ordine = np.argsort(gruppi, kind='stable')
+    gruppi_distinti, inizi = np.unique(gruppi[ordine], return_index=True)
+    fini = [*inizi.tolist()[1:], len(ordine)]
+    for gruppo, inizio, fine in zip(gruppi_distinti.tolist(), inizi.tolist(), fini):
+        righe = ordine[inizio:fine]
+        regole_gruppo = regole.regole(specie_distinte[gruppo // len(razze_distinte)],
+                                      razze_distinte[gruppo % len(razze_distinte)])
+        codici, inverso = np.unique(_codici_gruppo(regole_gruppo, righe, array), return_inverse=True)
+        esito_regole[righe] = len(messaggi) + inverso.ravel()
+        messaggi.extend(_messaggi(regole_gruppo, codice) for codice in codici.tolist())
+
+    sintomi_distinti, indice_sintomi = np.unique(sintomi, return_inverse=True)
+    nessuno, avvisi_sintomi = _avvisi_sintomi(sintomi_distinti)
+
+    # Un solo esito per ogni coppia distinta (regole, stringa di sintomi)
+    n_sintomi = len(sintomi_distinti)
+    distinte, inverso = np.unique(esito_regole * n_sintomi + indice_sintomi.ravel(), return_inverse=True)
+    esiti = []
+    for chiave in distinte.tolist():
+        (consigli, avvisi), sintomo = messaggi[chiave // n_sintomi], chiave % n_sintomi
+        esiti.append((consigli + ([CONSIGLIO_NESSUN_SINTOMO] if nessuno[sintomo] else []),
+                      avvisi + avvisi_sintomi[sintomo]))
+    return list(map(esiti.__getitem__, inverso.ravel().tolist()))
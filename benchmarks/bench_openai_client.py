@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: client OpenAI nuovo a ogni analisi vs client condiviso
+Usa un server HTTP locale che imita /v1/chat/completions (nessuna rete)
+
+Uso:
+    python benchmarks/bench_openai_client.py [--requests 200] [--delay 0.002]
+"""
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import statistics
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+from openai import OpenAI
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import animal_diary_api
+from animal_diary_api import AnimalHealthDiaryAPI
+
+DATI = {
+    'nome': 'Luna', 'specie': 'gatto', 'peso': 4.2, 'eta': 6,
+    'alimentazione': 'mista', 'attivita': 'medio', 'sintomi': 'nessuno', 'note': ''
+}
+
+RISPOSTA = json.dumps({
+    'id': 'chatcmpl-stub', 'object': 'chat.completion', 'created': 0, 'model': 'gpt-4o-mini',
+    'choices': [{'index': 0, 'finish_reason': 'stop',
+                 'message': {'role': 'assistant', 'content': 'Analisi simulata.'}}],
+    'usage': {'prompt_tokens': 150, 'completion_tokens': 3, 'total_tokens': 153}
+}).encode('utf-8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Risponde a ogni POST con una completion fissa, con keep-alive HTTP/1.1"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    delay = 0.0
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        StubHandler.connections += 1  # Una volta per connessione TCP accettata
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(RISPOSTA)))
+        self.end_headers()
+        self.wfile.write(RISPOSTA)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def misura(nome, crea_api, richieste):
+    """Esegue le analisi e stampa latenza e connessioni aperte"""
+    StubHandler.connections = 0
+    latenze = []
+    # Silenzia il messaggio "Analisi AI in corso..." durante le misure
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(richieste):
+            start = time.perf_counter()
+            api = crea_api()
+            risposta = api.analisi_ai(DATI)
+            latenze.append((time.perf_counter() - start) * 1000)
+            assert risposta == 'Analisi simulata.', risposta
+    latenze.sort()
+    print(f"{nome:<22} media {statistics.mean(latenze):7.2f} ms   "
+          f"p50 {latenze[len(latenze) // 2]:7.2f} ms   "
+          f"p95 {latenze[int(len(latenze) * 0.95)]:7.2f} ms   "
+          f"connessioni {StubHandler.connections}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--delay', type=float, default=0.002, help='Latenza simulata del modello (s)')
+    args = parser.parse_args()
+
+    StubHandler.delay = args.delay
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+
+    def client_nuovo():
+        # Comportamento precedente: nuovo client e pool a freddo per ogni analisi
+        client = OpenAI(api_key='stub', base_url=base_url, http_client=httpx.Client())
+        return AnimalHealthDiaryAPI(client=client)
+
+    def client_condiviso():
+        return AnimalHealthDiaryAPI(client=animal_diary_api.get_openai_client('stub', base_url))
+
+    try:
+        misura('client per richiesta', client_nuovo, args.requests)
+        misura('client condiviso', client_condiviso, args.requests)
+    finally:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: tempo di avvio a freddo della webapp, delle CLI e di un worker WSGI
+Misura ogni scenario in un interprete nuovo e usa python -X importtime per i moduli più pesanti
+
+Uso:
+    python benchmarks/bench_startup.py [--ripetizioni 5] [--eager]
+
+Con --eager openai e matplotlib vengono importati prima dello scenario,
+come faceva il codice prima degli import differiti, per confrontare i tempi.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WEBAPP = os.path.join(ROOT, 'webapp')
+
+# Dipendenze pesanti che nessuno scenario dovrebbe caricare all'avvio
+PESANTI = ('matplotlib', 'openai', 'httpx', 'numpy')
+
+# Worker WSGI con app precaricata (es. gunicorn --preload): fork del processo
+# che ha già importato l'app, poi prima richiesta servita dal figlio
+FORK_WORKER = """
+import os, time, app
+inizio = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    app.app.test_client().get('/api/status')
+    os._exit(0)
+os.waitpid(pid, 0)
+print(f'fork_ms={(time.perf_counter() - inizio) * 1000:.1f}')
+"""
+
+SCENARI = (
+    # (nome, directory di lavoro, codice)
+    ('webapp (import app)', WEBAPP, 'import app'),
+    ('CLI base (animal_diary)', ROOT, 'import animal_diary'),
+    ('CLI AI (animal_diary_api)', ROOT, 'import animal_diary_api'),
+    ('CLI batch (animal_diary_batch)', ROOT, 'import animal_diary_batch'),
+    ('worker WSGI (fork + richiesta)', WEBAPP, FORK_WORKER),
+)
+
+STAMPA_CARICATI = f"\nimport sys\nprint('caricati=' + ','.join(m for m in {PESANTI!r} if m in sys.modules))\n"
+
+
+def esegui(cwd, codice, importtime=False):
+    """Esegue il codice in un interprete nuovo; ritorna (secondi, stdout, stderr)"""
+    comando = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', codice]
+    inizio = time.perf_counter()
+    risultato = subprocess.run(comando, cwd=cwd, capture_output=True, text=True)
+    durata = time.perf_counter() - inizio
+    if risultato.returncode != 0:
+        raise RuntimeError(f"Scenario fallito:\n{risultato.stderr[-2000:]}")
+    return durata, risultato.stdout, risultato.stderr
+
+
+def moduli_pesanti(stderr, quanti=5):
+    """
+    Dall'output di -X importtime: (tempo cumulativo totale in ms, i `quanti`
+    import diretti più costosi dei moduli di primo livello come (ms, modulo))
+    """
+    totale = 0
+    diretti = []
+    for riga in stderr.splitlines():
+        if not riga.startswith('import time:') or 'cumulative' in riga:
+            continue
+        _, cumulativo, nome = riga[len('import time:'):].split('|')
+        # Il nome è rientrato di due spazi per ogni livello di annidamento
+        livello = (len(nome) - len(nome.lstrip()) - 1) // 2
+        if livello == 0:
+            totale += int(cumulativo) / 1000
+        elif livello == 1:
+            diretti.append((int(cumulativo) / 1000, nome.strip()))
+    return totale, sorted(diretti, reverse=True)[:quanti]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--ripetizioni', type=int, default=5, help='Avvii per scenario (si usa la mediana)')
+    parser.add_argument('--eager', action='store_true',
+                        help='Importa openai e matplotlib prima di ogni scenario (import non differiti)')
+    args = parser.parse_args()
+
+    prefisso = 'import openai, httpx, matplotlib.figure\n' if args.eager else ''
+    for nome, cwd, codice in SCENARI:
+        codice = prefisso + codice + STAMPA_CARICATI
+        esegui(cwd, codice)  # Riscalda la cache dei file e i .pyc
+        tempi = [esegui(cwd, codice)[0] * 1000 for _ in range(args.ripetizioni)]
+        _, stdout, stderr = esegui(cwd, codice, importtime=True)
+        totale, pesanti = moduli_pesanti(stderr)
+        valori = dict(riga.split('=', 1) for riga in stdout.splitlines() if '=' in riga)
+
+        print(f"\n{nome}")
+        print(f"  avvio (mediana di {args.ripetizioni}): {statistics.median(tempi):8.1f} ms")
+        print(f"  import (-X importtime):     {totale:8.1f} ms")
+        if 'fork_ms' in valori:
+            print(f"  fork + prima richiesta:     {float(valori['fork_ms']):8.1f} ms")
+        print(f"  dipendenze pesanti caricate: {valori.get('caricati') or 'nessuna'}")
+        for ms, modulo in pesanti:
+            print(f"    {ms:8.1f} ms  {modulo}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmark: classificazione dei sintomi, confronto sintomo per sintomo vs symptom_matcher
+Confronta il vecchio ciclo sintomi x termini con la ricerca per termine su testi lunghi
+
+Uso:
+    python benchmarks/bench_symptom_matcher.py [--sintomi 200] [--frequenza 0.1] [--ripetizioni 500]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from symptom_matcher import SINTOMI_GRAVI, SINTOMI_MODERATI, classifica_sintomi
+
+PAROLE = (
+    "da ieri sera mangia poco e sembra stanco dopo la passeggiata nel parco "
+    "si gratta spesso le orecchie beve normalmente dorme più del solito "
+    "zoppica leggermente sulla zampa destra e non vuole giocare con gli altri"
+).split()
+
+
+def scansione_annidata(testo):
+    """Implementazione precedente: ogni sintomo confrontato con ogni termine"""
+    risultato = []
+    if 'nessuno' in testo:
+        return risultato
+    for sintomo in [s.strip() for s in testo.lower().split(',')]:
+        if any(grave in sintomo for grave in SINTOMI_GRAVI):
+            risultato.append((sintomo, 'grave'))
+        elif any(mod in sintomo for mod in SINTOMI_MODERATI):
+            risultato.append((sintomo, 'moderato'))
+    return risultato
+
+
+def ricerca_per_termine(testo):
+    """Implementazione attuale (symptom_matcher), nello stesso formato"""
+    sintomi = classifica_sintomi(testo)
+    if sintomi['nessuno']:
+        return []
+    return [(sintomo.lower(), gravita) for sintomo, gravita, _ in sintomi['segmenti']]
+
+
+def genera_testo(sintomi, rng, frequenza=0.1):
+    """Descrizione libera con `sintomi` frasi separate da virgola, una su 1/frequenza con un termine"""
+    termini = list(SINTOMI_GRAVI + SINTOMI_MODERATI)
+    frasi = []
+    for _ in range(sintomi):
+        frase = rng.choices(PAROLE, k=rng.randint(6, 14))
+        if rng.random() < frequenza:
+            frase.insert(rng.randrange(len(frase)), rng.choice(termini))
+        frasi.append(' '.join(frase))
+    return ', '.join(frasi)
+
+
+def misura(nome, funzione, testi, ripetizioni):
+    start = time.perf_counter()
+    for _ in range(ripetizioni):
+        for testo in testi:
+            funzione(testo)
+    durata = (time.perf_counter() - start) / (ripetizioni * len(testi)) * 1e6
+    print(f"{nome:<22} {durata:9.1f} µs per testo")
+    return durata
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sintomi', type=int, default=200, help='Frasi per testo')
+    parser.add_argument('--testi', type=int, default=20)
+    parser.add_argument('--frequenza', type=float, default=0.1, help='Frazione di frasi con un sintomo noto')
+    parser.add_argument('--ripetizioni', type=int, default=500)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    con_accenti = [genera_testo(args.sintomi, rng, args.frequenza) for _ in range(args.testi)]
+    scenari = {
+        'testo ASCII': [testo.replace('più', 'piu') for testo in con_accenti],
+        'testo con accenti': con_accenti,
+    }
+    for scenario, testi in scenari.items():
+        for testo in testi:
+            assert scansione_annidata(testo) == ricerca_per_termine(testo)
+        lunghezza = sum(map(len, testi)) // len(testi)
+        print(f"\n{scenario}: {len(testi)} testi da {args.sintomi} sintomi (~{lunghezza} caratteri)")
+        prima = misura('scansione annidata', scansione_annidata, testi, args.ripetizioni)
+        dopo = misura('ricerca per termine', ricerca_per_termine, testi, args.ripetizioni)
+        print(f"speedup {prima / dopo:.1f}x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animal Health Diary - Tabella delle regole
+Regole su peso, età e alimentazione lette da JSON/YAML, ricaricate quando il file cambia
+"""
+
+import os
+import sys
+import json
+import time
+import operator
+import threading
+
+REGOLE_PREDEFINITE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'regole_salute.json')
+
+OPERATORI = {
+    'sotto': operator.lt,
+    'sopra': operator.gt,
+    'uguale': operator.eq,
+}
+
+
+def _compila_regola(regola):
+    """
+    Converte una regola della tabella in (condizioni, consigli, avvisi), con
+    condizioni = ((campo, operatore, valore), ...) tutte da soddisfare.
+
+    Formato: {"se": {"peso": {"sotto": 5}}, "consigli": [...], "avvisi": [...]}
+    """
+    condizioni = []
+    for campo, confronti in regola.get('se', {}).items():
+        for nome, valore in confronti.items():
+            if nome not in OPERATORI:
+                raise ValueError(f"Operatore sconosciuto '{nome}' per il campo '{campo}'")
+            condizioni.append((campo, OPERATORI[nome], valore))
+    consigli = tuple(regola.get('consigli', ()))
+    avvisi = tuple(regola.get('avvisi', ()))
+    if not condizioni or not (consigli or avvisi):
+        raise ValueError(f"Regola senza condizioni o senza messaggi: {regola}")
+    return tuple(condizioni), consigli, avvisi
+
+
+def _leggi_tabella(path):
+    """Legge la tabella da JSON o, se PyYAML è installato, da YAML"""
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ValueError("Tabella YAML: installare PyYAML (pip install pyyaml)")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+class RuleTable:
+    """
+    Regole compilate per specie (e razza), ricaricate quando il file cambia.
+
+    Per ogni coppia (specie, razza) le regole vengono compilate una volta in
+    una tupla: la valutazione costa una ricerca nel dizionario più le regole
+    di quella specie, indipendentemente da quante specie contiene la tabella.
+
+    Ordine delle regole: quelle della specie, poi quelle della razza (che con
+    "sostituisce": true prendono il posto di quelle della specie), poi le
+    regole comuni a tutte le specie.
+    """
+
+    def __init__(self, path=REGOLE_PREDEFINITE, intervallo=1.0):
+        """
+        Args:
+            path: File JSON (o YAML) della tabella
+            intervallo: Secondi minimi tra due controlli del file
+        """
+        self.path = path
+        self.intervallo = intervallo
+        self.errore = None
+        self._lock = threading.Lock()
+        self._stat_key = None
+        self._controllato = time.monotonic()
+        self._carica(os.stat(path))
+
+    def _carica(self, st):
+        """
+        Legge e valida la tabella; le regole per (specie, razza) si compilano
+        al primo uso. Lo stato è sostituito con un'unica assegnazione, così
+        chi valuta in parallelo vede la tabella vecchia o quella nuova.
+        """
+        tabella = _leggi_tabella(self.path)
+        try:
+            comuni = tuple(_compila_regola(r) for r in tabella.get('comuni', []))
+            specie = {}
+            for nome, voce in tabella.get('specie', {}).items():
+                razze = {
+                    razza.lower(): (tuple(_compila_regola(r) for r in dati.get('regole', [])),
+                                    bool(dati.get('sostituisce')))
+                    for razza, dati in voce.get('razze', {}).items()
+                }
+                specie[nome.lower()] = (tuple(_compila_regola(r) for r in voce.get('regole', [])), razze)
+        except (AttributeError, TypeError) as e:
+            raise ValueError(f"Struttura della tabella non valida: {e}")
+        self._stato = (comuni, specie, {})
+        self._stat_key = (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def _controlla(self):
+        """Ricarica la tabella se il file è cambiato (al più ogni `intervallo` secondi)"""
+        adesso = time.monotonic()
+        if adesso - self._controllato < self.intervallo:
+            return
+        with self._lock:
+            if adesso - self._controllato < self.intervallo:
+                return
+            self._controllato = adesso
+            try:
+                st = os.stat(self.path)
+                if (st.st_ino, st.st_size, st.st_mtime_ns) != self._stat_key:
+                    self._carica(st)
+                    self.errore = None
+            except (OSError, ValueError) as e:
+                # Tabella non valida o in scrittura: si continua con quella precedente
+                if str(e) != self.errore:
+                    print(f"⚠️  Regole non ricaricate da {self.path}: {e}", file=sys.stderr)
+                self.errore = str(e)
+
+    def regole(self, specie, razza=None):
+        """Regole compilate per specie e razza: ((condizioni, consigli, avvisi), ...)"""
+        self._controlla()
+        comuni, tabella_specie, cache = self._stato
+        chiave = ((specie or '').lower(), (razza or '').lower())
+        compilate = cache.get(chiave)
+        if compilate is None:
+            regole_specie, razze = tabella_specie.get(chiave[0], ((), {}))
+            regole_razza, sostituisce = razze.get(chiave[1], ((), False))
+            compilate = cache[chiave] = (() if sostituisce else regole_specie) + regole_razza + comuni
+        return compilate
+
+    def valuta(self, dati):
+        """Consigli e avvisi delle regole soddisfatte dai dati (esclusi i sintomi)"""
+        consigli, avvisi = [], []
+        for condizioni, consigli_regola, avvisi_regola in self.regole(dati.get('specie'), dati.get('razza')):
+            try:
+                if all(confronto(dati[campo], valore) for campo, confronto, valore in condizioni):
+                    consigli.extend(consigli_regola)
+                    avvisi.extend(avvisi_regola)
+            except (KeyError, TypeError):
+                continue  # Campo assente o di tipo non confrontabile: regola non applicabile
+        return consigli, avvisi
+
+    def info(self):
+        """File, specie configurate ed eventuale errore dell'ultimo ricaricamento"""
+        comuni, tabella_specie, _ = self._stato
+        return {
+            'path': self.path,
+            'specie': sorted(tabella_specie),
+            'regole_comuni': len(comuni),
+            'errore': self.errore,
+        }
+
+
+_tabella = None
+_tabella_lock = threading.Lock()
+
+
+def tabella_predefinita():
+    """Tabella condivisa dal processo, dal file in HEALTH_RULES_FILE (default regole_salute.json)"""
+    global _tabella
+    if _tabella is None:
+        with _tabella_lock:
+            if _tabella is None:
+                _tabella = RuleTable(os.getenv('HEALTH_RULES_FILE') or REGOLE_PREDEFINITE)
+    return _tabella
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animal Health Diary - Metriche
+Contatori e istogrammi leggeri dei percorsi critici, esportati nel formato testuale di Prometheus
+"""
+
+import math
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# Limiti (secondi) degli istogrammi di durata, gli stessi predefiniti di prometheus_client
+DURATE = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Content-Type della risposta di /metrics
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _numero(valore):
+    """Valore nel formato di Prometheus (+Inf, interi senza decimali)"""
+    if isinstance(valore, float):
+        if math.isinf(valore):
+            return '+Inf' if valore > 0 else '-Inf'
+        if valore.is_integer() and abs(valore) < 1e15:
+            return str(int(valore))
+    return repr(valore)
+
+
+def _etichette(nomi, valori, extra=''):
+    """{nome="valore",...} con i valori in escape; stringa vuota senza etichette"""
+    coppie = [
+        '{}="{}"'.format(nome, str(valore).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for nome, valore in zip(nomi, valori)
+    ]
+    if extra:
+        coppie.append(extra)
+    return '{' + ','.join(coppie) + '}' if coppie else ''
+
+
+class _Metrica:
+    """Metrica con etichette: un valore per ogni combinazione di valori delle etichette"""
+
+    tipo = None
+
+    def __init__(self, nome, descrizione, etichette=()):
+        self.nome = nome
+        self.descrizione = descrizione
+        self.etichette = tuple(etichette)
+        self._lock = threading.Lock()
+        self._valori = {}
+
+    def _chiave(self, valori):
+        if len(valori) != len(self.etichette) or any(nome not in valori for nome in self.etichette):
+            raise ValueError(f"{self.nome}: etichette attese {', '.join(self.etichette) or 'nessuna'}")
+        return tuple(str(valori[nome]) for nome in self.etichette)
+
+    def righe(self):
+        """Righe del formato testuale (senza HELP e TYPE)"""
+        raise NotImplementedError
+
+
+class Contatore(_Metrica):
+    """Contatore monotono (il nome termina per convenzione in _total)"""
+
+    tipo = 'counter'
+
+    def inc(self, quantita=1, **etichette):
+        chiave = self._chiave(etichette)
+        with self._lock:
+            self._valori[chiave] = self._valori.get(chiave, 0) + quantita
+
+    def righe(self):
+        with self._lock:
+            valori = sorted(self._valori.items())
+        for chiave, valore in valori:
+            yield f"{self.nome}{_etichette(self.etichette, chiave)} {_numero(valore)}"
+
+
+class Istogramma(_Metrica):
+    """Istogramma a limiti fissi: conteggi per limite, somma e numero delle osservazioni"""
+
+    tipo = 'histogram'
+
+    def __init__(self, nome, descrizione, etichette=(), limiti=DURATE):
+        super().__init__(nome, descrizione, etichette)
+        self.limiti = tuple(sorted(limiti))
+
+    def osserva(self, valore, **etichette):
+        chiave = self._chiave(etichette)
+        posizione = bisect.bisect_left(self.limiti, valore)
+        with self._lock:
+            voce = self._valori.get(chiave)
+            if voce is None:
+                voce = self._valori[chiave] = [[0] * (len(self.limiti) + 1), 0.0]
+            voce[0][posizione] += 1
+            voce[1] += valore
+
+    @contextmanager
+    def misura(self, **etichette):
+        """Osserva la durata in secondi del blocco with (anche se solleva un'eccezione)"""
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.osserva(time.perf_counter() - inizio, **etichette)
+
+    def righe(self):
+        with self._lock:
+            valori = sorted((chiave, (list(conteggi), somma)) for chiave, (conteggi, somma) in self._valori.items())
+        for chiave, (conteggi, somma) in valori:
+            cumulato = 0
+            for limite, conteggio in zip(self.limiti + (math.inf,), conteggi):
+                cumulato += conteggio
+                le = 'le="{}"'.format(_numero(float(limite)))
+                yield f"{self.nome}_bucket{_etichette(self.etichette, chiave, le)} {cumulato}"
+            yield f"{self.nome}_sum{_etichette(self.etichette, chiave)} {_numero(somma)}"
+            yield f"{self.nome}_count{_etichette(self.etichette, chiave)} {cumulato}"
+
+
+class Raccolta(_Metrica):
+    """
+    Valori letti al momento dell'esportazione da una funzione (dimensione
+    dello storico, statistiche delle cache già contate altrove). La funzione
+    ritorna un numero o, con etichette, un iterabile di (valori, numero).
+    """
+
+    def __init__(self, nome, descrizione, funzione, tipo='gauge', etichette=()):
+        super().__init__(nome, descrizione, etichette)
+        self.tipo = tipo
+        self.funzione = funzione
+
+    def righe(self):
+        risultato = self.funzione()
+        if not self.etichette:
+            yield f"{self.nome} {_numero(risultato)}"
+            return
+        for valori, valore in risultato:
+            if not isinstance(valori, tuple):
+                valori = (valori,)
+            yield f"{self.nome}{_etichette(self.etichette, valori)} {_numero(valore)}"
+
+
+class RegistroMetriche:
+    """
+    Metriche del processo, esportate insieme da esporta(). Creare due
+    volte una metrica con lo stesso nome ritorna quella esistente
+    (es. moduli importati da più punti). Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metriche = {}
+
+    def _registra(self, classe, nome, *args, **kwargs):
+        with self._lock:
+            metrica = self._metriche.get(nome)
+            if metrica is None:
+                metrica = self._metriche[nome] = classe(nome, *args, **kwargs)
+            elif not isinstance(metrica, classe):
+                raise ValueError(f"Metrica {nome} già registrata come {metrica.tipo}")
+            return metrica
+
+    def contatore(self, nome, descrizione, etichette=()):
+        return self._registra(Contatore, nome, descrizione, etichette)
+
+    def istogramma(self, nome, descrizione, etichette=(), limiti=DURATE):
+        return self._registra(Istogramma, nome, descrizione, etichette, limiti)
+
+    def raccolta(self, nome, descrizione, funzione, tipo='gauge', etichette=()):
+        """Metrica calcolata da funzione() a ogni esportazione (sostituisce una precedente con lo stesso nome)"""
+        metrica = Raccolta(nome, descrizione, funzione, tipo, etichette)
+        with self._lock:
+            self._metriche[nome] = metrica
+        return metrica
+
+    def esporta(self):
+        """
+        Tutte le metriche nel formato testuale di Prometheus (0.0.4). Una
+        funzione di raccolta che fallisce fa saltare solo la sua metrica.
+        """
+        with self._lock:
+            metriche = sorted(self._metriche.values(), key=lambda metrica: metrica.nome)
+        blocchi = []
+        for metrica in metriche:
+            try:
+                righe = list(metrica.righe())
+            except Exception:
+                continue
+            descrizione = metrica.descrizione.replace('\\', r'\\').replace('\n', r'\n')
+            blocchi.append(f"# HELP {metrica.nome} {descrizione}\n# TYPE {metrica.nome} {metrica.tipo}\n"
+                           + ''.join(riga + '\n' for riga in righe))
+        return ''.join(blocchi)
+
+
+# Registro condiviso dal processo (CLI e webapp)
+REGISTRO = RegistroMetriche()
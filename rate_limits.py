@@ -0,0 +1,503 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animal Health Diary - Limiti delle chiamate AI
+Limiti al minuto di richieste e token, backoff sui 429, registro dell'uso e budget giornalieri
+"""
+
+import os
+import time
+import sqlite3
+import threading
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+from triage import PREZZI
+
+# Stima dei token di un testo prima della chiamata: circa 4 caratteri ciascuno
+CARATTERI_PER_TOKEN = 4
+
+# Sospensione massima (secondi) del backoff esponenziale dopo 429 senza Retry-After
+BACKOFF_MAX = 60
+
+# Giorni di uso conservati nel registro
+GIORNI_REGISTRO = 90
+
+Prenotazione = namedtuple('Prenotazione', 'nome livello modello token_input token_output costo')
+
+
+class LimiteSuperato(Exception):
+    """La richiesta non può partire entro l'attesa massima (limiti al minuto o sospensione dopo un 429)"""
+
+    def __init__(self, messaggio, attesa):
+        super().__init__(messaggio)
+        self.attesa = attesa
+
+
+class BudgetEsaurito(Exception):
+    """Budget giornaliero di token o di costo esaurito (totale o per animale)"""
+
+    def __init__(self, messaggio, attesa):
+        super().__init__(messaggio)
+        self.attesa = attesa
+
+
+def errori_temporanei():
+    """Errori dell'API per cui ha senso ritentare (429, rete, timeout, 5xx)"""
+    import openai  # Non all'import del modulo: serve solo dopo un errore
+
+    return (
+        openai.RateLimitError,
+        openai.APIConnectionError,
+        openai.APITimeoutError,
+        openai.InternalServerError,
+    )
+
+
+def retry_after(errore):
+    """Secondi suggeriti dall'header Retry-After di una risposta 429/5xx"""
+    response = getattr(errore, 'response', None)
+    try:
+        return float(response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+
+def secondi_a_mezzanotte():
+    """Secondi al prossimo giorno (ora locale), quando i budget giornalieri ripartono"""
+    adesso = datetime.now()
+    domani = datetime.combine(adesso.date() + timedelta(days=1), datetime.min.time())
+    return (domani - adesso).total_seconds()
+
+
+class SecchioGettoni:
+    """
+    Secchio di gettoni: al massimo `per_minuto` gettoni, ricaricati in modo
+    continuo. Un prelievo più grande della capacità è concesso a secchio
+    pieno e lascia un debito. Non thread-safe: lo protegge il chiamante.
+    """
+
+    def __init__(self, per_minuto):
+        self.capacita = float(per_minuto)
+        self.velocita = per_minuto / 60.0
+        self.gettoni = self.capacita
+        self._aggiornato = time.monotonic()
+
+    def _ricarica(self, adesso):
+        self.gettoni = min(self.capacita, self.gettoni + (adesso - self._aggiornato) * self.velocita)
+        self._aggiornato = adesso
+
+    def attesa(self, quantita, adesso):
+        """Secondi prima che `quantita` gettoni siano disponibili"""
+        self._ricarica(adesso)
+        mancanti = min(quantita, self.capacita) - self.gettoni
+        return mancanti / self.velocita if mancanti > 0 else 0.0
+
+    def preleva(self, quantita, adesso):
+        """Preleva gettoni (negativo: li restituisce)"""
+        self._ricarica(adesso)
+        self.gettoni = min(self.capacita, self.gettoni - quantita)
+
+
+class Limitatore:
+    """
+    Limiti al minuto condivisi da tutti i thread del processo: un secchio di
+    gettoni per le richieste e uno per i token (stimati prima della
+    chiamata, poi corretti con l'uso riportato dalla risposta).
+
+    Dopo un 429 tutte le richieste vengono sospese per il Retry-After o, se
+    manca, per un backoff esponenziale (1, 2, 4... fino a BACKOFF_MAX
+    secondi) che si azzera alla prima risposta riuscita.
+    """
+
+    def __init__(self, richieste_al_minuto=None, token_al_minuto=None, backoff_max=BACKOFF_MAX):
+        """
+        Args:
+            richieste_al_minuto: Limite di richieste al minuto (None = nessuno)
+            token_al_minuto: Limite di token (input + output) al minuto (None = nessuno)
+            backoff_max: Sospensione massima in secondi dopo 429 ripetuti
+        """
+        self.richieste_al_minuto = richieste_al_minuto or None
+        self.token_al_minuto = token_al_minuto or None
+        self.backoff_max = backoff_max
+        self._richieste = SecchioGettoni(richieste_al_minuto) if richieste_al_minuto else None
+        self._token = SecchioGettoni(token_al_minuto) if token_al_minuto else None
+        self._lock = threading.Lock()
+        self._sospeso_fino = 0.0
+        self._backoff = 0.0
+        self._in_attesa = 0
+        self.stats = {'partite': 0, 'rifiutate': 0, 'sospensioni': 0, 'attese': 0, 'secondi_attesa': 0.0}
+
+    def _attesa(self, token, adesso):
+        """Secondi prima che una richiesta di `token` token possa partire"""
+        attesa = self._sospeso_fino - adesso
+        if self._richieste is not None:
+            attesa = max(attesa, self._richieste.attesa(1, adesso))
+        if self._token is not None:
+            attesa = max(attesa, self._token.attesa(token, adesso))
+        return attesa
+
+    def attendi(self, token=0, attesa_max=None):
+        """
+        Blocca il chiamante finché la richiesta rientra nei limiti e non c'è
+        una sospensione in corso, poi ne preleva i gettoni.
+
+        Args:
+            token: Token stimati della richiesta (input + output massimo)
+            attesa_max: Secondi massimi di attesa (None = senza limite);
+                        LimiteSuperato se la richiesta non può partire prima
+
+        Returns:
+            Secondi attesi
+        """
+        inizio = time.monotonic()
+        with self._lock:
+            self._in_attesa += 1
+        try:
+            while True:
+                with self._lock:
+                    adesso = time.monotonic()
+                    attesa = self._attesa(token, adesso)
+                    if attesa <= 0:
+                        if self._richieste is not None:
+                            self._richieste.preleva(1, adesso)
+                        if self._token is not None:
+                            self._token.preleva(token, adesso)
+                        atteso = adesso - inizio
+                        self.stats['partite'] += 1
+                        if atteso > 0.001:
+                            self.stats['attese'] += 1
+                            self.stats['secondi_attesa'] += atteso
+                        return atteso
+                    if attesa_max is not None and adesso - inizio + attesa > attesa_max:
+                        self.stats['rifiutate'] += 1
+                        raise LimiteSuperato(
+                            f"Limite di richieste AI raggiunto: riprovare tra {attesa:.0f} secondi", attesa)
+                # Attese brevi: una sospensione arrivata nel frattempo viene vista subito
+                time.sleep(min(attesa, 1.0))
+        finally:
+            with self._lock:
+                self._in_attesa -= 1
+
+    def correggi(self, stimati, effettivi):
+        """Corregge i token prelevati con quelli riportati dalla risposta"""
+        if self._token is not None and effettivi != stimati:
+            with self._lock:
+                self._token.preleva(effettivi - stimati, time.monotonic())
+
+    def sospendi(self, secondi=None):
+        """
+        Nessuna nuova richiesta per `secondi` (Retry-After) o, se None, per
+        il prossimo passo del backoff esponenziale. Ritorna i secondi applicati.
+        """
+        with self._lock:
+            if secondi is None:
+                self._backoff = min(max(1.0, self._backoff * 2), self.backoff_max)
+                secondi = self._backoff
+            self._sospeso_fino = max(self._sospeso_fino, time.monotonic() + secondi)
+            self.stats['sospensioni'] += 1
+            return secondi
+
+    def successo(self):
+        """Una risposta è arrivata: il backoff riparte da capo"""
+        with self._lock:
+            self._backoff = 0.0
+
+    def info(self):
+        """Limiti, gettoni disponibili, sospensione in corso e attese (per /api/status)"""
+        with self._lock:
+            adesso = time.monotonic()
+            info = {
+                'richieste_al_minuto': self.richieste_al_minuto,
+                'token_al_minuto': self.token_al_minuto,
+                'sospeso_secondi': round(max(0.0, self._sospeso_fino - adesso), 1),
+                'in_attesa': self._in_attesa,
+                'partite': self.stats['partite'],
+                'rifiutate': self.stats['rifiutate'],
+                'sospensioni': self.stats['sospensioni'],
+                'attese': self.stats['attese'],
+                'attesa_media_ms': round(self.stats['secondi_attesa'] / self.stats['attese'] * 1000, 1)
+                if self.stats['attese'] else 0.0,
+            }
+            if self._richieste is not None:
+                self._richieste.attesa(0, adesso)
+                info['richieste_disponibili'] = int(self._richieste.gettoni)
+            if self._token is not None:
+                self._token.attesa(0, adesso)
+                info['token_disponibili'] = int(self._token.gettoni)
+            return info
+
+
+class RegistroUso:
+    """
+    Token e costo di ogni chiamata AI (uso riportato dalla risposta, o
+    stimato), per giorno e animale, su SQLite: su file sopravvive ai
+    riavvii ed è condiviso tra processi, ':memory:' vale per il solo
+    processo. Vengono conservati GIORNI_REGISTRO giorni. Thread-safe.
+    """
+
+    def __init__(self, db_path=':memory:', prezzi=PREZZI):
+        """
+        Args:
+            db_path: File SQLite (':memory:' = solo in memoria)
+            prezzi: (USD per milione di token di input, di output)
+        """
+        self.db_path = db_path
+        self.prezzi = prezzi
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        if db_path != ':memory:':
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS chiamate ("
+            " quando REAL NOT NULL, giorno TEXT NOT NULL, nome TEXT NOT NULL, livello TEXT NOT NULL,"
+            " modello TEXT NOT NULL, token_input INTEGER NOT NULL, token_output INTEGER NOT NULL,"
+            " costo REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS chiamate_giorno ON chiamate (giorno, nome)")
+        limite = (date.today() - timedelta(days=GIORNI_REGISTRO)).isoformat()
+        self._db.execute("DELETE FROM chiamate WHERE giorno < ?", (limite,))
+        self._db.commit()
+
+    def costo(self, token_input, token_output):
+        """Costo in USD di una chiamata"""
+        prezzo_input, prezzo_output = self.prezzi
+        return (token_input * prezzo_input + token_output * prezzo_output) / 1_000_000
+
+    def registra(self, nome, livello, modello, token_input, token_output):
+        """Registra una chiamata; ritorna il suo costo"""
+        costo = self.costo(token_input, token_output)
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT INTO chiamate (quando, giorno, nome, livello, modello, token_input, token_output, costo)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (time.time(), date.today().isoformat(), nome, livello, modello, token_input, token_output, costo))
+        return costo
+
+    def totali(self, nome=None, giorno=None):
+        """(token, costo) del giorno (default oggi), di tutti o di un animale"""
+        sql = "SELECT COALESCE(SUM(token_input + token_output), 0), COALESCE(SUM(costo), 0) FROM chiamate WHERE giorno = ?"
+        parametri = [giorno or date.today().isoformat()]
+        if nome is not None:
+            sql += " AND nome = ?"
+            parametri.append(nome)
+        with self._lock:
+            return self._db.execute(sql, parametri).fetchone()
+
+    def riepilogo(self, giorno=None, animali=5):
+        """Chiamate, token e costo del giorno, con gli animali che hanno consumato di più"""
+        giorno = giorno or date.today().isoformat()
+        with self._lock:
+            chiamate, token_input, token_output, costo = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(token_input), 0), COALESCE(SUM(token_output), 0),"
+                " COALESCE(SUM(costo), 0) FROM chiamate WHERE giorno = ?", (giorno,)).fetchone()
+            principali = self._db.execute(
+                "SELECT nome, SUM(token_input + token_output) AS token, SUM(costo) FROM chiamate"
+                " WHERE giorno = ? GROUP BY nome ORDER BY token DESC LIMIT ?", (giorno, animali)).fetchall()
+        return {
+            'giorno': giorno,
+            'chiamate': chiamate,
+            'token_input': token_input,
+            'token_output': token_output,
+            'costo_usd': round(costo, 6),
+            'animali': [{'nome': nome, 'token': token, 'costo_usd': round(costo_animale, 6)}
+                        for nome, token, costo_animale in principali],
+        }
+
+
+class LimitiAI:
+    """
+    Ciò che AnimalHealthDiaryAPI consulta prima e dopo ogni chiamata:
+
+    - prenota(): controlla i budget giornalieri (token e costo totali, token
+      per animale) contando anche le chiamate in corso, poi attende il
+      proprio turno nei limiti al minuto
+    - concludi(): registra l'uso effettivo e corregge i token stimati
+    - annulla(): dopo un errore libera la prenotazione e, per un 429,
+      sospende tutte le richieste; dice se e dopo quanto ritentare
+
+    Thread-safe; un'istanza va condivisa da tutti i worker del processo.
+    """
+
+    def __init__(self, limitatore=None, registro=None, token_giorno=None, costo_giorno=None,
+                 token_animale_giorno=None, attesa_max=None, tentativi=3):
+        """
+        Args:
+            limitatore: Limitatore condiviso (default: senza limiti al minuto)
+            registro: RegistroUso (default: in memoria)
+            token_giorno: Budget giornaliero di token (None = nessuno)
+            costo_giorno: Budget giornaliero in USD (None = nessuno)
+            token_animale_giorno: Budget giornaliero di token per animale (None = nessuno)
+            attesa_max: Secondi massimi di attesa nei limiti al minuto (None = senza limite)
+            tentativi: Tentativi per chiamata sugli errori temporanei
+        """
+        self.limitatore = limitatore or Limitatore()
+        self.registro = registro or RegistroUso()
+        self.token_giorno = token_giorno or None
+        self.costo_giorno = costo_giorno or None
+        self.token_animale_giorno = token_animale_giorno or None
+        self.attesa_max = attesa_max
+        self.tentativi = max(1, tentativi)
+        self._lock = threading.Lock()
+        # Token e costo delle chiamate partite e non ancora concluse
+        self._prenotati = {}
+        self._prenotati_totale = [0, 0.0]
+
+    @classmethod
+    def from_env(cls, default_db=None, attesa_max=None, richieste_al_minuto=None, tentativi=None):
+        """
+        Crea i limiti dalle variabili d'ambiente:
+            AI_RPM                    richieste al minuto (default nessun limite)
+            AI_TPM                    token al minuto (default nessun limite)
+            AI_MAX_WAIT               secondi massimi di attesa nei limiti (default attesa_max)
+            AI_RETRIES                tentativi sugli errori temporanei (default 3)
+            AI_BUDGET_TOKENS          token al giorno (default nessun budget)
+            AI_BUDGET_USD             USD al giorno (default nessun budget)
+            AI_BUDGET_ANIMAL_TOKENS   token al giorno per animale (default nessun budget)
+            AI_USAGE_DB               file SQLite del registro dell'uso (default default_db, '' = in memoria)
+            AI_PRICE_INPUT/OUTPUT     USD per milione di token, come per il triage
+
+        richieste_al_minuto e tentativi, se indicati (opzioni della CLI),
+        prevalgono sulle variabili.
+        """
+        def numero(variabile, tipo):
+            valore = os.getenv(variabile)
+            return tipo(valore) if valore else None
+
+        attesa = os.getenv('AI_MAX_WAIT')
+        return cls(
+            limitatore=Limitatore(richieste_al_minuto or numero('AI_RPM', int), numero('AI_TPM', int)),
+            registro=RegistroUso(
+                os.getenv('AI_USAGE_DB', default_db or '') or ':memory:',
+                prezzi=(float(os.getenv('AI_PRICE_INPUT', str(PREZZI[0]))),
+                        float(os.getenv('AI_PRICE_OUTPUT', str(PREZZI[1]))))),
+            token_giorno=numero('AI_BUDGET_TOKENS', int),
+            costo_giorno=numero('AI_BUDGET_USD', float),
+            token_animale_giorno=numero('AI_BUDGET_ANIMAL_TOKENS', int),
+            attesa_max=float(attesa) if attesa else attesa_max,
+            tentativi=tentativi or int(os.getenv('AI_RETRIES', '3')),
+        )
+
+    @staticmethod
+    def _chiave(nome):
+        return ' '.join(str(nome or '').lower().split())
+
+    def _verifica(self, nome, token, costo):
+        """BudgetEsaurito se la chiamata supera un budget del giorno (chiamare con _lock)"""
+        def supera(usati, richiesta, limite):
+            return limite is not None and (usati >= limite or usati + richiesta > limite)
+
+        if self.token_giorno or self.costo_giorno:
+            token_usati, costo_usato = self.registro.totali()
+            if supera(token_usati + self._prenotati_totale[0], token, self.token_giorno):
+                raise BudgetEsaurito(
+                    f"Budget giornaliero di {self.token_giorno} token AI esaurito", secondi_a_mezzanotte())
+            if supera(costo_usato + self._prenotati_totale[1], costo, self.costo_giorno):
+                raise BudgetEsaurito(
+                    f"Budget giornaliero di {self.costo_giorno} USD per l'AI esaurito", secondi_a_mezzanotte())
+        if self.token_animale_giorno:
+            token_usati, _ = self.registro.totali(nome)
+            prenotati = self._prenotati.get(nome, (0, 0.0))[0]
+            if supera(token_usati + prenotati, token, self.token_animale_giorno):
+                raise BudgetEsaurito(
+                    f"Budget giornaliero di {self.token_animale_giorno} token AI per '{nome}' esaurito",
+                    secondi_a_mezzanotte())
+
+    def stima(self, parametri):
+        """(token di input, token di output massimi) stimati dai parametri di chat.completions.create"""
+        token_input = sum(len(messaggio['content']) for messaggio in parametri['messages']) // CARATTERI_PER_TOKEN
+        return token_input, parametri.get('max_tokens') or 0
+
+    def verifica(self, nome, parametri=None):
+        """
+        BudgetEsaurito se oggi non resta budget per la chiamata con questi
+        parametri (None: per nessuna chiamata), senza prenotarla
+        """
+        token_input, token_output = self.stima(parametri) if parametri is not None else (1, 0)
+        with self._lock:
+            self._verifica(self._chiave(nome), token_input + token_output,
+                           self.registro.costo(token_input, token_output))
+
+    def _aggiorna(self, prenotazione, segno):
+        """Aggiunge (+1) o toglie (-1) una prenotazione dai totali in corso (chiamare con _lock)"""
+        token = (prenotazione.token_input + prenotazione.token_output) * segno
+        costo = prenotazione.costo * segno
+        self._prenotati_totale[0] += token
+        self._prenotati_totale[1] += costo
+        voce = self._prenotati.get(prenotazione.nome, (0, 0.0))
+        voce = (voce[0] + token, voce[1] + costo)
+        if voce[0] > 0:
+            self._prenotati[prenotazione.nome] = voce
+        else:
+            self._prenotati.pop(prenotazione.nome, None)
+
+    def prenota(self, nome, livello, parametri):
+        """
+        Prenota una chiamata con i parametri di chat.completions.create:
+        controlla i budget (BudgetEsaurito) e attende il turno nei limiti
+        al minuto (LimiteSuperato oltre attesa_max).
+
+        Returns:
+            Prenotazione da passare a concludi() o annulla()
+        """
+        token_input, token_output = self.stima(parametri)
+        prenotazione = Prenotazione(self._chiave(nome), livello, parametri['model'], token_input, token_output,
+                                    self.registro.costo(token_input, token_output))
+        with self._lock:
+            self._verifica(prenotazione.nome, token_input + token_output, prenotazione.costo)
+            self._aggiorna(prenotazione, 1)
+        try:
+            self.limitatore.attendi(token_input + token_output, self.attesa_max)
+        except LimiteSuperato:
+            with self._lock:
+                self._aggiorna(prenotazione, -1)
+            raise
+        return prenotazione
+
+    def concludi(self, prenotazione, usage):
+        """Registra l'uso effettivo (usage della risposta) di una chiamata riuscita"""
+        token_input = getattr(usage, 'prompt_tokens', 0) or 0
+        token_output = getattr(usage, 'completion_tokens', 0) or 0
+        with self._lock:
+            self._aggiorna(prenotazione, -1)
+            self.registro.registra(prenotazione.nome, prenotazione.livello, prenotazione.modello,
+                                   token_input, token_output)
+        self.limitatore.correggi(prenotazione.token_input + prenotazione.token_output, token_input + token_output)
+        self.limitatore.successo()
+
+    def annulla(self, prenotazione, errore, tentativo=0):
+        """
+        Libera la prenotazione di una chiamata fallita. Dopo un 429 sospende
+        tutte le richieste per il Retry-After (o il backoff).
+
+        Returns:
+            Secondi da attendere prima di ritentare (0 se l'attesa è già nei
+            limiti condivisi), None se l'errore non è temporaneo
+        """
+        with self._lock:
+            self._aggiorna(prenotazione, -1)
+        if not isinstance(errore, errori_temporanei()):
+            return None
+        # Credito esaurito: ritentare non serve
+        if getattr(errore, 'code', None) == 'insufficient_quota':
+            return None
+        attesa = retry_after(errore)
+        if getattr(errore, 'status_code', None) == 429:
+            self.limitatore.sospendi(attesa)
+            return 0.0
+        return attesa if attesa is not None else min(2 ** tentativo, BACKOFF_MAX)
+
+    def info(self):
+        """Limiti al minuto, budget, chiamate in corso e uso del giorno (per /api/status e la CLI batch)"""
+        with self._lock:
+            in_corso = {'token': self._prenotati_totale[0], 'costo_usd': round(self._prenotati_totale[1], 6)}
+        return {
+            'limiti': self.limitatore.info(),
+            'budget': {
+                'token_giorno': self.token_giorno,
+                'costo_giorno_usd': self.costo_giorno,
+                'token_animale_giorno': self.token_animale_giorno,
+            },
+            'in_corso': in_corso,
+            'oggi': self.registro.riepilogo(),
+        }
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animal Health Diary - Classificazione dei sintomi
+Riconosce sintomi gravi e moderati in un testo libero, senza distinguere maiuscole e accenti
+"""
+
+import bisect
+import unicodedata
+
+SINTOMI_GRAVI = (
+    'vomito', 'diarrea', 'sangue', 'letargia', 'febbre', 'convulsioni',
+    'difficolta respiratorie', 'perdita coscienza', 'collasso',
+)
+SINTOMI_MODERATI = ('tosse', 'starnuti', 'prurito', 'perdita appetito', 'sete eccessiva')
+NESSUN_SINTOMO = 'nessuno'
+
+GRAVITA = {termine: 'grave' for termine in SINTOMI_GRAVI}
+GRAVITA.update({termine: 'moderato' for termine in SINTOMI_MODERATI})
+
+# Tabella precalcolata all'import: (termine, lunghezza, è grave)
+_TERMINI = tuple((termine, len(termine), gravita == 'grave') for termine, gravita in GRAVITA.items())
+
+
+def _tabella_latin1():
+    """Tabella per bytes.translate: ogni carattere Latin-1 in minuscolo e senza accento"""
+    tabella = bytearray(range(256))
+    for codice in range(256):
+        carattere = unicodedata.normalize('NFD', chr(codice).lower()).encode('ascii', 'ignore')
+        if len(carattere) == 1:
+            tabella[codice] = carattere[0]
+    return bytes(tabella)
+
+
+_LATIN1 = _tabella_latin1()
+
+
+def normalizza_testo(testo):
+    """
+    Minuscolo e senza accenti ("Difficoltà" -> "difficolta"); le virgole
+    restano invariate. Il testo Latin-1 (tutte le lettere accentate
+    italiane) passa per una tabella di traduzione in C; solo quello con
+    altri caratteri (es. apostrofi tipografici) richiede NFD.
+    """
+    if testo.isascii():
+        return testo.lower()
+    try:
+        return testo.encode('latin-1').translate(_LATIN1).decode('latin-1')
+    except UnicodeEncodeError:
+        return unicodedata.normalize('NFD', testo.lower()).encode('ascii', 'ignore').decode('ascii')
+
+
+def _virgole(testo):
+    """Posizioni delle virgole, per risalire al sintomo da una posizione nel testo"""
+    posizioni = []
+    posizione = testo.find(',')
+    while posizione >= 0:
+        posizioni.append(posizione)
+        posizione = testo.find(',', posizione + 1)
+    return posizioni
+
+
+def classifica_sintomi(testo):
+    """
+    Classifica i sintomi separati da virgola di un testo libero.
+
+    Ogni termine viene cercato con str.find sull'intero testo normalizzato
+    (ricerca in C che salta i caratteri che non possono iniziare il
+    termine), invece di confrontare ogni sintomo con ogni termine. In
+    CPython è più veloce di un'unica regex con tutti i termini in
+    alternativa, che avanza un carattere alla volta.
+
+    Un sintomo è grave se contiene almeno un termine grave, altrimenti
+    moderato se contiene un termine moderato; gli altri sono ignorati.
+
+    Returns:
+        Dizionario con:
+            gravita: 'grave', 'moderato' o None (la più alta trovata)
+            termini: termini riconosciuti, senza ripetizioni
+            segmenti: lista di (sintomo, gravita, termini) per i sintomi
+                      riconosciuti, nell'ordine del testo e con il testo
+                      originale del sintomo
+            nessuno: True se il testo contiene "nessuno"
+    """
+    testo = testo or ''
+    normalizzato = normalizza_testo(testo)
+
+    trovati = {}
+    gravi = set()
+    virgole = None
+    for termine, lunghezza, grave in _TERMINI:
+        if termine not in normalizzato:
+            continue
+        posizione = normalizzato.find(termine)
+        if virgole is None:
+            virgole = _virgole(normalizzato)
+        while posizione >= 0:
+            indice = bisect.bisect(virgole, posizione)
+            termini_segmento = trovati.setdefault(indice, [])
+            if termine not in termini_segmento:
+                termini_segmento.append(termine)
+            if grave:
+                gravi.add(indice)
+            posizione = normalizzato.find(termine, posizione + lunghezza)
+
+    segmenti = []
+    termini = {}
+    if trovati:
+        parti = testo.split(',')
+        for indice in sorted(trovati):
+            gravita = 'grave' if indice in gravi else 'moderato'
+            segmenti.append((parti[indice].strip(), gravita, trovati[indice]))
+            termini.update(dict.fromkeys(trovati[indice]))
+
+    return {
+        'gravita': 'grave' if gravi else 'moderato' if segmenti else None,
+        'termini': list(termini),
+        'segmenti': segmenti,
+        'nessuno': NESSUN_SINTOMO in normalizzato,
+    }
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+"""
+Test configuration for Animal Health Diary
+Moduli della radice e della webapp importabili come negli script (python webapp/app.py)
+"""
+import os
+import sys
+import importlib
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for path in (ROOT, os.path.join(ROOT, 'webapp')):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+
+@pytest.fixture(scope='session')
+def webapp(tmp_path_factory):
+    """Modulo app della webapp con dati in una directory temporanea e client finto"""
+    with pytest.MonkeyPatch.context() as env:
+        env.setenv('DATA_DIR', str(tmp_path_factory.mktemp('data')))
+        env.setenv('FAKE_OPENAI', '1')
+        for name in ('AI_RPM', 'AI_TPM', 'AI_BUDGET_TOKENS', 'AI_BUDGET_USD', 'AI_BUDGET_ANIMAL_TOKENS',
+                     'AI_USAGE_DB', 'AI_CACHE_DB', 'TRIAGE_POLICY', 'SEARCH_DB', 'PHOTO_MAX_MB'):
+            env.delenv(name, raising=False)
+        return importlib.import_module('app')
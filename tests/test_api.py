@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for animal_diary_api
+Uso dei token registrato nei limiti: quello riportato dall'API, anche in streaming
+"""
+from animal_diary_api import AnimalHealthDiaryAPI
+from fake_openai import FakeOpenAI
+from rate_limits import LimitiAI
+
+DATI = {
+    'nome': 'Rex', 'specie': 'cane', 'peso': 10.0, 'eta': 3, 'alimentazione': 'crocchette',
+    'attivita': 'Normale', 'sintomi': 'tosse', 'note': '', 'data': '2024-01-01 10:00',
+}
+
+
+def token_attesi(api, client):
+    messaggi = api.parametri_richiesta(DATI, api.valuta(DATI))['messages']
+    return sum(len(m['content'].split()) for m in messaggi), len(client.reply.split())
+
+
+def test_uso_riportato_in_streaming():
+    client = FakeOpenAI(latency=0)
+    api = AnimalHealthDiaryAPI(client=client, limiti=LimitiAI())
+    assert ''.join(api.richiesta_ai_stream(DATI, usa_cache=False)) == client.reply
+
+    oggi = api.limiti.registro.riepilogo()
+    assert oggi['chiamate'] == 1
+    assert (oggi['token_input'], oggi['token_output']) == token_attesi(api, client)
+
+
+def test_uso_riportato_senza_streaming():
+    client = FakeOpenAI(latency=0)
+    api = AnimalHealthDiaryAPI(client=client, limiti=LimitiAI())
+    assert api.richiesta_ai(DATI, usa_cache=False) == client.reply
+
+    oggi = api.limiti.registro.riepilogo()
+    assert (oggi['token_input'], oggi['token_output']) == token_attesi(api, client)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for animal_diary_batch
+Una riga JSONL illeggibile risulta non valida senza fermare il resto del batch
+"""
+import json
+
+from animal_diary_api import AnimalHealthDiaryAPI
+from animal_diary_batch import analizza_batch, leggi_record
+from fake_openai import FakeOpenAI
+from rate_limits import LimitiAI
+
+
+def test_riga_jsonl_non_valida(tmp_path):
+    path = tmp_path / 'animali.jsonl'
+    rex = {'id': 'rex', 'nome': 'Rex', 'specie': 'cane', 'peso': 10, 'sintomi': 'tosse'}
+    fido = {'id': 'fido', 'dati': {'nome': 'Fido', 'specie': 'cane', 'sintomi': 'nessuno'}}
+    path.write_text('\n'.join([json.dumps(rex), '{"id": "troncato", "nome', '', '[1, 2]', json.dumps(fido)]) + '\n',
+                    encoding='utf-8')
+
+    api = AnimalHealthDiaryAPI(client=FakeOpenAI(latency=0), limiti=LimitiAI())
+    risultati = {r['id']: r for r in analizza_batch(api, leggi_record(str(path)), workers=2)}
+
+    assert set(risultati) == {'rex', 'riga-2', 'riga-3', 'fido'}
+    assert risultati['rex']['status'] == risultati['fido']['status'] == 'ok'
+    assert risultati['riga-2']['status'] == 'invalid'
+    assert risultati['riga-2']['error'].startswith("JSON non valido")
+    assert risultati['riga-3']['status'] == 'invalid'
+    # I risultati restano serializzabili nel file JSONL di output
+    json.dumps(list(risultati.values()))
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for webapp/ids.py
+dedupe_ids con timestamp mancanti, nulli o non validi
+"""
+from ids import dedupe_ids
+
+
+def test_dedupe_con_timestamp_non_validi():
+    entries = [{'id': '1', 'timestamp': '2024-01-01T10:00:00'}, {'id': '1', 'timestamp': None},
+               {'id': '1', 'timestamp': 'ieri'}, {'id': '1', 'timestamp': 20240101}, {'id': '1'}]
+
+    assert dedupe_ids(entries) == 4
+    assert len({e['id'] for e in entries}) == 5
+    assert entries[0]['id'] == '1'
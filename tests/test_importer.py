@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for webapp/importer.py
+Id ripetuti nello stesso file riportati come duplicati; riferimenti alle foto mantenuti dagli export
+"""
+import io
+import json
+
+from importer import import_rows, read_rows
+from storage import HistoryStore
+
+
+def record(entry_id, **extra):
+    return dict({'id': entry_id, 'nome': 'Rex', 'specie': 'cane', 'peso': 10.0, 'sintomi': 'nessuno',
+                 'timestamp': '2024-01-01T10:00:00', 'analisi_ai': f"Analisi {entry_id}"}, **extra)
+
+
+def jsonl(*records):
+    return io.StringIO(''.join(json.dumps(r) + '\n' for r in records))
+
+
+def test_id_duplicati_nel_file(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.jsonl'))
+    rows = read_rows(jsonl(record('1'), record('2'), record('1', peso=20.0), record('3')), 'jsonl')
+    result = import_rows(store, rows, batch_size=2)
+
+    assert result['imported'] == 3
+    assert result['duplicates'] == 1
+    assert result['skipped'] == 0
+    assert result['errors'] == [{'row': 3, 'error': "Id duplicato nel file: 1"}]
+    # Vale la prima riga
+    assert store.get('1')['dati']['peso'] == 10.0
+    assert store.count() == 3
+
+
+def test_reimport_di_un_export_con_foto(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.jsonl'))
+    esportata = {'id': '1', 'dati': {'nome': 'Rex', 'specie': 'cane', 'peso': 10.0, 'sintomi': 'nessuno'},
+                 'analisi_ai': "Analisi 1", 'timestamp': '2024-01-01T10:00:00', 'foto': ['a1b2.png']}
+    rows = read_rows(jsonl(esportata, record('2', foto=['c3d4.jpg']), record('3'), record('4', foto='../x')), 'jsonl')
+    result = import_rows(store, rows)
+
+    assert result['imported'] == 3
+    assert result['invalid'] == 1
+    assert store.get('1')['foto'] == ['a1b2.png']
+    assert store.get('2')['foto'] == ['c3d4.jpg']
+    assert 'foto' not in store.get('3')
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for webapp/jobs.py
+run_analysis della webapp eseguita dalla JobQueue con il client finto: completata, da cache,
+locale, in errore, scaduta; coda piena e job scaduti in coda
+"""
+import time
+import threading
+
+import pytest
+
+from fake_openai import FakeOpenAI
+from ids import new_id
+from jobs import JobQueue, QueueFullError
+
+
+class FailingOpenAI(FakeOpenAI):
+    """Client che non raggiunge mai il servizio"""
+
+    def _create(self, model, messages, **kwargs):
+        raise ConnectionError("Servizio non raggiungibile")
+
+
+@pytest.fixture
+def client(webapp, monkeypatch):
+    """Client usato da create_api(): veloce salvo diversa indicazione del test"""
+    def use(client):
+        monkeypatch.setattr(webapp, 'FakeOpenAI', lambda: client)
+        return client
+    use(FakeOpenAI(latency=0.05))
+    return use
+
+
+def dati(sintomi='tosse, letargia'):
+    """Dati dal form di /analyze; nome unico, così la cache non lega i test tra loro"""
+    return {
+        'nome': f"Rex {new_id()}", 'specie': 'cane', 'peso': 10.0, 'eta': 3, 'alimentazione': 'crocchette',
+        'attivita': 'Normale', 'sintomi': sintomi, 'note': '', 'data': '2024-01-01 10:00',
+    }
+
+
+def esegui(webapp, dati, timeout=5, usa_cache=True):
+    """run_analysis in una JobQueue come fa /analyze; ritorna (job, frammenti pubblicati)"""
+    jobs = JobQueue(max_workers=1, max_queue=1, timeout=timeout)
+    job_id = jobs.submit(webapp.run_analysis, dati, usa_cache, streaming=True, cancellable=True)
+    frammenti = [f for f in jobs.stream(job_id, keepalive=1) if f is not None]
+    return jobs.get(job_id), frammenti
+
+
+def chiamate(webapp):
+    return webapp.ai_limits.registro.riepilogo()['chiamate']
+
+
+def test_analisi_completata_e_salvata(webapp, client):
+    fake = client(FakeOpenAI(latency=0.05))
+    prima = chiamate(webapp)
+    job, frammenti = esegui(webapp, dati())
+
+    assert job['status'] == 'done'
+    assert job['error'] is None
+    assert job['result']['analisi'] == fake.reply
+    assert job['result']['livello'] == 'completa'
+    assert ''.join(frammenti) == fake.reply
+    entry = webapp.history_store.get(job['result']['entry_id'])
+    assert entry['analisi_ai'] == fake.reply
+    # Chiamata prenotata e conclusa nei limiti condivisi
+    assert chiamate(webapp) == prima + 1
+
+
+def test_risposta_dalla_cache(webapp, client):
+    fake = client(FakeOpenAI(latency=0))
+    richiesta = dati()
+    primo, _ = esegui(webapp, richiesta)
+    client(FailingOpenAI(latency=0))
+    prima = chiamate(webapp)
+    secondo, _ = esegui(webapp, dict(richiesta))
+
+    assert secondo['status'] == 'done'
+    assert secondo['result']['analisi'] == primo['result']['analisi'] == fake.reply
+    assert secondo['result']['entry_id'] != primo['result']['entry_id']
+    assert chiamate(webapp) == prima
+
+    # Senza cache la chiamata fallisce
+    terzo, _ = esegui(webapp, dict(richiesta), usa_cache=False)
+    assert terzo['status'] == 'error'
+
+
+def test_risposta_locale_del_triage(webapp, client):
+    client(FailingOpenAI(latency=0))
+    job, _ = esegui(webapp, dati('nessuno'))
+
+    assert job['status'] == 'done'
+    assert job['result']['livello'] == 'locale'
+    assert webapp.history_store.get(job['result']['entry_id'])['analisi_ai'] == job['result']['analisi']
+
+
+def test_errore_non_salvato(webapp, client):
+    client(FailingOpenAI(latency=0))
+    prima = webapp.history_store.count()
+    job, _ = esegui(webapp, dati('vomito con sangue'))
+
+    assert job['status'] == 'error'
+    assert "Errore nella chiamata API" in job['error']
+    assert "Servizio non raggiungibile" in job['error']
+    assert job['result'] is None
+    assert webapp.history_store.count() == prima
+
+
+def test_timeout_non_salvato(webapp, client):
+    client(FakeOpenAI(latency=3))
+    prima = webapp.history_store.count()
+    inizio = time.monotonic()
+    job, frammenti = esegui(webapp, dati(), timeout=0.3)
+
+    assert job['status'] == 'timeout'
+    assert job['result'] is None
+    # Interrotto dal controllo cooperativo, non alla fine della risposta
+    assert time.monotonic() - inizio < 2
+    assert ''.join(frammenti) != FakeOpenAI().reply
+    assert webapp.history_store.count() == prima
+
+
+def test_job_scaduto_in_coda():
+    rilascia = threading.Event()
+    jobs = JobQueue(max_workers=1, max_queue=1, timeout=0.1)
+    occupato = jobs.submit(rilascia.wait, 5)
+    chiamato = []
+    in_coda = jobs.submit(chiamato.append, 'eseguito')
+    time.sleep(0.2)
+    rilascia.set()
+
+    assert jobs.wait(occupato, 5) and jobs.wait(in_coda, 5)
+    job = jobs.get(in_coda)
+    assert job['status'] == 'timeout'
+    assert job['started'] is None
+    assert chiamato == []
+    assert jobs.get('sconosciuto') is None
+
+
+def test_coda_piena():
+    rilascia = threading.Event()
+    jobs = JobQueue(max_workers=1, max_queue=1, timeout=5)
+    primo = jobs.submit(rilascia.wait, 5)
+    secondo = jobs.submit(rilascia.wait, 5)
+    with pytest.raises(QueueFullError):
+        jobs.submit(rilascia.wait, 5)
+    assert jobs.stats()['queued'] + jobs.stats()['running'] == 2
+
+    rilascia.set()
+    assert jobs.wait(primo, 5) and jobs.wait(secondo, 5)
+    # I posti liberati tornano disponibili
+    terzo = jobs.submit(lambda: 'ok')
+    assert jobs.wait(terzo, 5)
+    assert jobs.get(terzo)['status'] == 'done'
+    assert jobs.get(terzo)['result'] == 'ok'
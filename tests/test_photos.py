@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for photo uploads (webapp/app.py upload_photo)
+Limite PHOTO_MAX_BYTES applicato mentre il corpo viene letto, anche senza Content-Length
+"""
+import io
+import os
+
+import pytest
+
+from ids import new_id
+
+PNG = b'\x89PNG\r\n\x1a\n'
+LIMITE = 1024 * 1024
+
+
+class CountingStream(io.BytesIO):
+    """Corpo della richiesta che conta i byte letti dal server"""
+
+    def __init__(self, data):
+        super().__init__(data)
+        self.letti = 0
+
+    def read(self, size=-1):
+        chunk = super().read(size)
+        self.letti += len(chunk)
+        return chunk
+
+    def readline(self, size=-1):
+        line = super().readline(size)
+        self.letti += len(line)
+        return line
+
+
+@pytest.fixture
+def entry_id(webapp, monkeypatch):
+    monkeypatch.setitem(webapp.app.config, 'PHOTO_MAX_BYTES', LIMITE)
+    entry_id = new_id()
+    webapp.history_store.append({'id': entry_id, 'dati': {'nome': 'Rex'}, 'timestamp': '2024-01-01T10:00:00'})
+    return entry_id
+
+
+def multipart(data, boundary='confine'):
+    return (f'--{boundary}\r\nContent-Disposition: form-data; name="photo"; filename="foto.png"\r\n'
+            f'Content-Type: image/png\r\n\r\n').encode() + data + f'\r\n--{boundary}--\r\n'.encode()
+
+
+def chunked_post(webapp, entry_id, body, content_type):
+    """POST senza Content-Length (Transfer-Encoding: chunked)"""
+    stream = CountingStream(body)
+    response = webapp.app.test_client().post(
+        f'/entry/{entry_id}/photos', input_stream=stream,
+        headers={'Transfer-Encoding': 'chunked', 'Content-Type': content_type},
+        environ_overrides={'wsgi.input_terminated': True})
+    return response, stream
+
+
+def part_files(webapp):
+    return [name for _, _, files in os.walk(webapp.PhotoManager.PHOTOS_DIR) for name in files
+            if name.endswith('.part')]
+
+
+def test_multipart_chunked_oltre_il_limite(webapp, entry_id):
+    body = multipart(PNG + b'\0' * (5 * LIMITE))
+    response, stream = chunked_post(webapp, entry_id, body, 'multipart/form-data; boundary=confine')
+
+    assert response.status_code == 413
+    assert response.get_json()['error'] is True
+    # Lettura interrotta al limite, non dopo aver ricevuto tutto il corpo
+    assert stream.letti < 2 * LIMITE
+    assert part_files(webapp) == []
+
+
+def test_corpo_chunked_oltre_il_limite(webapp, entry_id):
+    response, stream = chunked_post(webapp, entry_id, PNG + b'\0' * (5 * LIMITE), 'image/png')
+
+    assert response.status_code == 413
+    assert stream.letti < 2 * LIMITE
+    assert part_files(webapp) == []
+
+
+def test_content_length_oltre_il_limite(webapp, entry_id):
+    response = webapp.app.test_client().post(
+        f'/entry/{entry_id}/photos', data=PNG + b'\0' * (2 * LIMITE), headers={'Content-Type': 'image/png'})
+
+    assert response.status_code == 413
+
+
+def test_foto_entro_il_limite(webapp, entry_id):
+    body = multipart(PNG + os.urandom(4096))
+    response, _ = chunked_post(webapp, entry_id, body, 'multipart/form-data; boundary=confine')
+
+    assert response.status_code == 201
+    filename = response.get_json()['filename']
+    assert webapp.history_store.get(entry_id)['foto'] == [filename]
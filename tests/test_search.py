@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for webapp/search_index.py
+Nome dell'animale nei risultati come scritto dall'utente; indice di una versione precedente ricostruito
+"""
+import sqlite3
+
+from search_index import SearchIndex
+from storage import HistoryStore
+
+
+def entry(entry_id, nome):
+    return {
+        'id': entry_id,
+        'dati': {'nome': nome, 'specie': 'Cane', 'peso': 10.0, 'sintomi': 'tosse secca'},
+        'analisi_ai': "Analisi",
+        'timestamp': '2024-01-01T10:00:00',
+    }
+
+
+def test_nome_originale_nei_risultati(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.jsonl'))
+    store.append_many([entry('1', 'Rex'), entry('2', 'Fido')])
+    index = SearchIndex(store, str(tmp_path / 'search.sqlite3'))
+
+    results, has_more = index.search('tosse', nome='rex')
+    assert [(r['id'], r['nome'], r['specie']) for r in results] == [('1', 'Rex', 'cane')]
+    assert not has_more
+    assert {r['nome'] for r in index.search('tosse', nome='FIDO ')[0]} == {'Fido'}
+
+
+def test_indice_senza_etichetta_ricostruito(tmp_path):
+    db_path = str(tmp_path / 'search.sqlite3')
+    with sqlite3.connect(db_path) as db:
+        db.execute("CREATE TABLE documenti (rowid INTEGER PRIMARY KEY, entry_id TEXT UNIQUE NOT NULL,"
+                   " impronta INTEGER NOT NULL, nome TEXT NOT NULL, specie TEXT NOT NULL, timestamp TEXT NOT NULL)")
+        db.execute("INSERT INTO documenti VALUES (1, '1', 0, 'rex', 'cane', '')")
+    db.close()
+    store = HistoryStore(str(tmp_path / 'history.jsonl'))
+    store.append(entry('1', 'Rex'))
+
+    index = SearchIndex(store, db_path)
+    assert [r['nome'] for r in index.search('tosse')[0]] == ['Rex']
+    assert index.info() == {'indexed': 1, 'pending': 0}
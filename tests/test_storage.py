@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for webapp/storage.py
+HistoryStore: append, sostituzione, cancellazione, compattazione, riapertura e ricostruzione dell'indice
+"""
+import os
+
+import pytest
+
+from storage import HistoryStore, text_digest
+
+
+def entry(entry_id, peso=10.0, nome='Rex', analisi=None):
+    return {
+        'id': entry_id,
+        'dati': {'nome': nome, 'specie': 'cane', 'peso': peso, 'sintomi': 'nessuno'},
+        'analisi_ai': analisi or f"Analisi {entry_id}",
+        'timestamp': f"2024-01-01T10:00:{int(entry_id) % 60:02d}",
+    }
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / 'history.jsonl')
+
+
+def open_store(path, **kwargs):
+    """Store nuovo sullo stesso file, come un altro processo o un riavvio"""
+    kwargs.setdefault('compact_min_records', 10 ** 6)  # Nessuna compattazione automatica
+    return HistoryStore(path, **kwargs)
+
+
+def ids(store):
+    return [e['id'] for e in store.load()]
+
+
+def test_append_e_riapertura(path):
+    store = open_store(path)
+    for i in range(5):
+        store.append(entry(str(i)))
+    store.append_many([entry(str(i)) for i in range(5, 8)])
+
+    assert ids(store) == [str(i) for i in reversed(range(8))]
+    assert store.count() == 8
+    assert store.get('3')['analisi_ai'] == "Analisi 3"
+    assert store.get('assente') is None
+    assert [e['id'] for e in store.get_many(['7', 'assente', '1'])] == ['7', '1']
+
+    riaperto = open_store(path)
+    assert ids(riaperto) == ids(store)
+    assert riaperto.get('6') == store.get('6')
+
+
+def test_sostituzione_stesso_id(path):
+    store = open_store(path)
+    store.append(entry('1', peso=10.0))
+    store.append(entry('2'))
+    digest = store._meta['1']['h']
+    nuova = entry('1', peso=12.5, analisi="Analisi rivista")
+    store.append(nuova)
+
+    assert store.count() == 2
+    assert store.get('1')['dati']['peso'] == 12.5
+    # L'impronta del testo (ricerca) segue l'analisi AI sostituita, anche dall'indice su disco
+    assert store._meta['1']['h'] == text_digest(nuova) != digest
+    riaperto = open_store(path)
+    assert riaperto.get('1')['analisi_ai'] == "Analisi rivista"
+    assert riaperto._meta['1']['h'] == text_digest(nuova)
+
+
+def test_cancellazione(path):
+    store = open_store(path)
+    for i in range(3):
+        store.append(entry(str(i)))
+
+    assert store.delete('1') is True
+    assert store.delete('1') is False
+    assert store.delete('assente') is False
+    assert ids(store) == ['2', '0']
+    assert ids(open_store(path)) == ['2', '0']
+
+
+def test_scritture_di_un_altro_processo(path):
+    store = open_store(path)
+    store.append(entry('1'))
+    altro = open_store(path)
+    altro.append(entry('2'))
+    altro.delete('1')
+
+    assert ids(store) == ['2']
+
+
+def test_compattazione(path):
+    store = open_store(path)
+    for i in range(20):
+        store.append(entry(str(i)))
+    for i in range(15):
+        store.delete(str(i))
+    size = os.path.getsize(path)
+
+    soglia = open_store(path, compact_min_records=10)
+    assert soglia.needs_compaction()
+    assert soglia.compact_if_needed() is True
+
+    assert os.path.getsize(path) < size
+    assert ids(soglia) == [str(i) for i in reversed(range(15, 20))]
+    assert not soglia.needs_compaction()
+    # Lo store aperto prima vede il file sostituito
+    assert ids(store) == ids(soglia)
+    assert ids(open_store(path)) == ids(soglia)
+
+
+def test_compattazione_automatica(path):
+    store = HistoryStore(path, compact_min_records=10)
+    for i in range(12):
+        store.append(entry(str(i)))
+    for i in range(11):
+        store.delete(str(i))
+    if store._compactor is not None:
+        store._compactor.join(5)
+
+    assert ids(store) == ['11']
+    assert ids(open_store(path)) == ['11']
+
+
+def test_indice_ricostruito_dopo_un_crash(path, monkeypatch):
+    store = open_store(path)
+    for i in range(20):
+        store.append(entry(str(i)))
+    store.append(entry('3', peso=20.0))
+    for i in range(12):
+        if i != 3:
+            store.delete(str(i))
+    atteso = store.load()
+
+    # Indice perso (crash prima della scrittura): tutto si rilegge dal log
+    os.remove(path + '.idx')
+    riaperto = open_store(path)
+    assert riaperto.load() == atteso
+    # La prima scrittura ricostruisce l'indice
+    riaperto.append(entry('30'))
+    atteso = riaperto.load()
+
+    scanned = []
+    scan_log = HistoryStore._scan_log
+
+    def spy(self, st):
+        scanned.append(st.st_size - self._log_end)
+        return scan_log(self, st)
+
+    monkeypatch.setattr(HistoryStore, '_scan_log', spy)
+    nuovo = open_store(path, compact_min_records=10)
+    assert nuovo.load() == atteso
+    # L'indice ricostruito copre anche i record morti: nessun byte riletto dal log
+    assert scanned == [0]
+    # ...e ne conserva il numero, così la compattazione scatta ancora
+    assert nuovo.needs_compaction()
+
+
+def test_scrittura_interrotta(path):
+    store = open_store(path)
+    store.append(entry('1'))
+    with open(path, 'ab') as f:
+        f.write(b'{"op": "add", "entry": {"id": "2", "da')
+
+    riaperto = open_store(path)
+    assert ids(riaperto) == ['1']
+    # La riga incompleta viene scartata dalla scrittura successiva
+    riaperto.append(entry('3'))
+    assert ids(open_store(path)) == ['3', '1']
+
+
+def test_indice_non_allineato(path):
+    store = open_store(path)
+    for i in range(3):
+        store.append(entry(str(i)))
+    # Indice troncato a metà di una riga
+    with open(path + '.idx', 'r+b') as f:
+        f.truncate(os.path.getsize(path + '.idx') - 5)
+
+    assert ids(open_store(path)) == ['2', '1', '0']
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for animal_diary_vector
+analisi_ia_vettoriale deve dare lo stesso risultato di AnimalHealthDiary.analisi_ia riga per riga
+"""
+import json
+import random
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from animal_diary import AnimalHealthDiary
+from animal_diary_vector import analisi_ia_vettoriale, colonne_da_record
+from health_rules import RuleTable
+
+SPECIE = ('cane', 'Cane', 'gatto', 'GATTO', 'coniglio', '')
+ALIMENTAZIONE = ('crocchette', 'umido', 'mista', 'casalinga', 'Casalinga', '')
+SINTOMI = (
+    'nessuno', 'Nessuno', '', 'tosse', 'vomito, diarrea', 'Vomito con sangue',
+    'starnuti e prurito', 'perdita appetito, sete eccessiva', 'difficoltà respiratorie',
+    'zoppia', 'letargia, tosse, febbre',
+)
+# Valori ai limiti delle regole (sotto 5/3, sopra 30/6, età sotto 1 e sopra 10)
+PESI = (0.5, 2.9, 3, 3.1, 4.99, 5, 5.01, 6, 6.5, 29.9, 30, 30.1, 45)
+ETA = (0, 1, 2, 10, 11, 15)
+
+
+# Celle come arrivano da CSV o JSON non validati: testo, None, tipi scambiati
+PESI_SPORCHI = PESI + ('4', '12', '', None, 'n/d', True)
+ETA_SPORCHE = ETA + ('12', '0', None, 11.5)
+ALIMENTAZIONE_SPORCA = ALIMENTAZIONE + (None, 5)
+SPECIE_SPORCHE = SPECIE + (None,)
+
+
+def genera_record(n, razze=(), seed=0, sporchi=False):
+    """
+    Record casuali ma riproducibili, con valori ai limiti delle regole;
+    con sporchi=True anche celle non numeriche e campi assenti
+    """
+    rng = random.Random(seed)
+    records = []
+    for _ in range(n):
+        dati = {
+            'peso': rng.choice(PESI_SPORCHI if sporchi else PESI),
+            'eta': rng.choice(ETA_SPORCHE if sporchi else ETA),
+            'specie': rng.choice(SPECIE_SPORCHE if sporchi else SPECIE),
+            'alimentazione': rng.choice(ALIMENTAZIONE_SPORCA if sporchi else ALIMENTAZIONE),
+            'sintomi': rng.choice(SINTOMI),
+        }
+        if sporchi:
+            for campo in ('peso', 'eta', 'specie', 'alimentazione'):
+                if rng.random() < 0.1:
+                    del dati[campo]
+        if razze:
+            dati['razza'] = rng.choice(razze)
+        records.append(dati)
+    return records
+
+
+def confronta(records, regole=None, colonne=None):
+    diario = AnimalHealthDiary(regole)
+    attesi = [diario.analisi_ia(dict(dati)) for dati in records]
+    ottenuti = analisi_ia_vettoriale(colonne or colonne_da_record(records), diario.regole)
+    assert len(ottenuti) == len(attesi)
+    for dati, atteso, ottenuto in zip(records, attesi, ottenuti):
+        assert (list(ottenuto[0]), list(ottenuto[1])) == (list(atteso[0]), list(atteso[1])), dati
+
+
+def test_equivalenza_tabella_predefinita():
+    confronta(genera_record(2000))
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_equivalenza_pochi_record(seed):
+    confronta(genera_record(7, seed=seed))
+
+
+def test_equivalenza_con_razze(tmp_path):
+    tabella = {
+        'specie': {
+            'cane': {
+                'regole': [{'se': {'peso': {'sopra': 30}}, 'consigli': ['Taglia grande']}],
+                'razze': {
+                    'bassotto': {'regole': [{'se': {'peso': {'sopra': 9}}, 'avvisi': ['Bassotto sovrappeso']}]},
+                    'alano': {'sostituisce': True,
+                              'regole': [{'se': {'peso': {'sotto': 45}}, 'avvisi': ['Alano sottopeso']}]},
+                },
+            },
+        },
+        'comuni': [
+            {'se': {'eta': {'sopra': 10}, 'alimentazione': {'uguale': 'casalinga'}}, 'consigli': ['Senior casalinga']},
+        ],
+    }
+    path = tmp_path / 'regole.json'
+    path.write_text(json.dumps(tabella), encoding='utf-8')
+    confronta(genera_record(1000, razze=('', 'Bassotto', 'alano', 'meticcio')), RuleTable(str(path)))
+
+
+def test_valori_testuali_da_csv():
+    # peso ed età come testo non attivano le regole numeriche, come nella valutazione scalare
+    records = [{'peso': '4', 'eta': '12', 'specie': 'Cane', 'alimentazione': 'casalinga', 'sintomi': 'nessuno'}]
+    confronta(records)
+    consigli, _ = analisi_ia_vettoriale(colonne_da_record(records))[0]
+    assert not any('taglia piccola' in c or 'anziano' in c for c in consigli)
+
+
+def test_equivalenza_con_celle_non_valide():
+    confronta(genera_record(3000, sporchi=True, seed=1))
+
+
+def test_equivalenza_con_razze_e_celle_non_valide(tmp_path):
+    tabella = {
+        'specie': {'cane': {'regole': [], 'razze': {
+            'alano': {'regole': [{'se': {'peso': {'sotto': 45}, 'alimentazione': {'uguale': 'umido'}},
+                                  'avvisi': ['Alano sottopeso']}]},
+        }}},
+        'comuni': [{'se': {'eta': {'uguale': 12}}, 'consigli': ['Dodici anni']},
+                   {'se': {'alimentazione': {'sopra': 'c'}}, 'consigli': ['Dopo la c']}],
+    }
+    path = tmp_path / 'regole.json'
+    path.write_text(json.dumps(tabella), encoding='utf-8')
+    confronta(genera_record(1000, razze=('', 'Alano'), sporchi=True, seed=2), RuleTable(str(path)))
+
+
+def test_colonna_assente():
+    records = [{'peso': peso, 'specie': 'cane', 'sintomi': 'tosse'} for peso in PESI]
+    colonne = {'peso': [r['peso'] for r in records], 'specie': ['cane'] * len(records),
+               'sintomi': [r['sintomi'] for r in records]}
+    confronta(records, colonne=colonne)
+
+
+def test_colonne_numpy_tipizzate():
+    records = genera_record(500, seed=3)
+    colonne = {campo: np.asarray([r[campo] for r in records]) for campo in records[0]}
+    confronta(records, colonne=colonne)
+
+
+def test_nessun_record():
+    assert analisi_ia_vettoriale(colonne_da_record([])) == []
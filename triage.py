@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Animal Health Diary - Triage delle analisi
+Regole locali prima dell'AI: risposta locale, prompt breve o analisi completa secondo la gravità
+"""
+
+import os
+import threading
+from collections import namedtuple
+
+from animal_diary import AnimalHealthDiary
+from symptom_matcher import classifica_sintomi
+
+# Livelli di analisi, dal più economico
+LIVELLI = ('locale', 'breve', 'completa')
+
+# Casi riconosciuti dalle regole locali, dal meno al più preoccupante:
+#   nessuno            nessun sintomo e nessun avviso dalle regole
+#   avvisi             nessun sintomo, ma avvisi su peso/età/alimentazione
+#   non_riconosciuti   sintomi o note con termini non presenti nel dizionario
+#   moderato, grave    sintomi riconosciuti (anche nelle note) di quella gravità
+CASI = ('nessuno', 'avvisi', 'non_riconosciuti', 'moderato', 'grave')
+
+POLITICA_PREDEFINITA = {
+    'nessuno': 'locale',
+    'avvisi': 'breve',
+    'non_riconosciuti': 'breve',
+    'moderato': 'completa',
+    'grave': 'completa',
+}
+
+# Token massimi della risposta per i livelli che chiamano l'AI
+MAX_TOKENS = {'breve': 250, 'completa': 800}
+
+# Prezzi in USD per milione di token (gpt-4o-mini: input, output)
+PREZZI = (0.15, 0.60)
+
+Valutazione = namedtuple('Valutazione', 'caso livello consigli avvisi')
+
+
+def leggi_politica(testo):
+    """
+    Politica di instradamento da testo "caso=livello,caso=livello" (i casi
+    non indicati restano quelli predefiniti); "off" manda tutto all'analisi
+    completa. ValueError se un caso o un livello non esiste.
+    """
+    testo = (testo or '').strip()
+    if testo.lower() == 'off':
+        return dict.fromkeys(CASI, 'completa')
+    politica = dict(POLITICA_PREDEFINITA)
+    for voce in filter(None, (parte.strip() for parte in testo.split(','))):
+        caso, _, livello = voce.partition('=')
+        caso, livello = caso.strip(), livello.strip()
+        if caso not in CASI:
+            raise ValueError(f"Caso di triage sconosciuto '{caso}' (usa {', '.join(CASI)})")
+        if livello not in LIVELLI:
+            raise ValueError(f"Livello di analisi sconosciuto '{livello}' (usa {', '.join(LIVELLI)})")
+        politica[caso] = livello
+    return politica
+
+
+class StatisticheLivelli:
+    """Richieste, latenza, token e costo stimato per livello di analisi. Thread-safe."""
+
+    def __init__(self, prezzi=PREZZI):
+        self.prezzi = prezzi
+        self._lock = threading.Lock()
+        self._livelli = {livello: {'richieste': 0, 'da_cache': 0, 'secondi': 0.0, 'secondi_max': 0.0,
+                                   'token_input': 0, 'token_output': 0} for livello in LIVELLI}
+        self._casi = dict.fromkeys(CASI, 0)
+
+    def registra(self, caso, livello, secondi, token_input=0, token_output=0, da_cache=False):
+        """Registra una richiesta servita al livello indicato"""
+        with self._lock:
+            voce = self._livelli[livello]
+            voce['richieste'] += 1
+            voce['da_cache'] += int(da_cache)
+            voce['secondi'] += secondi
+            voce['secondi_max'] = max(voce['secondi_max'], secondi)
+            voce['token_input'] += token_input
+            voce['token_output'] += token_output
+            self._casi[caso] += 1
+
+    def info(self):
+        """Per livello: richieste, latenza media e massima (ms), token e costo stimato (USD)"""
+        prezzo_input, prezzo_output = self.prezzi
+        with self._lock:
+            livelli = {}
+            for livello, voce in self._livelli.items():
+                richieste = voce['richieste']
+                livelli[livello] = {
+                    'richieste': richieste,
+                    'da_cache': voce['da_cache'],
+                    'latenza_media_ms': round(voce['secondi'] / richieste * 1000, 2) if richieste else 0.0,
+                    'latenza_max_ms': round(voce['secondi_max'] * 1000, 2),
+                    'token_input': voce['token_input'],
+                    'token_output': voce['token_output'],
+                    'costo_usd': round((voce['token_input'] * prezzo_input +
+                                        voce['token_output'] * prezzo_output) / 1_000_000, 6),
+                }
+            return {'livelli': livelli, 'casi': dict(self._casi)}
+
+
+class Triage:
+    """
+    Sceglie il livello di analisi di un record con le regole locali di
+    AnimalHealthDiary (tabella regole e symptom_matcher, microsecondi):
+
+    - locale: risposta costruita dai consigli e avvisi delle regole, senza AI
+    - breve: prompt ridotto con l'esito delle regole e pochi token di risposta
+    - completa: analisi AI completa
+
+    Quale caso va a quale livello è deciso dalla politica (TRIAGE_POLICY).
+    """
+
+    def __init__(self, politica=None, regole=None, max_tokens=None, prezzi=PREZZI):
+        """
+        Args:
+            politica: Dizionario caso -> livello (default POLITICA_PREDEFINITA)
+            regole: RuleTable da usare (default: tabella condivisa)
+            max_tokens: Token massimi per livello (default MAX_TOKENS)
+            prezzi: (USD per milione di token di input, di output) per la stima dei costi
+        """
+        self.politica = dict(POLITICA_PREDEFINITA, **(politica or {}))
+        self.max_tokens = dict(MAX_TOKENS, **(max_tokens or {}))
+        self.diario = AnimalHealthDiary(regole)
+        self.statistiche = StatisticheLivelli(prezzi)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Crea il triage dalle variabili d'ambiente:
+            TRIAGE_POLICY        politica "caso=livello,..." o "off" (default: POLITICA_PREDEFINITA)
+            TRIAGE_SHORT_TOKENS  token massimi della risposta breve (default 250)
+            AI_PRICE_INPUT       USD per milione di token di input (default 0.15)
+            AI_PRICE_OUTPUT      USD per milione di token di output (default 0.60)
+        """
+        return cls(
+            politica=leggi_politica(os.getenv('TRIAGE_POLICY')),
+            max_tokens={'breve': int(os.getenv('TRIAGE_SHORT_TOKENS', str(MAX_TOKENS['breve'])))},
+            prezzi=(float(os.getenv('AI_PRICE_INPUT', str(PREZZI[0]))),
+                    float(os.getenv('AI_PRICE_OUTPUT', str(PREZZI[1])))),
+        )
+
+    def valuta(self, dati):
+        """Caso, livello scelto dalla politica e consigli/avvisi delle regole locali"""
+        consigli, avvisi = self.diario.analisi_ia(dati)
+        sintomi, note = dati.get('sintomi') or '', dati.get('note') or ''
+        classificazione = classifica_sintomi(sintomi)
+        gravita = {classificazione['gravita'], classifica_sintomi(note)['gravita']}
+
+        if 'grave' in gravita:
+            caso = 'grave'
+        elif 'moderato' in gravita:
+            caso = 'moderato'
+        elif (sintomi.strip() and not classificazione['nessuno']) or note.strip():
+            caso = 'non_riconosciuti'
+        elif avvisi:
+            caso = 'avvisi'
+        else:
+            caso = 'nessuno'
+        return Valutazione(caso, self.politica[caso], consigli, avvisi)
+
+    @staticmethod
+    def risposta_locale(valutazione):
+        """Testo dell'analisi costruito dalle sole regole locali"""
+        righe = ["Valutazione automatica con le regole locali (nessuna analisi AI necessaria)."]
+        if valutazione.avvisi:
+            righe += ["", "Avvisi:"] + [f"- {avviso}" for avviso in valutazione.avvisi]
+        if valutazione.consigli:
+            righe += ["", "Consigli:"] + [f"- {consiglio}" for consiglio in valutazione.consigli]
+        righe += ["", "Questi sono consigli generali e non sostituiscono una visita veterinaria."]
+        return '\n'.join(righe)
+
+    def registra(self, valutazione, secondi, usage=None, da_cache=False):
+        """Registra latenza e token (usage della risposta, se presente) di un'analisi"""
+        self.statistiche.registra(
+            valutazione.caso, valutazione.livello, secondi,
+            token_input=getattr(usage, 'prompt_tokens', 0) or 0,
+            token_output=getattr(usage, 'completion_tokens', 0) or 0,
+            da_cache=da_cache,
+        )
+
+    def info(self):
+        """Politica, token per livello e statistiche (per /api/status e la CLI batch)"""
+        return dict(self.statistiche.info(), politica=dict(self.politica), max_tokens=dict(self.max_tokens))
@@ -5,46 +5,213 @@ Animal Health Diary - Flask Web Application
 Applicazione web per monitoraggio salute animali con AI
 """
 
+import io
 import os
 import sys
 import json
-from datetime import datetime
-from flask import Flask, render_template, request, jsonify, redirect, url_for
+import time
+import cProfile
+import threading
+from contextlib import closing
+from datetime import datetime, timezone
+from flask import Flask, Request, Response, render_template, request, jsonify, redirect, url_for, abort, send_file, g
+from werkzeug.http import is_resource_modified
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # Aggiungi la directory parent al path per importare animal_diary_api
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from animal_diary_api import AnimalHealthDiaryAPI
+from analysis_cache import AnalysisCache
+from triage import Triage
+from rate_limits import LimitiAI, LimiteSuperato, BudgetEsaurito
+from metrics import REGISTRO, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from storage import HistoryStore
+from history_index import TimelineIndex, SeriesIndex, AnimalRegistry, PhotoRefIndex
+from jobs import JobQueue, QueueFullError, JobTimeoutError
+from fake_openai import FakeOpenAI
+from ids import new_id
+from utils import ChartGenerator, ChartCache, DataExporter, PhotoManager
+from importer import FORMATS as IMPORT_FORMATS, guess_format, read_rows, import_rows
+from search_index import SearchIndex
+
+
+
+class DiaryRequest(Request):
+    """
+    Request con limite del corpo impostabile per la singola richiesta
+    (request.max_content_length = n, come in Flask 3.1): werkzeug lo applica
+    anche ai corpi chunked senza Content-Length, mentre vengono letti.
+    """
+    _max_content_length = None
+
+    @property
+    def max_content_length(self):
+        if self._max_content_length is not None:
+            return self._max_content_length
+        return super().max_content_length
+
+    @max_content_length.setter
+    def max_content_length(self, value):
+        self._max_content_length = value
+
 
 app = Flask(__name__)
+app.request_class = DiaryRequest
 app.config['SECRET_KEY'] = os.urandom(24)
 
-# Directory per salvare i dati
-DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+# Directory per salvare i dati (DATA_DIR per spostarla, es. nei test)
+DATA_DIR = os.getenv('DATA_DIR') or os.path.join(os.path.dirname(__file__), 'data')
 os.makedirs(DATA_DIR, exist_ok=True)
+PhotoManager.PHOTOS_DIR = os.path.join(DATA_DIR, 'photos')
 
-# File per lo storico
-HISTORY_FILE = os.path.join(DATA_DIR, 'health_history.json')
+# File per lo storico (log append-only) e vecchio formato JSON da migrare
+HISTORY_FILE = os.path.join(DATA_DIR, 'health_history.jsonl')
+LEGACY_HISTORY_FILE = os.path.join(DATA_DIR, 'health_history.json')
 
+history_store = HistoryStore(HISTORY_FILE)
+history_store.migrate_from_json(LEGACY_HISTORY_FILE)
+timeline = TimelineIndex(history_store)
+series = SeriesIndex(history_store)
+animals = AnimalRegistry(history_store)
+photo_refs = PhotoRefIndex(history_store)
 
-def load_history():
-    """Carica lo storico delle visite dal file JSON"""
-    if os.path.exists(HISTORY_FILE):
-        try:
-            with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return []
-    return []
+# Ricerca full-text su sintomi, note e analisi (SQLite FTS5, configurabile con SEARCH_DB)
+search_index = SearchIndex(history_store, os.getenv('SEARCH_DB') or os.path.join(DATA_DIR, 'search.sqlite3'))
+search_index.sync_in_background()  # Prima indicizzazione o entry cambiate da un altro processo
 
+# Grafici per animale: formati serviti e immagini tenute in cache
+CHART_FORMATS = {'png': 'image/png', 'svg': 'image/svg+xml'}
+CHART_KINDS = ('weight', 'activity')
+chart_cache = ChartCache(max_entries=int(os.getenv('CHART_CACHE_SIZE', '64')))
 
-def save_history(history):
-    """Salva lo storico delle visite nel file JSON"""
-    try:
-        with open(HISTORY_FILE, 'w', encoding='utf-8') as f:
-            json.dump(history, f, ensure_ascii=False, indent=2)
-        return True
-    except:
-        return False
+# Ordinamenti dell'anagrafica: campo -> dal valore più alto
+ANIMAL_SORTS = {'nome': False, 'ultima_visita': True, 'visite': True, 'visite_critiche': True}
+
+# Paginazione dello storico
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+
+# Analisi AI in background: worker, profondità coda e timeout (secondi)
+app.config['AI_WORKERS'] = int(os.getenv('AI_WORKERS', '4'))
+app.config['AI_QUEUE_SIZE'] = int(os.getenv('AI_QUEUE_SIZE', '32'))
+app.config['AI_TIMEOUT'] = float(os.getenv('AI_TIMEOUT', '60'))
+# Client OpenAI finto (nessuna rete) per sviluppo e prove di carico
+app.config['FAKE_OPENAI'] = os.getenv('FAKE_OPENAI') == '1'
+
+ai_jobs = JobQueue(max_workers=app.config['AI_WORKERS'],
+                   max_queue=app.config['AI_QUEUE_SIZE'],
+                   timeout=app.config['AI_TIMEOUT'])
+
+# Cache delle analisi AI (memoria + SQLite in data/, configurabile con AI_CACHE_*)
+ai_cache = AnalysisCache.from_env(default_db=os.path.join(DATA_DIR, 'ai_cache.sqlite3'))
+
+# Triage con le regole locali: risposta locale, prompt breve o analisi completa (TRIAGE_POLICY)
+triage = Triage.from_env()
+
+# Limiti al minuto, ritentativi e budget giornalieri delle chiamate AI, condivisi
+# da tutti i job (AI_RPM, AI_TPM, AI_BUDGET_*); uso registrato in data/.
+# Un job attende il proprio turno al massimo AI_TIMEOUT secondi (AI_MAX_WAIT)
+ai_limits = LimitiAI.from_env(default_db=os.path.join(DATA_DIR, 'ai_usage.sqlite3'),
+                              attesa_max=app.config['AI_TIMEOUT'])
+
+# Foto: dimensione massima (MB), worker per le miniature, durata della cache HTTP (secondi)
+app.config['PHOTO_MAX_BYTES'] = int(float(os.getenv('PHOTO_MAX_MB', '10')) * 1024 * 1024)
+app.config['PHOTO_WORKERS'] = int(os.getenv('PHOTO_WORKERS', '2'))
+app.config['PHOTO_MAX_AGE'] = int(os.getenv('PHOTO_MAX_AGE', str(365 * 24 * 3600)))
+# Età minima (secondi) di una foto non referenziata prima che il garbage collector la elimini
+app.config['PHOTO_GC_GRACE'] = int(os.getenv('PHOTO_GC_GRACE', str(PhotoManager.GC_GRACE)))
+
+photo_jobs = JobQueue(max_workers=app.config['PHOTO_WORKERS'], max_queue=256, timeout=600)
+# Serializza le modifiche alla lista foto di una entry (lettura + riscrittura)
+photo_lock = threading.Lock()
+# Al più un garbage collector delle foto in coda o in esecuzione
+photo_gc_pending = threading.Event()
+
+# Profilazione con cProfile delle richieste con header X-Profile: 1, solo con
+# PROFILE_REQUESTS=1; un file .prof per richiesta in PROFILE_DIR
+app.config['PROFILE_REQUESTS'] = os.getenv('PROFILE_REQUESTS') == '1'
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR') or os.path.join(DATA_DIR, 'profiles')
+
+# Metriche del processo su /metrics: latenza per route (qui), operazioni sullo
+# storico (storage), chiamate AI (animal_diary_api), grafici ed export (utils)
+REQUEST_SECONDS = REGISTRO.istogramma(
+    'animal_diary_http_request_duration_seconds',
+    "Durata delle richieste HTTP per endpoint (risposte in streaming: fino all'inizio del corpo)",
+    ('endpoint', 'method'))
+REQUESTS = REGISTRO.contatore(
+    'animal_diary_http_requests_total', "Richieste HTTP per endpoint, metodo e stato", ('endpoint', 'method', 'status'))
+REGISTRO.raccolta('animal_diary_history_entries', "Entry nello storico", history_store.count)
+REGISTRO.raccolta('animal_diary_animals', "Animali nell'anagrafica", animals.count)
+REGISTRO.raccolta(
+    'animal_diary_jobs', "Job in coda e in esecuzione",
+    lambda: [((queue, state), jobs.stats()[state])
+             for queue, jobs in (('ai', ai_jobs), ('photo', photo_jobs)) for state in ('queued', 'running')],
+    etichette=('queue', 'state'))
+REGISTRO.raccolta(
+    'animal_diary_search_documents', "Entry nell'indice di ricerca e in attesa di indicizzazione",
+    lambda: search_index.info().items(), etichette=('state',))
+REGISTRO.raccolta(
+    'animal_diary_ai_cache_requests_total', "Letture della cache delle analisi AI per esito",
+    lambda: dict(ai_cache.stats).items(), tipo='counter', etichette=('result',))
+REGISTRO.raccolta(
+    'animal_diary_chart_cache_requests_total', "Letture della cache dei grafici per esito",
+    lambda: [('hit', chart_cache.hits), ('miss', chart_cache.misses)], tipo='counter', etichette=('result',))
+REGISTRO.raccolta(
+    'animal_diary_ai_tokens_today', "Token AI usati oggi (registro dei limiti)",
+    lambda: [(kind, ai_limits.registro.riepilogo()[f'token_{kind}']) for kind in ('input', 'output')],
+    etichette=('kind',))
+REGISTRO.raccolta(
+    'animal_diary_ai_cost_usd_today', "Costo stimato delle chiamate AI di oggi (USD)",
+    lambda: ai_limits.registro.riepilogo()['costo_usd'])
+REGISTRO.raccolta(
+    'animal_diary_ai_limiter_waiting', "Chiamate AI in attesa nei limiti al minuto",
+    lambda: ai_limits.limitatore.info()['in_attesa'])
+REGISTRO.raccolta(
+    'animal_diary_ai_limiter_events_total', "Chiamate AI partite, rifiutate e sospensioni dopo un 429",
+    lambda: [(event, ai_limits.limitatore.stats[event]) for event in ('partite', 'rifiutate', 'sospensioni')],
+    tipo='counter', etichette=('event',))
+
+
+def dump_profile(profiler):
+    """Salva il profilo di una richiesta in PROFILE_DIR (per pstats o snakeviz); ritorna il nome del file"""
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    filename = f"{datetime.now():%Y%m%d-%H%M%S}-{request.endpoint or 'unmatched'}-{new_id()}.prof"
+    profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], filename))
+    return filename
+
+
+@app.before_request
+def start_request_metrics():
+    """Avvia il cronometro della richiesta e, se richiesto e abilitato, il profiler"""
+    g.request_start = time.perf_counter()
+    if app.config['PROFILE_REQUESTS'] and request.headers.get('X-Profile') == '1':
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+@app.after_request
+def finish_profile(response):
+    """Ferma il profiler e indica il file salvato nell'header X-Profile-File"""
+    g.response_status = response.status_code
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        response.headers['X-Profile-File'] = dump_profile(profiler)
+    return response
+
+
+@app.teardown_request
+def observe_request(exc):
+    """Durata e stato della richiesta nelle metriche (500 per un'eccezione non gestita)"""
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+    start = g.pop('request_start', None)
+    if start is None:
+        return
+    endpoint = request.endpoint or 'unmatched'
+    REQUEST_SECONDS.osserva(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=g.pop('response_status', 500))
 
 
 @app.route('/')
@@ -53,16 +220,287 @@ def index():
     return render_template('index.html')
 
 
+def history_filters():
+    """Legge paginazione e filtri dello storico dalla query string"""
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return {
+        'limit': max(1, min(limit, MAX_PAGE_SIZE)),
+        'cursor': request.args.get('cursor') or None,
+        'nome': request.args.get('nome') or None,
+        'specie': request.args.get('specie') or None,
+        'date_from': request.args.get('date_from') or None,
+        'date_to': request.args.get('date_to') or None,
+    }
+
+
 @app.route('/history')
 def history():
-    """Pagina storico visite"""
-    history_data = load_history()
-    return render_template('history.html', entries=history_data)
+    """Pagina storico visite (paginata, con filtri)"""
+    filters = history_filters()
+    try:
+        entries, next_cursor = timeline.page(**filters)
+    except ValueError as e:
+        return str(e), 400
+    return render_template('history.html', entries=entries,
+                           next_cursor=next_cursor, filters=filters)
+
+
+@app.route('/api/history')
+def api_history():
+    """Storico in JSON, paginato a cursore e filtrabile"""
+    try:
+        entries, next_cursor = timeline.page(**history_filters())
+    except ValueError as e:
+        return jsonify({'error': True, 'message': str(e)}), 400
+    return jsonify({'entries': entries, 'next_cursor': next_cursor})
+
+
+@app.route('/export/<fmt>')
+def export(fmt):
+    """
+    Esporta lo storico (csv, json o jsonl) in streaming, con gli stessi
+    filtri dello storico (nome, specie, date_from, date_to); ?gzip=1 per
+    un file compresso al volo
+    """
+    if fmt not in DataExporter.FORMATS:
+        abort(404)
+    filters = history_filters()
+    del filters['limit'], filters['cursor']
+    entries = timeline.scan(**filters)
+    return DataExporter.stream(entries, fmt, compress=request.args.get('gzip') == '1')
+
+
+# Formato di un import inviato come corpo della richiesta, dal Content-Type
+IMPORT_CONTENT_TYPES = {
+    'text/csv': 'csv',
+    'application/json': 'json',
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+}
+
+
+@app.route('/import', methods=['POST'])
+def import_history():
+    """
+    Importa uno storico (CSV dell'export, JSON o JSONL) dal file caricato
+    (campo 'file') o dal corpo della richiesta, letto e validato in
+    streaming e scritto a blocchi. Le entry con un id già presente sono
+    saltate, o sostituite con ?replace=1. Nessuna chiamata AI: le entry senza
+    analisi si possono analizzare dopo con `importer.py --analizza`.
+    """
+    upload = request.files.get('file')
+    if upload is not None:
+        stream = upload.stream
+        fmt = request.args.get('format') or guess_format(upload.filename)
+    else:
+        stream = request.stream
+        fmt = request.args.get('format') or IMPORT_CONTENT_TYPES.get(request.mimetype, 'jsonl')
+    if fmt not in IMPORT_FORMATS:
+        return jsonify({'error': True, 'message': f'Formato non supportato: {fmt}'}), 400
+
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    result = import_rows(history_store, read_rows(text, fmt),
+                         replace=request.args.get('replace') == '1')
+    search_index.sync_in_background()
+    return jsonify(result), 400 if result.get('fatal_error') else 200
+
+
+def search_params():
+    """Ricerca, filtri per animale e paginazione dalla query string"""
+    limit = request.args.get('limit', DEFAULT_PAGE_SIZE, type=int)
+    return {
+        'query': request.args.get('q', '').strip(),
+        'nome': request.args.get('nome') or None,
+        'specie': request.args.get('specie') or None,
+        'limit': max(1, min(limit, MAX_PAGE_SIZE)),
+        'offset': max(0, request.args.get('offset', 0, type=int)),
+    }
+
+
+@app.route('/search')
+def search():
+    """Ricerca full-text nello storico (sintomi, note, analisi AI)"""
+    params = search_params()
+    results, has_more = [], False
+    if params['query']:
+        try:
+            results, has_more = search_index.search(**params)
+        except ValueError as e:
+            return str(e), 400
+    next_offset = params['offset'] + params['limit'] if has_more else None
+    return render_template('search.html', results=results, params=params, next_offset=next_offset)
+
+
+@app.route('/api/search')
+def api_search():
+    """
+    Ricerca full-text in JSON: risultati dal più pertinente con id, nome,
+    specie, timestamp, score ed estratto HTML con i termini in <mark>
+    """
+    params = search_params()
+    if not params['query']:
+        return jsonify({'error': True, 'message': 'Parametro q mancante'}), 400
+    try:
+        results, has_more = search_index.search(**params)
+    except ValueError as e:
+        return jsonify({'error': True, 'message': str(e)}), 400
+    return jsonify({
+        'results': results,
+        'next_offset': params['offset'] + params['limit'] if has_more else None,
+    })
+
+
+def animal_list():
+    """Anagrafica filtrata per specie e ordinata come da query string (?specie, ?sort)"""
+    sort = request.args.get('sort', 'nome')
+    if sort not in ANIMAL_SORTS:
+        raise ValueError(f"Ordinamento non valido: {sort} (usa {', '.join(ANIMAL_SORTS)})")
+    summaries = animals.all(specie=request.args.get('specie'))
+    if sort != 'nome':
+        summaries.sort(key=lambda summary: summary[sort], reverse=ANIMAL_SORTS[sort])
+    return summaries
+
+
+@app.route('/animals')
+def animals_dashboard():
+    """Cruscotto degli animali con gli aggregati di ciascuno"""
+    try:
+        summaries = animal_list()
+    except ValueError as e:
+        return str(e), 400
+    return render_template('animals.html', animals=summaries,
+                           specie=request.args.get('specie', ''), sort=request.args.get('sort', 'nome'))
+
+
+@app.route('/api/animals')
+def api_animals():
+    """Anagrafica in JSON: un elemento per animale con i suoi aggregati"""
+    try:
+        summaries = animal_list()
+    except ValueError as e:
+        return jsonify({'error': True, 'message': str(e)}), 400
+    return jsonify({'animals': summaries, 'count': len(summaries)})
+
+
+@app.route('/api/animals/<path:nome>')
+def api_animal(nome):
+    """Aggregati di un singolo animale"""
+    summary = animals.get(nome)
+    if summary is None:
+        return jsonify({'error': True, 'message': 'Animale non trovato'}), 404
+    return jsonify(summary)
+
+
+@app.route('/api/series/<path:nome>')
+def api_series(nome):
+    """Andamento di un animale: punti di peso (epoch, kg) e conteggi per attività"""
+    times, weights = series.weights(nome)
+    return jsonify({
+        'nome': nome,
+        'peso': [{'t': t, 'kg': kg} for t, kg in zip(times, weights)],
+        'attivita': series.activity(nome),
+    })
+
+
+@app.route('/charts/<animal>/<kind>.<fmt>')
+def chart(animal, kind, fmt):
+    """
+    Grafico di un animale (kind: weight o activity) in PNG o SVG.
+    ETag e Last-Modified derivano dalle entry dell'animale: il browser
+    rivalida e riceve 304 senza che il grafico venga ridisegnato.
+    """
+    if kind not in CHART_KINDS or fmt not in CHART_FORMATS:
+        abort(404)
+    stamp = series.stamp(animal)
+    if stamp is None:
+        abort(404)
+    count, digest, latest = stamp
+    etag = f"{kind}-{fmt}-{count}-{digest:08x}"
+    last_modified = datetime.fromtimestamp(int(latest), timezone.utc) if latest is not None else None
+    if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        response = Response(status=304)
+    else:
+        key = (animal.strip().lower(), kind, fmt)
+        image = chart_cache.get(key, stamp)
+        if image is None:
+            image = ChartGenerator.render_chart(series, animal, kind, fmt)
+            if image is None:
+                abort(404)
+            chart_cache.put(key, stamp, image)
+        response = Response(image, mimetype=CHART_FORMATS[fmt])
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
+def create_api():
+    """Istanza di AnimalHealthDiaryAPI con client reale o finto"""
+    client = FakeOpenAI() if app.config['FAKE_OPENAI'] else None
+    return AnimalHealthDiaryAPI(client=client, timeout=app.config['AI_TIMEOUT'], cache=ai_cache, triage=triage,
+                                limiti=ai_limits, chiave_obbligatoria=False)
+
+
+def run_analysis(dati, usa_cache=True, emit=None, cancelled=None):
+    """
+    Job in background: analisi AI e salvataggio nello storico.
+    Con emit la risposta viene letta in streaming e ogni frammento pubblicato
+    subito; il testo completo viene comunque salvato alla fine.
+    
+    Il job attende il proprio turno nei limiti al minuto e ritenta i 429
+    (ai_limits); se l'analisi fallisce comunque il job termina con errore e
+    nello storico non viene salvato nulla. Lo stesso se cancelled() indica
+    che il job ha superato il tempo massimo: lo streaming si interrompe e
+    l'analisi ormai scaduta non viene salvata.
+    """
+    def check_timeout():
+        if cancelled is not None and cancelled():
+            raise JobTimeoutError("Analisi oltre il tempo massimo")
+    
+    api = create_api()
+    try:
+        if emit is None:
+            risposta_ai = api.richiesta_ai(dati, usa_cache=usa_cache)
+        else:
+            frammenti = []
+            with closing(api.richiesta_ai_stream(dati, usa_cache=usa_cache)) as stream:
+                for delta in stream:
+                    check_timeout()
+                    frammenti.append(delta)
+                    emit(delta)
+            risposta_ai = ''.join(frammenti)
+    except (LimiteSuperato, BudgetEsaurito, JobTimeoutError):
+        raise
+    except Exception as e:
+        raise RuntimeError(f"Errore nella chiamata API: {str(e)}") from e
+    check_timeout()
+    
+    # Crea l'entry per lo storico
+    entry = {
+        'id': new_id(),
+        'dati': dati,
+        'analisi_ai': risposta_ai,
+        'timestamp': datetime.now().isoformat()
+    }
+    
+    # Salva nello storico (append O(1)) e rende l'analisi subito ricercabile;
+    # se è in corso un'altra sync() (es. un import) l'entry resta annotata e
+    # viene indicizzata da quella successiva
+    history_store.append(entry)
+    search_index.sync(blocking=False)
+    
+    return {
+        'entry_id': entry['id'],
+        'dati': dati,
+        'analisi': risposta_ai,
+        'livello': api.livello(dati)
+    }
 
 
 @app.route('/analyze', methods=['POST'])
 def analyze():
-    """Endpoint per analisi AI dei dati animale"""
+    """Accoda l'analisi AI dei dati animale e ritorna subito l'id del job"""
     try:
         # Ottieni i dati dal form
         dati = {
@@ -77,37 +515,34 @@ def analyze():
             'data': datetime.now().strftime("%Y-%m-%d %H:%M")
         }
         
-        # Verifica che OPENAI_API_KEY sia configurata
-        if not os.getenv('OPENAI_API_KEY'):
-            return jsonify({
-                'error': True,
-                'message': 'OPENAI_API_KEY non configurata. Impostare la variabile d\'ambiente.'
-            }), 400
+        # Ignora la cache con il campo bypass_cache=1 o Cache-Control: no-cache
+        usa_cache = request.form.get('bypass_cache') not in ('1', 'true', 'on') and \
+            'no-cache' not in request.headers.get('Cache-Control', '')
         
-        # Inizializza l'API e ottieni l'analisi
-        api = AnimalHealthDiaryAPI()
-        risposta_ai = api.analisi_ai(dati)
-        
-        # Crea l'entry per lo storico
-        entry = {
-            'id': datetime.now().strftime("%Y%m%d_%H%M%S"),
-            'dati': dati,
-            'analisi_ai': risposta_ai,
-            'timestamp': datetime.now().isoformat()
-        }
-        
-        # Salva nello storico
-        history_data = load_history()
-        history_data.insert(0, entry)  # Aggiungi all'inizio
-        save_history(history_data)
+        # La chiave e il budget servono solo se non basta la risposta locale del triage
+        valutazione = triage.valuta(dati)
+        if valutazione.livello != 'locale':
+            if not os.getenv('OPENAI_API_KEY') and not app.config['FAKE_OPENAI']:
+                return jsonify({
+                    'error': True,
+                    'message': 'OPENAI_API_KEY non configurata. Impostare la variabile d\'ambiente.'
+                }), 400
+            ai_limits.verifica(dati['nome'], create_api().parametri_richiesta(dati, valutazione))
         
+        job_id = ai_jobs.submit(run_analysis, dati, usa_cache, streaming=True, cancellable=True)
         return jsonify({
             'success': True,
-            'entry_id': entry['id'],
-            'dati': dati,
-            'analisi': risposta_ai
-        })
+            'job_id': job_id,
+            'status_url': url_for('api_job', job_id=job_id),
+            'events_url': url_for('api_job_events', job_id=job_id)
+        }), 202
         
+    except QueueFullError as e:
+        return jsonify({'error': True, 'message': str(e)}), 503
+    except BudgetEsaurito as e:
+        response = jsonify({'error': True, 'message': str(e)})
+        response.headers['Retry-After'] = str(int(e.attesa) + 1)
+        return response, 429
     except ValueError as e:
         return jsonify({
             'error': True,
@@ -120,11 +555,43 @@ def analyze():
         }), 500
 
 
+@app.route('/api/jobs/<job_id>')
+def api_job(job_id):
+    """Stato di un job di analisi (polling)"""
+    job = ai_jobs.get(job_id)
+    if job is None:
+        return jsonify({'error': True, 'message': 'Job non trovato'}), 404
+    return jsonify(job)
+
+
+@app.route('/api/jobs/<job_id>/events')
+def api_job_events(job_id):
+    """
+    Job via Server-Sent Events: un evento 'delta' per ogni frammento della
+    risposta AI man mano che arriva, poi un evento 'final' con il job
+    (stato done/error/timeout e risultato salvato nello storico). Nomi
+    diversi da 'error', che per EventSource è l'errore di connessione.
+    """
+    if ai_jobs.get(job_id) is None:
+        return jsonify({'error': True, 'message': 'Job non trovato'}), 404
+    
+    def generate():
+        for delta in ai_jobs.stream(job_id):
+            if delta is None:
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: delta\ndata: {json.dumps({'text': delta}, ensure_ascii=False)}\n\n"
+        job = ai_jobs.get(job_id)
+        yield f"event: final\ndata: {json.dumps(job, ensure_ascii=False)}\n\n"
+    
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 @app.route('/entry/<entry_id>')
 def view_entry(entry_id):
     """Visualizza una singola entry"""
-    history_data = load_history()
-    entry = next((e for e in history_data if e['id'] == entry_id), None)
+    entry = history_store.get(entry_id)
     
     if entry:
         return render_template('entry.html', entry=entry)
@@ -132,15 +599,128 @@ def view_entry(entry_id):
         return "Entry non trovata", 404
 
 
+def queue_variants(filename):
+    """Accoda la generazione delle miniature; con la coda piena verrà ritentata alla prima richiesta"""
+    try:
+        photo_jobs.submit(PhotoManager.make_variants, filename)
+    except QueueFullError:
+        pass
+
+
+def collect_photos():
+    """Garbage collector delle foto non più usate da nessuna entry (job in background)"""
+    photo_gc_pending.clear()
+    return PhotoManager.collect_garbage(photo_refs.referenced(), grace=app.config['PHOTO_GC_GRACE'])
+
+
+def queue_photo_gc():
+    """Accoda il garbage collector delle foto, se non è già in coda"""
+    if photo_gc_pending.is_set():
+        return
+    photo_gc_pending.set()
+    try:
+        photo_jobs.submit(collect_photos)
+    except QueueFullError:
+        photo_gc_pending.clear()  # Verrà ritentato alla prossima cancellazione
+
+
+@app.route('/entry/<entry_id>/photos', methods=['POST'])
+def upload_photo(entry_id):
+    """
+    Allega una foto a una entry: file nel campo 'photo' (multipart) o
+    immagine come corpo della richiesta, scritta su disco a blocchi con
+    limite PHOTO_MAX_MB. Le miniature vengono generate in background.
+    Un'immagine già salvata (anche per altre entry) non viene duplicata.
+    """
+    max_bytes = app.config['PHOTO_MAX_BYTES']
+    too_large = f'File troppo grande (massimo {max_bytes // (1024 * 1024)} MB)'
+    # Margine per le intestazioni multipart; il limite vale anche mentre il
+    # corpo viene letto (multipart in request.files o stream), prima di
+    # finire su disco
+    request.max_content_length = max_bytes + 64 * 1024
+    if request.content_length and request.content_length > request.max_content_length:
+        return jsonify({'error': True, 'message': too_large}), 413
+    if history_store.get(entry_id) is None:
+        return jsonify({'error': True, 'message': 'Entry non trovata'}), 404
+
+    try:
+        upload = request.files.get('photo')
+        if upload is not None:
+            success, result = PhotoManager.save_photo(upload, max_bytes)
+        else:
+            success, result = PhotoManager.save_stream(request.stream, max_bytes)
+    except RequestEntityTooLarge:
+        # Corpo senza Content-Length (chunked) oltre il limite durante la lettura
+        return jsonify({'error': True, 'message': too_large}), 413
+    if not success:
+        return jsonify({'error': True, 'message': result}), 400
+
+    with photo_lock:
+        entry = history_store.get(entry_id)
+        if entry is None:
+            # La foto, se non usata da altre entry, resta al garbage collector
+            return jsonify({'error': True, 'message': 'Entry non trovata'}), 404
+        added = result not in entry.get('foto', [])
+        if added:
+            history_store.append(dict(entry, foto=entry.get('foto', []) + [result]))
+    queue_variants(result)
+
+    return jsonify({
+        'success': True,
+        'filename': result,
+        'url': url_for('photo', filename=result),
+        'thumb_url': url_for('photo', filename=result, variant='thumb'),
+    }), 201 if added else 200
+
+
+@app.route('/photos/<filename>')
+@app.route('/photos/<variant>/<filename>')
+def photo(filename, variant=None):
+    """
+    Foto originale o variante ridotta (thumb, medium). I nomi sono unici e
+    non cambiano mai: cache HTTP di lunga durata, immutable, con ETag e
+    richieste Range. Una variante non ancora generata viene sostituita
+    dall'originale senza cache di lunga durata.
+    """
+    if variant is not None and variant not in PhotoManager.VARIANTS:
+        abort(404)
+    if '/' in filename or '\\' in filename or filename.startswith('.'):
+        abort(404)
+    path = PhotoManager.get_photo_path(filename)
+    if not os.path.isfile(path):
+        abort(404)
+
+    max_age = app.config['PHOTO_MAX_AGE']
+    mimetype = PhotoManager.MIMETYPES.get(filename.rsplit('.', 1)[-1])
+    if variant is not None:
+        variant_path = PhotoManager.variant_path(filename, variant)
+        if os.path.isfile(variant_path):
+            path, mimetype = variant_path, 'image/webp'
+        else:
+            queue_variants(filename)
+            max_age = 0
+
+    response = send_file(path, mimetype=mimetype, conditional=True, max_age=max_age)
+    if max_age:
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response
+
+
 @app.route('/delete/<entry_id>', methods=['POST'])
 def delete_entry(entry_id):
-    """Elimina una entry dallo storico"""
-    history_data = load_history()
-    history_data = [e for e in history_data if e['id'] != entry_id]
-    
-    if save_history(history_data):
+    """Elimina una entry dallo storico e rilascia i riferimenti alle sue foto"""
+    try:
+        entry = history_store.get(entry_id)
+        history_store.delete(entry_id)  # Tombstone, compattazione in background
+        # Le foto non più usate da altre entry vengono eliminate in background
+        if entry and any(photo_refs.count(filename) == 0 for filename in entry.get('foto', [])):
+            queue_photo_gc()
+        search_index.sync(blocking=False)
         return jsonify({'success': True})
-    else:
+    except OSError:
         return jsonify({'error': True, 'message': 'Errore durante l\'eliminazione'}), 500
 
 
@@ -150,10 +730,24 @@ def api_status():
     api_key = os.getenv('OPENAI_API_KEY')
     return jsonify({
         'api_configured': bool(api_key),
-        'entries_count': len(load_history())
+        'entries_count': history_store.count(),
+        'animals_count': animals.count(),
+        'jobs': ai_jobs.stats(),
+        'ai_cache': ai_cache.info(),
+        'triage': triage.info(),
+        'ai_limits': ai_limits.info(),
+        'chart_cache': chart_cache.info(),
+        'photos': photo_refs.info(),
+        'search': search_index.info()
     })
 
 
+@app.route('/metrics')
+def metrics():
+    """Metriche del processo nel formato testuale di Prometheus"""
+    return Response(REGISTRO.esporta(), content_type=METRICS_CONTENT_TYPE)
+
+
 if __name__ == '__main__':
     print("\n" + "="*70)
     print("  ANIMAL HEALTH DIARY - WEB APPLICATION")
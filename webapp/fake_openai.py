@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fake OpenAI client for Animal Health Diary webapp
+Client locale che imita chat.completions.create per sviluppo e prove di carico
+"""
+import os
+import time
+from types import SimpleNamespace
+
+
+class FakeOpenAI:
+    """
+    Sostituto di openai.OpenAI senza rete: risponde dopo `latency` secondi con
+    un testo fisso. Si attiva nella webapp con FAKE_OPENAI=1 (latenza in
+    FAKE_OPENAI_LATENCY) oppure passandolo come client ad AnimalHealthDiaryAPI.
+    """
+
+    def __init__(self, latency=None, reply=None):
+        self.latency = float(os.getenv('FAKE_OPENAI_LATENCY', '1.0') if latency is None else latency)
+        self.reply = reply or (
+            "Valutazione simulata: nessuna criticità rilevata dai dati forniti.\n"
+            "Questi sono consigli generali e non sostituiscono una visita veterinaria."
+        )
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, max_tokens=None, stream=False, stream_options=None, **kwargs):
+        """Imita chat.completions.create (risposta completa o in streaming)"""
+        if stream:
+            include_usage = bool((stream_options or {}).get('include_usage'))
+            return self._stream(model, self._usage(messages) if include_usage else None)
+        time.sleep(self.latency)
+        return SimpleNamespace(
+            model=model,
+            choices=[SimpleNamespace(message=SimpleNamespace(role='assistant', content=self.reply),
+                                     finish_reason='stop')],
+            usage=self._usage(messages),
+        )
+
+    def _usage(self, messages):
+        """Token simulati: una parola per token"""
+        prompt_tokens = sum(len(m['content'].split()) for m in messages)
+        completion_tokens = len(self.reply.split())
+        return SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                               total_tokens=prompt_tokens + completion_tokens)
+
+    def _stream(self, model, usage=None):
+        """
+        Chunk in stile streaming: primo token dopo il 10% della latenza; con
+        usage un chunk finale senza choices riporta i token, come l'API con
+        stream_options={'include_usage': True}
+        """
+        words = self.reply.split(' ')
+        time.sleep(self.latency * 0.1)
+        for i, word in enumerate(words):
+            if i:
+                time.sleep(self.latency * 0.9 / len(words))
+            content = word if i == len(words) - 1 else word + ' '
+            yield SimpleNamespace(
+                model=model,
+                choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=None)],
+            )
+        if usage is not None:
+            yield SimpleNamespace(model=model, choices=[], usage=usage)
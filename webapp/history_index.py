@@ -0,0 +1,596 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Secondary indexes for Animal Health Diary webapp
+Indice temporale dello storico per paginazione a cursore e filtri,
+serie per animale di peso e attività per i grafici, anagrafica degli animali,
+riferimenti alle foto
+"""
+import json
+import zlib
+import base64
+import threading
+from array import array
+from datetime import datetime
+from collections import Counter
+from bisect import bisect_left, bisect_right, insort
+
+
+def encode_cursor(key):
+    """Cursore opaco per l'URL a partire dalla chiave (timestamp, id)"""
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Chiave (timestamp, id) da un cursore; ValueError se non valido"""
+    try:
+        timestamp, entry_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError(f"Cursore non valido: {cursor}") from e
+    return str(timestamp), str(entry_id)
+
+
+class TimelineIndex:
+    """
+    Indice ordinato per (timestamp, id) delle entry, con liste separate per
+    nome, specie e coppia nome/specie. Mantenuto incrementalmente dallo
+    HistoryStore: una pagina costa O(log N + dimensione pagina).
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self.reset()
+        store.subscribe(self)
+
+    def reset(self):
+        """Svuota l'indice (lo store lo ripopola con add())"""
+        with self._lock:
+            self._all = []
+            self._by_nome = {}
+            self._by_specie = {}
+            self._by_nome_specie = {}
+
+    def _buckets(self, meta):
+        """Liste ordinate in cui compare una entry con i metadati indicati"""
+        nome = (meta.get('n') or '').strip().lower()
+        specie = (meta.get('s') or '').strip().lower()
+        return [
+            self._all,
+            self._by_nome.setdefault(nome, []),
+            self._by_specie.setdefault(specie, []),
+            self._by_nome_specie.setdefault((nome, specie), []),
+        ]
+
+    def add(self, entry_id, meta):
+        """Inserisce una entry in tutte le liste ordinate"""
+        key = (meta.get('t') or '', entry_id)
+        with self._lock:
+            for keys in self._buckets(meta):
+                insort(keys, key)
+
+    def add_many(self, items):
+        """
+        Inserisce più entry (entry_id, meta): le chiavi nuove vengono
+        ordinate e accodate, o fuse con un solo sort per lista, invece di
+        un insort (O(N) ciascuno) per entry
+        """
+        new_keys = {}
+        with self._lock:
+            for entry_id, meta in items:
+                key = (meta.get('t') or '', entry_id)
+                for keys in self._buckets(meta):
+                    new_keys.setdefault(id(keys), (keys, []))[1].append(key)
+            for keys, added in new_keys.values():
+                added.sort()
+                if not keys or keys[-1] <= added[0]:
+                    keys.extend(added)
+                elif added[-1] <= keys[0]:
+                    keys[:0] = added
+                else:
+                    keys.extend(added)
+                    keys.sort()
+
+    def remove(self, entry_id, meta):
+        """Rimuove una entry da tutte le liste ordinate"""
+        key = (meta.get('t') or '', entry_id)
+        with self._lock:
+            for keys in self._buckets(meta):
+                position = bisect_left(keys, key)
+                if position < len(keys) and keys[position] == key:
+                    del keys[position]
+
+    def page_keys(self, limit=20, cursor=None, nome=None, specie=None,
+                  date_from=None, date_to=None):
+        """
+        Chiavi (timestamp, id) di una pagina, dalla più recente alla più vecchia.
+
+        Args:
+            limit: Numero massimo di entry
+            cursor: Cursore restituito dalla pagina precedente
+            nome, specie: Filtri esatti (case-insensitive)
+            date_from, date_to: Intervallo di date ISO (YYYY-MM-DD), estremi inclusi
+
+        Returns:
+            (chiavi, cursore della pagina successiva o None)
+        """
+        self.store.refresh()
+        nome = (nome or '').strip().lower()
+        specie = (specie or '').strip().lower()
+
+        with self._lock:
+            if nome and specie:
+                keys = self._by_nome_specie.get((nome, specie), [])
+            elif nome:
+                keys = self._by_nome.get(nome, [])
+            elif specie:
+                keys = self._by_specie.get(specie, [])
+            else:
+                keys = self._all
+
+            start = bisect_left(keys, (date_from,)) if date_from else 0
+            end = bisect_right(keys, (date_to + '\uffff',)) if date_to else len(keys)
+            if cursor:
+                end = min(end, bisect_left(keys, decode_cursor(cursor)))
+
+            first = max(start, end - limit)
+            page = keys[first:end][::-1]
+            has_more = first > start
+
+        next_cursor = encode_cursor(page[-1]) if page and has_more else None
+        return page, next_cursor
+
+    def page(self, **filters):
+        """Come page_keys() ma ritorna le entry complete lette dallo store"""
+        keys, next_cursor = self.page_keys(**filters)
+        entries = [self.store.get(entry_id) for _, entry_id in keys]
+        return [entry for entry in entries if entry is not None], next_cursor
+
+    def scan(self, batch_size=500, nome=None, specie=None, date_from=None, date_to=None):
+        """
+        Tutte le entry che rispettano i filtri, dalla più recente, lette
+        dallo store a blocchi di batch_size: la memoria usata non dipende
+        dalla dimensione dello storico.
+        """
+        cursor = None
+        while True:
+            keys, cursor = self.page_keys(limit=batch_size, cursor=cursor, nome=nome, specie=specie,
+                                          date_from=date_from, date_to=date_to)
+            yield from self.store.get_many([entry_id for _, entry_id in keys])
+            if cursor is None:
+                return
+
+
+class _Series:
+    """
+    Serie di un animale: tempi (epoch) e pesi ordinati per tempo, conteggi
+    attività e, per riconoscere le modifiche, epoch di tutte le entry e
+    XOR dei crc32 di id, timestamp, peso e attività
+    """
+    __slots__ = ('times', 'weights', 'ids', 'activity', 'stamps', 'digest')
+
+    def __init__(self):
+        self.times = array('d')
+        self.weights = array('d')
+        self.ids = []
+        self.activity = Counter()
+        self.stamps = array('d')
+        self.digest = 0
+
+
+class SeriesIndex:
+    """
+    Serie temporali per animale (e per l'intero storico), mantenute
+    incrementalmente dallo HistoryStore a partire dai metadati dell'indice:
+    il timestamp viene interpretato una sola volta all'inserimento e un
+    grafico legge solo i punti dell'animale richiesto.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self.reset()
+        store.subscribe(self)
+
+    def reset(self):
+        """Svuota le serie (lo store le ripopola con add())"""
+        with self._lock:
+            self._series = {}
+
+    @staticmethod
+    def _keys(meta):
+        """Serie in cui compare una entry: quella dell'animale e quella complessiva (None)"""
+        return None, (meta.get('n') or '').strip().lower()
+
+    @staticmethod
+    def _epoch(meta):
+        """Timestamp di una entry in epoch, o None se non valido"""
+        try:
+            return datetime.fromisoformat(meta.get('t') or '').timestamp()
+        except ValueError:
+            return None
+
+    @staticmethod
+    def _point(epoch, meta):
+        """(epoch, peso) di una entry, o None se senza peso o data validi"""
+        peso = meta.get('p')
+        if epoch is None or not peso or peso <= 0:
+            return None
+        return epoch, peso
+
+    @staticmethod
+    def _crc(entry_id, meta):
+        """
+        crc32 di id e valori che finiscono nei grafici: una entry sostituita
+        con lo stesso id ma peso o attività diversi cambia il digest
+        """
+        values = (entry_id, meta.get('t') or '', repr(meta.get('p')), meta.get('a') or '')
+        return zlib.crc32('\x00'.join(values).encode('utf-8'))
+
+    def add(self, entry_id, meta):
+        """Aggiunge il punto di peso e l'attività di una entry"""
+        epoch = self._epoch(meta)
+        point = self._point(epoch, meta)
+        activity = meta.get('a') or 'Non specificata'
+        crc = self._crc(entry_id, meta)
+        with self._lock:
+            for key in self._keys(meta):
+                series = self._series.get(key)
+                if series is None:
+                    series = self._series[key] = _Series()
+                series.activity[activity] += 1
+                series.digest ^= crc
+                if epoch is not None:
+                    series.stamps.insert(bisect_right(series.stamps, epoch), epoch)
+                if point is not None:
+                    # Le entry arrivano di norma in ordine: l'inserimento è un append
+                    position = bisect_right(series.times, point[0])
+                    series.times.insert(position, point[0])
+                    series.weights.insert(position, point[1])
+                    series.ids.insert(position, entry_id)
+
+    def add_many(self, items):
+        """
+        Aggiunge più entry (entry_id, meta) insieme: ogni serie riceve i
+        nuovi punti in un colpo solo (accodati, anteposti o fusi con un
+        unico ordinamento) invece di un inserimento per entry
+        """
+        new_points = {}
+        with self._lock:
+            for entry_id, meta in items:
+                epoch = self._epoch(meta)
+                point = self._point(epoch, meta)
+                activity = meta.get('a') or 'Non specificata'
+                crc = self._crc(entry_id, meta)
+                for key in self._keys(meta):
+                    series = self._series.get(key)
+                    if series is None:
+                        series = self._series[key] = _Series()
+                    series.activity[activity] += 1
+                    series.digest ^= crc
+                    stamps, points = new_points.setdefault(key, ([], []))
+                    if epoch is not None:
+                        stamps.append(epoch)
+                    if point is not None:
+                        points.append((point[0], point[1], entry_id))
+            for key, (stamps, points) in new_points.items():
+                series = self._series[key]
+                stamps.sort()
+                self._merge(series, ('stamps',), [(stamp,) for stamp in stamps])
+                points.sort(key=lambda point: point[0])
+                self._merge(series, ('times', 'weights', 'ids'), points)
+
+    @staticmethod
+    def _merge(series, fields, rows):
+        """
+        Unisce righe ordinate per tempo ai campi paralleli di una serie:
+        accodate se tutte successive, anteposte se tutte precedenti (import
+        dal più recente), altrimenti fuse con un unico ordinamento stabile
+        """
+        if not rows:
+            return
+        columns = [getattr(series, field) for field in fields]
+        times = columns[0]
+        if not times or times[-1] <= rows[0][0]:
+            for position, column in enumerate(columns):
+                column.extend(row[position] for row in rows)
+        elif rows[-1][0] < times[0]:
+            for position, column in enumerate(columns):
+                values = [row[position] for row in rows]
+                column[:0] = array('d', values) if isinstance(column, array) else values
+        else:
+            merged = sorted([*zip(*columns), *rows], key=lambda row: row[0])
+            for position, (field, column) in enumerate(zip(fields, columns)):
+                values = (row[position] for row in merged)
+                setattr(series, field, array('d', values) if isinstance(column, array) else list(values))
+
+    def remove(self, entry_id, meta):
+        """Rimuove il punto di peso e l'attività di una entry"""
+        epoch = self._epoch(meta)
+        point = self._point(epoch, meta)
+        activity = meta.get('a') or 'Non specificata'
+        crc = self._crc(entry_id, meta)
+        with self._lock:
+            for key in self._keys(meta):
+                series = self._series.get(key)
+                if series is None:
+                    continue
+                series.activity[activity] -= 1
+                if series.activity[activity] <= 0:
+                    del series.activity[activity]
+                series.digest ^= crc
+                if epoch is not None:
+                    position = bisect_left(series.stamps, epoch)
+                    if position < len(series.stamps) and series.stamps[position] == epoch:
+                        del series.stamps[position]
+                if point is not None:
+                    position = bisect_left(series.times, point[0])
+                    while position < len(series.times) and series.times[position] == point[0]:
+                        if series.ids[position] == entry_id:
+                            del series.times[position]
+                            del series.weights[position]
+                            del series.ids[position]
+                            break
+                        position += 1
+                if not series.ids and not series.activity:
+                    del self._series[key]
+
+    def weights(self, nome=None):
+        """
+        Punti di peso di un animale (o di tutto lo storico se nome è None),
+        dal più vecchio: (lista di epoch, lista di pesi in kg)
+        """
+        self.store.refresh()
+        key = None if nome is None else nome.strip().lower()
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return [], []
+            return series.times.tolist(), series.weights.tolist()
+
+    def activity(self, nome=None):
+        """Numero di registrazioni per livello di attività di un animale (o di tutti)"""
+        self.store.refresh()
+        key = None if nome is None else nome.strip().lower()
+        with self._lock:
+            series = self._series.get(key)
+            return dict(series.activity) if series is not None else {}
+
+    def stamp(self, nome=None):
+        """
+        Stato della serie di un animale per la validazione HTTP, o None se
+        l'animale non ha entry: (numero di entry, digest di id e valori,
+        epoch dell'entry più recente o None). Cambia a ogni entry aggiunta,
+        eliminata o sostituita con valori diversi ed è lo stesso dopo un
+        riavvio.
+        """
+        self.store.refresh()
+        key = None if nome is None else nome.strip().lower()
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                return None
+            return (sum(series.activity.values()), series.digest,
+                    series.stamps[-1] if series.stamps else None)
+
+
+class PhotoRefIndex:
+    """
+    Conteggio dei riferimenti alle foto (blob per contenuto, condivisi tra
+    entry): numero di entry vive che citano ogni file in 'foto'. Mantenuto
+    dallo HistoryStore, quindi una entry eliminata, sostituita o compattata
+    rilascia i suoi riferimenti senza passaggi espliciti.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self.reset()
+        store.subscribe(self)
+
+    def reset(self):
+        """Azzera i conteggi (lo store li ripopola con add())"""
+        with self._lock:
+            self._refs = Counter()
+
+    def add(self, entry_id, meta):
+        """Un riferimento per ogni foto distinta della entry"""
+        photos = set(meta.get('f') or ())
+        if photos:
+            with self._lock:
+                self._refs.update(photos)
+
+    def add_many(self, items):
+        """Riferimenti di più entry (entry_id, meta) sotto un solo lock"""
+        with self._lock:
+            for _, meta in items:
+                self._refs.update(set(meta.get('f') or ()))
+
+    def remove(self, entry_id, meta):
+        """Rilascia i riferimenti della entry; a zero la foto resta al garbage collector"""
+        photos = set(meta.get('f') or ())
+        if photos:
+            with self._lock:
+                for filename in photos:
+                    self._refs[filename] -= 1
+                    if self._refs[filename] <= 0:
+                        del self._refs[filename]
+
+    def count(self, filename):
+        """Numero di entry che usano la foto"""
+        self.store.refresh()
+        with self._lock:
+            return self._refs.get(filename, 0)
+
+    def referenced(self):
+        """Insieme dei file foto usati da almeno una entry"""
+        self.store.refresh()
+        with self._lock:
+            return set(self._refs)
+
+    def info(self):
+        """Foto distinte e riferimenti totali"""
+        self.store.refresh()
+        with self._lock:
+            return {'photos': len(self._refs), 'references': sum(self._refs.values())}
+
+
+class _Animal:
+    """
+    Aggregati di un animale: visite (timestamp, id, nome, specie) e pesi
+    (timestamp, id, kg) ordinati per tempo, pesi ordinati per valore con la
+    loro somma, numero di visite con sintomi critici
+    """
+    __slots__ = ('visits', 'weighed', 'weights', 'weight_sum', 'critical')
+
+    def __init__(self):
+        self.visits = []
+        self.weighed = []
+        self.weights = []
+        self.weight_sum = 0.0
+        self.critical = 0
+
+
+def _extend_sorted(keys, added):
+    """Unisce a una lista ordinata nuovi elementi ordinati: accodati se successivi, altrimenti un sort"""
+    if not keys or keys[-1] <= added[0]:
+        keys.extend(added)
+    else:
+        keys.extend(added)
+        keys.sort()
+
+
+class AnimalRegistry:
+    """
+    Anagrafica degli animali (per nome, case-insensitive) con aggregati
+    aggiornati a ogni entry aggiunta o eliminata: visite, prima e ultima
+    visita, ultimo peso, peso minimo/massimo/medio e visite con sintomi
+    critici. Ogni aggregato si legge in O(1), senza scorrere lo storico.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self.reset()
+        store.subscribe(self)
+
+    def reset(self):
+        """Svuota l'anagrafica (lo store la ripopola con add())"""
+        with self._lock:
+            self._animals = {}
+
+    @staticmethod
+    def _rows(entry_id, meta):
+        """Chiave dell'animale, visita e (se presente) peso di una entry"""
+        timestamp = meta.get('t') or ''
+        visit = (timestamp, entry_id, (meta.get('n') or '').strip(), (meta.get('s') or '').strip())
+        peso = meta.get('p')
+        weighed = (timestamp, entry_id, peso) if peso and peso > 0 else None
+        return visit[2].lower(), visit, weighed
+
+    def add(self, entry_id, meta):
+        """Aggiunge una visita agli aggregati del suo animale"""
+        key, visit, weighed = self._rows(entry_id, meta)
+        with self._lock:
+            animal = self._animals.get(key)
+            if animal is None:
+                animal = self._animals[key] = _Animal()
+            insort(animal.visits, visit)
+            if weighed is not None:
+                insort(animal.weighed, weighed)
+                insort(animal.weights, weighed[2])
+                animal.weight_sum += weighed[2]
+            if meta.get('g'):
+                animal.critical += 1
+
+    def add_many(self, items):
+        """
+        Aggiunge più visite (entry_id, meta): ogni animale riceve le nuove
+        righe in un colpo solo, accodate o fuse con un unico ordinamento
+        """
+        new_rows = {}
+        with self._lock:
+            for entry_id, meta in items:
+                key, visit, weighed = self._rows(entry_id, meta)
+                animal = self._animals.get(key)
+                if animal is None:
+                    animal = self._animals[key] = _Animal()
+                visits, weighed_rows = new_rows.setdefault(key, ([], []))
+                visits.append(visit)
+                if weighed is not None:
+                    weighed_rows.append(weighed)
+                if meta.get('g'):
+                    animal.critical += 1
+            for key, (visits, weighed_rows) in new_rows.items():
+                animal = self._animals[key]
+                visits.sort()
+                _extend_sorted(animal.visits, visits)
+                if weighed_rows:
+                    weighed_rows.sort()
+                    _extend_sorted(animal.weighed, weighed_rows)
+                    weights = sorted(row[2] for row in weighed_rows)
+                    _extend_sorted(animal.weights, weights)
+                    animal.weight_sum += sum(weights)
+
+    def remove(self, entry_id, meta):
+        """Toglie una visita dagli aggregati; l'animale sparisce con l'ultima visita"""
+        key, visit, weighed = self._rows(entry_id, meta)
+        with self._lock:
+            animal = self._animals.get(key)
+            if animal is None:
+                return
+            position = bisect_left(animal.visits, visit)
+            if position < len(animal.visits) and animal.visits[position] == visit:
+                del animal.visits[position]
+            if weighed is not None:
+                position = bisect_left(animal.weighed, weighed)
+                if position < len(animal.weighed) and animal.weighed[position] == weighed:
+                    del animal.weighed[position]
+                    del animal.weights[bisect_left(animal.weights, weighed[2])]
+                    animal.weight_sum -= weighed[2]
+            if meta.get('g'):
+                animal.critical -= 1
+            if not animal.visits:
+                del self._animals[key]
+
+    @staticmethod
+    def _summary(animal):
+        """Aggregati di un animale come dizionario (nome e specie dall'ultima visita)"""
+        first, last = animal.visits[0], animal.visits[-1]
+        weights = animal.weights
+        return {
+            'nome': last[2],
+            'specie': last[3],
+            'visite': len(animal.visits),
+            'prima_visita': first[0],
+            'ultima_visita': last[0],
+            'ultima_entry': last[1],
+            'peso_attuale': animal.weighed[-1][2] if animal.weighed else None,
+            'peso_min': weights[0] if weights else None,
+            'peso_max': weights[-1] if weights else None,
+            'peso_medio': round(animal.weight_sum / len(weights), 2) if weights else None,
+            'visite_critiche': animal.critical,
+        }
+
+    def get(self, nome):
+        """Aggregati di un animale, o None se non ha visite"""
+        self.store.refresh()
+        with self._lock:
+            animal = self._animals.get((nome or '').strip().lower())
+            return self._summary(animal) if animal is not None else None
+
+    def count(self):
+        """Numero di animali distinti"""
+        self.store.refresh()
+        with self._lock:
+            return len(self._animals)
+
+    def all(self, specie=None):
+        """Aggregati di tutti gli animali (eventualmente di una specie), in ordine di nome"""
+        self.store.refresh()
+        specie = (specie or '').strip().lower()
+        with self._lock:
+            summaries = [self._summary(animal) for _, animal in sorted(self._animals.items())]
+        if specie:
+            summaries = [summary for summary in summaries if summary['specie'].lower() == specie]
+        return summaries
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ID generator for Animal Health Diary webapp
+Id univoci e ordinabili per entry, foto ed esportazioni
+"""
+import os
+import threading
+from datetime import datetime, timedelta
+
+_lock = threading.Lock()
+_last = None
+
+
+def _format(moment):
+    """Timestamp al microsecondo + pid a larghezza fissa (ordinabile come stringa)"""
+    return f"{moment.strftime('%Y%m%d_%H%M%S_%f')}_{os.getpid():06x}"
+
+
+def new_id(moment=None, taken=None):
+    """
+    Genera un id univoco e ordinabile, es. 20250101_120000_123456_00a1b2
+
+    Nello stesso processo gli id sono strettamente crescenti: se l'orologio
+    non avanza (o torna indietro) si usa il microsecondo successivo all'ultimo
+    id emesso. Il pid distingue processi diversi nello stesso microsecondo.
+
+    Args:
+        moment: Istante da usare al posto dell'ora corrente (es. dati storici)
+        taken: Insieme di id già usati da evitare (solo con moment)
+    """
+    global _last
+    if moment is not None:
+        candidate = _format(moment)
+        while taken is not None and candidate in taken:
+            moment += timedelta(microseconds=1)
+            candidate = _format(moment)
+        return candidate
+
+    with _lock:
+        now = datetime.now()
+        if _last is not None and now <= _last:
+            now = _last + timedelta(microseconds=1)
+        _last = now
+    return _format(now)
+
+
+def dedupe_ids(entries):
+    """
+    Assegna un nuovo id alle entry con id già visto (in ordine cronologico),
+    derivandolo dal loro timestamp per mantenerne l'ordinamento.
+    Ritorna il numero di id riscritti.
+    """
+    seen = set()
+    rewritten = 0
+    for entry in entries:
+        if entry['id'] in seen:
+            try:
+                moment = datetime.fromisoformat(entry.get('timestamp', ''))
+            except (TypeError, ValueError):
+                moment = datetime.now()
+            entry['id'] = new_id(moment, taken=seen)
+            rewritten += 1
+        seen.add(entry['id'])
+    return rewritten
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Bulk import for Animal Health Diary webapp
+Importazione di storici esistenti (CSV, JSON, JSONL) a blocchi, con analisi AI opzionale e differita
+"""
+import os
+import sys
+import csv
+import json
+import argparse
+from datetime import datetime
+
+# Directory parent nel path per le colonne e la validazione della CLI batch
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from animal_diary_batch import COLONNE_CSV, valida_record, analizza_batch
+from ids import new_id
+
+FORMATS = ('csv', 'json', 'jsonl')
+
+# Entry scritte con una sola write + fsync
+DEFAULT_BATCH_SIZE = 5000
+
+# Errori di validazione riportati nel risultato (gli altri sono solo contati)
+MAX_ERRORS = 100
+
+
+def guess_format(filename, default='jsonl'):
+    """Formato dall'estensione del file (csv, json, jsonl)"""
+    extension = os.path.splitext(filename or '')[1].lower().lstrip('.')
+    return extension if extension in FORMATS else default
+
+
+def _json_array(f, block_size=64 * 1024):
+    """
+    Elementi di un array JSON letti a blocchi, senza caricare il file
+    intero. Un errore di sintassi interrompe la lettura (ValueError).
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(block_size).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError("JSON: atteso un array di entry")
+    position = 1
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position == len(buffer):
+                raise ValueError("fine del blocco")
+            item, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # Elemento a cavallo del blocco: si legge il successivo e si riprova
+            more = f.read(block_size)
+            if not more:
+                raise ValueError("JSON troncato o non valido")
+            buffer, position = buffer[position:] + more, 0
+            continue
+        yield item
+        position = end
+        if position > block_size:
+            buffer, position = buffer[position:], 0
+
+
+def read_rows(f, fmt):
+    """
+    Righe da un file di testo aperto: CSV con le colonne di
+    DataExporter.export_to_csv (o i nomi dei campi), array JSON o JSONL di
+    entry dello storico o di dizionari dati.
+
+    Yields:
+        (numero di riga, record) con record dizionario o ValueError se la
+        riga non è leggibile (solo JSONL: le altre righe proseguono)
+    """
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(f), start=1):
+            yield number, {COLONNE_CSV.get(column, column): value for column, value in row.items()}
+    elif fmt == 'json':
+        yield from enumerate(_json_array(f), start=1)
+    else:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError as e:
+                yield number, ValueError(f"JSON non valido: {e}")
+
+
+def _timestamp(record, dati):
+    """Timestamp ISO dell'entry: quello dell'export, o la data della visita, o adesso"""
+    # fromisoformat accetta anche il formato della webapp "YYYY-MM-DD HH:MM"
+    for value in (record.get('timestamp'), dati['data']):
+        if value:
+            try:
+                return datetime.fromisoformat(value).isoformat()
+            except (TypeError, ValueError):
+                continue
+    return datetime.now().isoformat()
+
+
+def _photos(value):
+    """Riferimenti alle foto di un'entry esportata (lista di nomi di file)"""
+    if not value:
+        return []
+    if not isinstance(value, list) or not all(
+            isinstance(name, str) and name and '/' not in name and '\\' not in name and not name.startswith('.')
+            for name in value):
+        raise ValueError("Campo foto non valido: attesa una lista di nomi di file")
+    return value
+
+
+def entry_from_record(record):
+    """
+    Entry dello storico da un record importato (ValueError se non valido).
+    L'id del record viene mantenuto, così reimportare lo stesso file non
+    duplica le entry; anche i riferimenti alle foto ('foto') restano quelli
+    dell'export. L'analisi AI resta vuota se assente.
+    """
+    if not isinstance(record, dict):
+        raise ValueError("Record non valido: atteso un oggetto")
+    if isinstance(record.get('dati'), dict):
+        record = dict(record['dati'], id=record.get('id'), timestamp=record.get('timestamp'),
+                      analisi_ai=record.get('analisi_ai'), foto=record.get('foto'))
+    try:
+        dati = valida_record(record)
+    except (TypeError, ValueError) as e:
+        raise ValueError(str(e)) from e
+    entry = {
+        'id': str(record.get('id') or new_id()),
+        'dati': dati,
+        'analisi_ai': str(record.get('analisi_ai') or ''),
+        'timestamp': _timestamp(record, dati),
+    }
+    photos = _photos(record.get('foto'))
+    if photos:
+        entry['foto'] = photos
+    return entry
+
+
+def import_rows(store, rows, batch_size=DEFAULT_BATCH_SIZE, replace=False, pending=None):
+    """
+    Valida le righe in un solo passaggio e le scrive nello storico a
+    blocchi di batch_size entry (una write e un fsync per blocco). Le righe
+    non valide vengono saltate e riportate.
+
+    Args:
+        store: HistoryStore di destinazione
+        rows: Iterabile di (numero di riga, record) come da read_rows()
+        batch_size: Entry per blocco
+        replace: Sostituisce le entry con lo stesso id già nello storico
+                 (default: saltate, es. reimport dopo un'interruzione)
+        pending: Lista in cui aggiungere gli id importati senza analisi AI
+
+    Returns:
+        Dizionario con imported, skipped, duplicates (id ripetuti nel file:
+        vale la prima riga), invalid, without_analysis, errors (primi
+        MAX_ERRORS come {'row', 'error'}) ed eventuale fatal_error se la
+        lettura si è interrotta (i blocchi precedenti restano scritti)
+    """
+    result = {'imported': 0, 'skipped': 0, 'duplicates': 0, 'invalid': 0, 'without_analysis': 0, 'errors': []}
+    batch = []
+    seen = set()
+
+    def write(batch):
+        if not replace:
+            existing = store.existing(entry['id'] for entry in batch)
+            if existing:
+                result['skipped'] += len(existing)
+                batch = [entry for entry in batch if entry['id'] not in existing]
+        for entry in batch:
+            if not entry['analisi_ai']:
+                result['without_analysis'] += 1
+                if pending is not None:
+                    pending.append(entry['id'])
+        result['imported'] += store.append_many(batch)
+
+    def report(number, error):
+        if len(result['errors']) < MAX_ERRORS:
+            result['errors'].append({'row': number, 'error': str(error)})
+
+    def invalid(number, error):
+        result['invalid'] += 1
+        report(number, error)
+
+    try:
+        for number, record in rows:
+            if isinstance(record, ValueError):
+                invalid(number, record)
+                continue
+            try:
+                entry = entry_from_record(record)
+            except ValueError as e:
+                invalid(number, e)
+                continue
+            if entry['id'] in seen:
+                result['duplicates'] += 1
+                report(number, f"Id duplicato nel file: {entry['id']}")
+                continue
+            seen.add(entry['id'])
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = []
+    except (ValueError, csv.Error, UnicodeDecodeError) as e:
+        result['fatal_error'] = str(e)
+    write(batch)
+    return result
+
+
+def analyze_pending(store, entry_ids, api, workers=4, batch_size=100):
+    """
+    Analisi AI differita delle entry importate senza analisi, con la
+    concorrenza della CLI batch e i limiti al minuto, i ritentativi e i
+    budget di api.limiti. Le entry analizzate (solo quelle riuscite)
+    vengono riscritte (stesso id) a blocchi.
+
+    Returns:
+        Dizionario {'ok', 'error', 'invalid'} con i conteggi
+    """
+    def records():
+        for start in range(0, len(entry_ids), batch_size):
+            for entry in store.get_many(entry_ids[start:start + batch_size]):
+                yield entry['id'], entry['dati']
+
+    counts = {'ok': 0, 'error': 0, 'invalid': 0}
+    analyses = {}
+
+    def save():
+        entries = store.get_many(list(analyses))
+        store.append_many([dict(entry, analisi_ai=analyses[entry['id']]) for entry in entries])
+        analyses.clear()
+
+    for result in analizza_batch(api, records(), workers=workers):
+        counts[result['status']] += 1
+        if result['status'] == 'ok':
+            analyses[result['id']] = result['analisi_ai']
+            if len(analyses) >= batch_size:
+                save()
+    if analyses:
+        save()
+    return counts
+
+
+def main():
+    """Importazione da riga di comando nello storico della webapp"""
+    from storage import HistoryStore
+
+    parser = argparse.ArgumentParser(description="Importa uno storico CSV/JSON/JSONL nella webapp")
+    parser.add_argument('input', help="File CSV (export della webapp), JSON o JSONL")
+    parser.add_argument('--format', choices=FORMATS, help="Formato (default: dall'estensione)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help="Entry per scrittura")
+    parser.add_argument('--replace', action='store_true',
+                        help="Sostituisce le entry con lo stesso id (default: saltate)")
+    parser.add_argument('--analizza', action='store_true',
+                        help="Dopo l'import, analisi AI delle entry che non ne hanno una")
+    parser.add_argument('-w', '--workers', type=int, default=4, help="Richieste AI concorrenti")
+    parser.add_argument('--rpm', type=int, default=None, help="Limite di richieste AI al minuto (default AI_RPM)")
+    args = parser.parse_args()
+
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    store = HistoryStore(os.path.join(data_dir, 'health_history.jsonl'))
+
+    pending = [] if args.analizza else None
+    fmt = args.format or guess_format(args.input)
+    with open(args.input, 'r', encoding='utf-8', newline='') as f:
+        result = import_rows(store, read_rows(f, fmt), batch_size=args.batch_size,
+                             replace=args.replace, pending=pending)
+
+    for error in result['errors']:
+        print(f"❌ Riga {error['row']}: {error['error']}", file=sys.stderr)
+    if result.get('fatal_error'):
+        print(f"❌ Lettura interrotta: {result['fatal_error']}", file=sys.stderr)
+    print(f"✅ Importate: {result['imported']}  Già presenti: {result['skipped']}  "
+          f"Duplicate nel file: {result['duplicates']}  Non valide: {result['invalid']}  "
+          f"Senza analisi AI: {result['without_analysis']}")
+
+    if pending:
+        from animal_diary_api import AnimalHealthDiaryAPI
+        from triage import Triage
+        from rate_limits import LimitiAI
+        try:
+            limits = LimitiAI.from_env(default_db=os.path.join(data_dir, 'ai_usage.sqlite3'),
+                                       richieste_al_minuto=args.rpm)
+            api = AnimalHealthDiaryAPI(triage=Triage.from_env(), limiti=limits)
+        except ValueError as e:
+            print(f"\n❌ Errore: {str(e)}")
+            return 1
+        counts = analyze_pending(store, pending, api, workers=args.workers)
+        print(f"🤖 Analizzate: {counts['ok']}  Errori: {counts['error']}")
+    return 0 if not result.get('fatal_error') else 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
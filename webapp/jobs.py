@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background jobs for Animal Health Diary webapp
+Coda limitata di job (analisi AI) eseguiti da un pool di thread
+"""
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from ids import new_id
+
+
+class QueueFullError(Exception):
+    """La coda dei job ha raggiunto la profondità massima"""
+
+
+class JobTimeoutError(Exception):
+    """Sollevata da un job che si interrompe perché oltre il tempo massimo"""
+
+
+class JobQueue:
+    """
+    Pool di worker con coda limitata: submit() ritorna subito l'id del job,
+    il risultato si legge con get() (polling) o attendendo con wait().
+    I job in streaming pubblicano frammenti parziali leggibili con stream().
+
+    Un job resta in coda al massimo `timeout` secondi: oltre viene marcato
+    come scaduto senza essere eseguito. In esecuzione il timeout è
+    cooperativo: i job cancellable ricevono cancelled=callable, vero oltre
+    `timeout` secondi dall'avvio, e terminano sollevando JobTimeoutError
+    (stato 'timeout'); il timeout della chiamata vera e propria resta
+    responsabilità della funzione eseguita (es. timeout HTTP).
+    """
+
+    def __init__(self, max_workers=4, max_queue=32, timeout=60, ttl=600):
+        """
+        Args:
+            max_workers: Job eseguiti in parallelo
+            max_queue: Job in attesa oltre a quelli in esecuzione
+            timeout: Secondi massimi di attesa in coda (e di esecuzione attesa)
+            ttl: Secondi per cui un job concluso resta consultabile
+        """
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._chunks = {}
+        self._conditions = {}
+
+    def submit(self, fn, *args, streaming=False, cancellable=False, **kwargs):
+        """
+        Accoda fn(*args, **kwargs); QueueFullError se la coda è piena.
+        Con streaming=True fn riceve anche emit=callable per pubblicare
+        frammenti parziali del risultato, con cancellable=True
+        cancelled=callable per sapere se ha superato il tempo massimo.
+        """
+        if not self._slots.acquire(blocking=False):
+            raise QueueFullError("Troppe analisi in corso, riprovare tra poco")
+        self._prune()
+        job = {
+            'id': new_id(),
+            'status': 'queued',
+            'result': None,
+            'error': None,
+            'created': time.time(),
+            'started': None,
+            'finished': None,
+        }
+        with self._lock:
+            self._jobs[job['id']] = job
+            self._chunks[job['id']] = []
+            self._conditions[job['id']] = threading.Condition()
+        if streaming:
+            kwargs['emit'] = lambda chunk: self._emit(job['id'], chunk)
+        if cancellable:
+            kwargs['cancelled'] = lambda: self._expired(job)
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        return job['id']
+
+    def _emit(self, job_id, chunk):
+        """Pubblica un frammento parziale e sveglia i lettori in streaming"""
+        condition = self._conditions[job_id]
+        with condition:
+            self._chunks[job_id].append(chunk)
+            condition.notify_all()
+
+    def _expired(self, job):
+        """Job in esecuzione da più di timeout secondi"""
+        return job['started'] is not None and time.time() - job['started'] > self.timeout
+
+    def _run(self, job, fn, args, kwargs):
+        """Esegue un job aggiornandone lo stato"""
+        try:
+            if time.time() - job['created'] > self.timeout:
+                job['status'] = 'timeout'
+                job['error'] = "Tempo massimo di attesa in coda superato"
+                return
+            job['started'] = time.time()
+            job['status'] = 'running'
+            try:
+                job['result'] = fn(*args, **kwargs)
+                job['status'] = 'done'
+            except JobTimeoutError as e:
+                job['error'] = str(e) or "Analisi oltre il tempo massimo"
+                job['status'] = 'timeout'
+            except Exception as e:
+                job['error'] = str(e)
+                job['status'] = 'error'
+        finally:
+            self._slots.release()
+            condition = self._conditions[job['id']]
+            with condition:
+                job['finished'] = time.time()
+                condition.notify_all()
+
+    def _prune(self):
+        """Rimuove i job conclusi da più di ttl secondi"""
+        limit = time.time() - self.ttl
+        with self._lock:
+            expired = [job_id for job_id, job in self._jobs.items()
+                       if job['finished'] and job['finished'] < limit]
+            for job_id in expired:
+                del self._jobs[job_id]
+                del self._chunks[job_id]
+                del self._conditions[job_id]
+
+    def get(self, job_id):
+        """Copia dello stato di un job (None se sconosciuto)"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        job = dict(job)
+        if job['status'] == 'running' and self._expired(job):
+            job['status'] = 'timeout'
+            job['error'] = "Analisi oltre il tempo massimo"
+        return job
+
+    def wait(self, job_id, timeout=None):
+        """Attende la fine di un job; True se concluso entro timeout"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return True
+        condition = self._conditions[job_id]
+        with condition:
+            return condition.wait_for(lambda: job['finished'], timeout)
+
+    def stream(self, job_id, keepalive=15):
+        """
+        Genera i frammenti pubblicati da un job in streaming, dall'inizio e
+        fino alla sua conclusione. Genera None ogni `keepalive` secondi senza
+        novità, così il chiamante può mantenere viva la connessione.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        condition = self._conditions[job_id]
+        chunks = self._chunks[job_id]
+        sent = 0
+        while True:
+            with condition:
+                condition.wait_for(lambda: len(chunks) > sent or job['finished'], keepalive)
+                new_chunks = chunks[sent:]
+                finished = job['finished']
+            sent += len(new_chunks)
+            if new_chunks:
+                yield from new_chunks
+            elif not finished:
+                yield None
+            if finished and sent == len(chunks):
+                return
+
+    def stats(self):
+        """Job in coda/in esecuzione e limiti configurati"""
+        with self._lock:
+            statuses = [job['status'] for job in self._jobs.values()]
+        return {
+            'queued': statuses.count('queued'),
+            'running': statuses.count('running'),
+            'max_workers': self.max_workers,
+            'max_queue': self.max_queue,
+        }
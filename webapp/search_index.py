@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Full-text search for Animal Health Diary webapp
+Indice di ricerca (SQLite FTS5) su sintomi, note e analisi AI, allineato allo storico
+"""
+import re
+import html
+import sqlite3
+import threading
+import unicodedata
+
+from storage import entry_meta
+
+# Parole escluse dalle query (articoli, preposizioni, congiunzioni)
+STOPWORDS = frozenset('''
+    a ad al alla alle agli ai all allo anche c che chi ci con col da dal dalla dalle dai dagli dall
+    dallo de degli dei del della delle dell dello di e ed gli ha ho i il in l la le lo ma mi ne nei
+    nel nella nelle nell nello negli no non o per piu poi se si sono su sul sulla sulle sui sugli
+    sull sullo tra fra un una uno ve vi
+'''.split())
+
+# Desinenze rimosse per cercare tutte le forme di una parola (vomito, vomitare, vomiti)
+SUFFIXES = ('are', 'ere', 'ire', 'a', 'e', 'i', 'o')
+
+# Peso delle colonne nel ranking BM25: sintomi, note, analisi AI
+WEIGHTS = (4.0, 2.0, 1.0)
+
+# Marcatori dei termini trovati negli estratti (sostituiti da <mark>)
+_OPEN, _CLOSE = '\x02', '\x03'
+
+_TOKEN = re.compile(r'"([^"]*)"|([^\W_]+)')
+_WORD = re.compile(r'[^\W_]+')
+
+
+def fold(text):
+    """Minuscolo senza accenti né segni diacritici (perché -> perche)"""
+    decomposed = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).lower()
+
+
+def stem(word):
+    """
+    Radice approssimata di una parola italiana: senza vocale finale o
+    desinenza dell'infinito, se resta una radice di almeno 4 lettere
+    (convulsioni -> convulsion, vomitare -> vomit)
+    """
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 4:
+            return word[:-len(suffix)]
+    return word
+
+
+def build_query(text):
+    """
+    Espressione MATCH di FTS5 da una ricerca libera: ogni parola (senza
+    stopword) diventa una ricerca per prefisso della sua radice, i testi tra
+    virgolette una frase esatta. Tutti i termini devono comparire.
+    Ritorna None se non resta alcun termine.
+    """
+    terms = []
+    for phrase, word in _TOKEN.findall(text or ''):
+        if phrase:
+            words = _WORD.findall(fold(phrase))
+            if words:
+                terms.append('"' + ' '.join(words) + '"')
+        else:
+            word = fold(word)
+            if word in STOPWORDS:
+                continue
+            root = stem(word)
+            # Prefissi molto corti troverebbero quasi tutto: parola esatta
+            terms.append(f'"{root}"*' if len(root) >= 3 else f'"{word}"')
+    return ' '.join(terms) or None
+
+
+def highlight(snippet):
+    """Estratto in HTML sicuro, con i termini trovati in <mark>"""
+    return html.escape(snippet).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+class SearchIndex:
+    """
+    Indice full-text delle entry su SQLite FTS5 (tokenizer unicode61 senza
+    diacritici), salvato su file accanto allo storico.
+
+    Registrato sullo HistoryStore come gli altri indici secondari: add() e
+    remove() annotano solo gli id cambiati, confrontando l'impronta del
+    testo nei metadati ('h'). sync() rilegge dallo store le sole entry
+    cambiate e aggiorna le tabelle; dopo un riavvio vengono reindicizzate
+    solo le entry diverse da quelle già nel file.
+    """
+
+    def __init__(self, store, db_path, batch_size=500):
+        """
+        Args:
+            store: HistoryStore da indicizzare
+            db_path: File SQLite dell'indice
+            batch_size: Entry lette e scritte per transazione durante sync()
+        """
+        self.store = store
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        # Connessione condivisa tra i thread: un uso alla volta
+        self._db_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._syncer = None
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        # WAL: le ricerche non aspettano gli aggiornamenti (anche di altri processi)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(documenti)")}
+        if columns and 'etichetta' not in columns:
+            # Indice di una versione precedente (solo il nome normalizzato):
+            # si ricostruisce dallo storico alla prima sync()
+            self._db.execute("DROP TABLE documenti")
+            self._db.execute("DROP TABLE IF EXISTS testi")
+        # nome e specie normalizzati per i filtri, etichetta come scritta dall'utente
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS documenti ("
+            " rowid INTEGER PRIMARY KEY, entry_id TEXT UNIQUE NOT NULL, impronta INTEGER NOT NULL,"
+            " nome TEXT NOT NULL, etichetta TEXT NOT NULL, specie TEXT NOT NULL, timestamp TEXT NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS documenti_nome ON documenti (nome)")
+        self._db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS testi USING fts5("
+            " sintomi, note, analisi, tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        self._db.commit()
+        # Entry nel file, mantenuto da sync() per non contarle a ogni info()
+        self._indexed = self._db.execute("SELECT COUNT(*) FROM documenti").fetchone()[0]
+        self.reset()
+        store.subscribe(self)
+
+    def reset(self):
+        """Lo storico è stato ricaricato: alla prossima sync() si confronta tutto"""
+        with self._lock:
+            self._expected = {}
+            self._dirty = None
+
+    def add(self, entry_id, meta):
+        """Annota una entry nuova o modificata"""
+        with self._lock:
+            self._expected[entry_id] = meta.get('h')
+            if self._dirty is not None:
+                self._dirty.add(entry_id)
+
+    def add_many(self, items):
+        """Annota più entry (entry_id, meta) sotto un solo lock"""
+        with self._lock:
+            for entry_id, meta in items:
+                self._expected[entry_id] = meta.get('h')
+                if self._dirty is not None:
+                    self._dirty.add(entry_id)
+
+    def remove(self, entry_id, meta):
+        """Annota una entry eliminata o sostituita"""
+        with self._lock:
+            self._expected.pop(entry_id, None)
+            if self._dirty is not None:
+                self._dirty.add(entry_id)
+
+    def _changes(self):
+        """
+        Id da reindicizzare e da togliere dall'indice: confrontati tutti dopo
+        un reset(), altrimenti solo quelli annotati dall'ultima sync()
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            if dirty is None:
+                expected = dict(self._expected)
+            else:
+                expected = {entry_id: self._expected.get(entry_id) for entry_id in dirty}
+        with self._db_lock:
+            if dirty is None:
+                indexed = dict(self._db.execute("SELECT entry_id, impronta FROM documenti"))
+            else:
+                indexed = {}
+                ids = list(dirty)
+                for start in range(0, len(ids), self.batch_size):
+                    chunk = ids[start:start + self.batch_size]
+                    indexed.update(self._db.execute(
+                        f"SELECT entry_id, impronta FROM documenti WHERE entry_id IN ({','.join('?' * len(chunk))})",
+                        chunk))
+        stale = [entry_id for entry_id, digest in indexed.items() if expected.get(entry_id) != digest]
+        missing = [entry_id for entry_id, digest in expected.items()
+                   if digest is not None and indexed.get(entry_id) != digest]
+        return missing, stale
+
+    def _delete(self, entry_ids):
+        """Toglie le entry dalle due tabelle (senza commit); ritorna quante erano indicizzate"""
+        removed = 0
+        for start in range(0, len(entry_ids), self.batch_size):
+            chunk = entry_ids[start:start + self.batch_size]
+            placeholders = ','.join('?' * len(chunk))
+            self._db.execute(
+                f"DELETE FROM testi WHERE rowid IN (SELECT rowid FROM documenti WHERE entry_id IN ({placeholders}))",
+                chunk)
+            removed += self._db.execute(f"DELETE FROM documenti WHERE entry_id IN ({placeholders})", chunk).rowcount
+        return removed
+
+    def _insert(self, entries):
+        """Indicizza le entry lette dallo store (senza commit)"""
+        for entry in entries:
+            dati = entry.get('dati') or {}
+            meta = entry_meta(entry)
+            name = (meta['n'] or '').strip()
+            cursor = self._db.execute(
+                "INSERT INTO documenti (entry_id, impronta, nome, etichetta, specie, timestamp)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (entry['id'], meta['h'], name.lower(), name, (meta['s'] or '').strip().lower(), meta['t'] or ''))
+            self._db.execute(
+                "INSERT INTO testi (rowid, sintomi, note, analisi) VALUES (?, ?, ?, ?)",
+                (cursor.lastrowid, str(dati.get('sintomi') or ''), str(dati.get('note') or ''),
+                 str(entry.get('analisi_ai') or '')))
+
+    def sync(self, blocking=True):
+        """
+        Allinea l'indice allo storico: rilegge e reindicizza le entry
+        cambiate, a blocchi di batch_size per transazione. Con
+        blocking=False, se un'altra sync() è in corso ritorna subito.
+
+        Returns:
+            Numero di entry aggiornate o eliminate (None se saltata)
+        """
+        if not self._sync_lock.acquire(blocking=blocking):
+            return None
+        try:
+            self.store.refresh()
+            missing, stale = self._changes()
+            with self._db_lock:
+                with self._db:
+                    removed = self._delete(stale)
+                self._indexed -= removed
+            for start in range(0, len(missing), self.batch_size):
+                chunk = missing[start:start + self.batch_size]
+                entries = self.store.get_many(chunk)
+                with self._db_lock:
+                    with self._db:
+                        # Una entry cambiata dopo _changes() è di nuovo annotata:
+                        # viene indicizzata com'è ora e ricontrollata alla prossima sync()
+                        removed = self._delete(chunk)
+                        self._insert(entries)
+                    # Il contatore cambia solo a transazione confermata
+                    self._indexed += len(entries) - removed
+            return len(missing) + len(stale)
+        finally:
+            self._sync_lock.release()
+
+    def sync_in_background(self):
+        """sync() in un thread separato (avvio, import), se non ne è già in corso una"""
+        with self._lock:
+            if self._syncer is None or not self._syncer.is_alive():
+                self._syncer = threading.Thread(target=self.sync, daemon=True)
+                self._syncer.start()
+
+    def search(self, query, nome=None, specie=None, limit=20, offset=0):
+        """
+        Entry che contengono tutti i termini della ricerca, dalla più
+        pertinente (BM25, con sintomi e note più importanti dell'analisi).
+
+        Args:
+            query: Testo libero; "frase esatta" tra virgolette
+            nome, specie: Filtri esatti (case-insensitive)
+            limit, offset: Paginazione
+
+        Returns:
+            (risultati, altri risultati disponibili) con risultati lista di
+            dizionari id, nome, specie, timestamp, score, snippet (HTML)
+        """
+        match = build_query(query)
+        if match is None:
+            return [], False
+        # Le modifiche recenti si applicano prima di cercare; se un'altra
+        # sync() (es. la prima indicizzazione) è in corso si usa l'indice attuale
+        self.sync(blocking=False)
+
+        sql = (
+            "SELECT d.entry_id, d.etichetta, d.specie, d.timestamp, bm25(testi, ?, ?, ?) AS rank,"
+            " snippet(testi, -1, ?, ?, '…', 16)"
+            " FROM testi JOIN documenti d ON d.rowid = testi.rowid WHERE testi MATCH ?"
+        )
+        params = [*WEIGHTS, _OPEN, _CLOSE, match]
+        if nome:
+            sql += " AND d.nome = ?"
+            params.append(nome.strip().lower())
+        if specie:
+            sql += " AND d.specie = ?"
+            params.append(specie.strip().lower())
+        sql += " ORDER BY rank LIMIT ? OFFSET ?"
+        params += [limit + 1, offset]
+
+        try:
+            with self._db_lock:
+                rows = self._db.execute(sql, params).fetchall()
+        except sqlite3.OperationalError as e:
+            raise ValueError(f"Ricerca non valida: {query}") from e
+        results = [{
+            'id': entry_id,
+            'nome': animal,
+            'specie': species,
+            'timestamp': timestamp,
+            'score': round(-rank, 3),
+            'snippet': highlight(snippet),
+        } for entry_id, animal, species, timestamp, rank, snippet in rows[:limit]]
+        return results, len(rows) > limit
+
+    def info(self):
+        """Entry indicizzate e in attesa di indicizzazione (senza interrogare il database)"""
+        with self._lock:
+            pending = len(self._expected) if self._dirty is None else len(self._dirty)
+        with self._db_lock:
+            indexed = self._indexed
+        return {'indexed': indexed, 'pending': pending}
@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+History storage for Animal Health Diary webapp
+Storico visite su log append-only (JSONL) con indice per id e compattazione periodica
+"""
+import os
+import sys
+import json
+import zlib
+import threading
+from contextlib import contextmanager
+
+from ids import dedupe_ids
+
+# Directory parent nel path per symptom_matcher e metrics
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from symptom_matcher import classifica_sintomi
+from metrics import REGISTRO
+
+try:
+    import fcntl  # Lock tra processi (solo POSIX)
+except ImportError:
+    fcntl = None
+
+# Versione del formato dei metadati nell'indice (entry_meta)
+INDEX_VERSION = 5
+
+# Durata delle operazioni sullo storico (esportata su /metrics)
+OPERATION_SECONDS = REGISTRO.istogramma(
+    'animal_diary_history_operation_seconds',
+    "Durata delle operazioni sullo storico (load, append, refresh dal disco, riscritture)",
+    ('operation',))
+
+
+def _fsync_dir(path):
+    """Rende durevole un rename/replace sincronizzando la directory (POSIX)"""
+    if os.name != 'posix':
+        return
+    fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _encode(record):
+    """Serializza un record come singola riga JSONL"""
+    return (json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+def text_digest(entry):
+    """crc32 dei testi ricercabili (sintomi, note, analisi AI): cambia quando cambiano"""
+    dati = entry.get('dati') or {}
+    text = '\0'.join(str(value or '') for value in (dati.get('sintomi'), dati.get('note'), entry.get('analisi_ai')))
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def entry_meta(entry):
+    """
+    Metadati compatti di una entry salvati nell'indice, usati dagli indici
+    secondari senza deserializzare l'entry completa
+    """
+    dati = entry.get('dati') or {}
+    try:
+        peso = float(dati.get('peso'))
+    except (TypeError, ValueError):
+        peso = None
+    meta = {
+        't': entry.get('timestamp', ''),
+        'n': dati.get('nome', ''),
+        's': dati.get('specie', ''),
+        'p': peso,
+        'a': dati.get('attivita'),
+        'h': text_digest(entry),
+    }
+    if entry.get('foto'):
+        meta['f'] = list(entry['foto'])
+    if classifica_sintomi(dati.get('sintomi'))['gravita'] == 'grave':
+        meta['g'] = 1  # Visita con sintomi critici
+    return meta
+
+
+def _index_line(op, entry_id, offset, length, meta=None):
+    """
+    Riga del file indice: op, id, offset e lunghezza del record nel log,
+    metadati. Op 'gap' (id '-') copre un tratto di record morti in un indice
+    ricostruito, con il loro numero nei metadati ('r')
+    """
+    meta = json.dumps(meta or {}, ensure_ascii=False, separators=(',', ':'))
+    return f"{op}\t{entry_id}\t{offset}\t{length}\t{meta}\n".encode('utf-8')
+
+
+class HistoryStore:
+    """
+    Storico visite su file JSONL append-only.
+
+    Ogni riga del log è un record:
+        {"op": "add", "entry": {...}}   nuova entry (o sostituzione per stesso id)
+        {"op": "del", "id": "..."}      tombstone di cancellazione
+
+    Accanto al log viene mantenuto un indice (<log>.idx) con offset e lunghezza
+    di ogni record: conteggi e ricerche per id non deserializzano le entry, e
+    una get() legge dal disco solo il record richiesto. L'indice è una cache
+    del log: se manca o non è allineato viene ricostruito.
+
+    Gli indici secondari si registrano con subscribe() e ricevono reset(),
+    add(entry_id, meta) e remove(entry_id, meta) a ogni variazione, anche
+    quando le scritture arrivano da altri processi. Se definiscono
+    add_many(items) le entry lette o scritte insieme (ricarica, import a
+    blocchi) arrivano in un'unica chiamata.
+
+    Le scritture sono append O(1) con fsync; le cancellazioni accodano un
+    tombstone e la compattazione (in background) riscrive solo le entry vive
+    su file temporaneo, sostituendolo atomicamente.
+    """
+
+    def __init__(self, path, compact_ratio=0.5, compact_min_records=200):
+        """
+        Args:
+            path: Percorso del file JSONL
+            compact_ratio: Frazione di record morti oltre cui compattare
+            compact_min_records: Numero minimo di record prima di compattare
+        """
+        self.path = path
+        self.index_path = path + '.idx'
+        self.lock_path = path + '.lock'
+        self.compact_ratio = compact_ratio
+        self.compact_min_records = compact_min_records
+        self._lock = threading.RLock()
+        self._compactor = None
+        self._subscribers = []
+        # Stato in memoria, allineato al log tramite (device, inode), mtime e
+        # byte letti: id -> (offset, lunghezza) in ordine di inserimento, più
+        # le entry già deserializzate
+        self._index = None
+        self._entries = {}
+        self._meta = {}
+        self._stat_key = None
+        self._log_end = 0
+        self._idx_offset = 0
+        self._idx_ident = None
+        self._idx_covered = 0
+        self._records = 0
+        # Variazioni da notificare agli indici secondari: (rimosse, aggiunte)
+        self._changes = None
+
+    @contextmanager
+    def _file_lock(self):
+        """Lock esclusivo tra thread e (su POSIX) tra processi"""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _index_header(self, st):
+        """
+        Intestazione che lega il file indice a una specifica versione del log
+        e al formato dei metadati: un indice di un altro formato viene
+        ignorato e ricostruito dal log
+        """
+        return f"# v{INDEX_VERSION} {st.st_dev} {st.st_ino}\n".encode('ascii')
+
+    def _apply(self, op, entry_id, offset, length, entry=None, meta=None, cache=True):
+        """Applica un record (letto dall'indice o dal log) allo stato in memoria"""
+        self._records += 1
+        self._log_end = offset + length
+        old_meta = self._meta.pop(entry_id, None)
+        if old_meta is not None:
+            if self._changes is None:
+                for subscriber in self._subscribers:
+                    subscriber.remove(entry_id, old_meta)
+            elif self._changes[1].pop(entry_id, None) is None:
+                self._changes[0].append((entry_id, old_meta))
+        if op == 'add':
+            self._index.pop(entry_id, None)
+            self._index[entry_id] = (offset, length)
+            if entry is not None and cache:
+                self._entries[entry_id] = entry
+            else:
+                self._entries.pop(entry_id, None)
+            if entry is not None and meta is None:
+                meta = entry_meta(entry)
+            self._meta[entry_id] = meta or {}
+            if self._changes is None:
+                for subscriber in self._subscribers:
+                    subscriber.add(entry_id, self._meta[entry_id])
+            else:
+                self._changes[1][entry_id] = self._meta[entry_id]
+        elif op == 'del':
+            self._index.pop(entry_id, None)
+            self._entries.pop(entry_id, None)
+
+    @contextmanager
+    def _batched_changes(self):
+        """
+        Raccoglie le variazioni applicate nel blocco e le notifica agli
+        indici secondari alla fine, le aggiunte con add_many() se presente
+        """
+        if self._changes is not None:
+            yield  # Blocco annidato: notifica quello esterno
+            return
+        self._changes = ([], {})
+        try:
+            yield
+        finally:
+            removed, added = self._changes
+            self._changes = None
+            added = list(added.items())
+            for subscriber in self._subscribers:
+                for entry_id, meta in removed:
+                    subscriber.remove(entry_id, meta)
+                if hasattr(subscriber, 'add_many'):
+                    subscriber.add_many(added)
+                else:
+                    for entry_id, meta in added:
+                        subscriber.add(entry_id, meta)
+
+    def _read_index(self, st):
+        """Legge le righe nuove del file indice; si ferma al primo buco"""
+        try:
+            f = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            idx_st = os.fstat(f.fileno())
+            ident = (idx_st.st_dev, idx_st.st_ino)
+            if self._idx_offset and ident != self._idx_ident:
+                # Indice ricostruito da un altro processo: si rilegge da capo
+                self._reset()
+                self._index = {}
+            if self._idx_offset == 0:
+                header = f.readline()
+                if header != self._index_header(st):
+                    return  # Indice di un'altra versione del log
+                self._idx_offset = len(header)
+                self._idx_ident = ident
+            f.seek(self._idx_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    op, entry_id, offset, length, meta = line.decode('utf-8')[:-1].split('\t', 4)
+                    offset, length, meta = int(offset), int(length), json.loads(meta)
+                except ValueError:
+                    break
+                if offset + length <= self._log_end:
+                    pass  # Record già letto dal log prima che l'indice fosse scritto
+                elif offset != self._log_end or offset + length > st.st_size:
+                    break  # Indice non allineato: il resto viene letto dal log
+                elif op == 'gap':
+                    # Record morti saltati da un indice ricostruito: contano per la compattazione
+                    self._records += meta.get('r', 0)
+                    self._log_end = offset + length
+                else:
+                    self._apply(op, entry_id, offset, length, meta=meta)
+                self._idx_offset += len(line)
+                self._idx_covered = offset + length
+
+    def _scan_log(self, st):
+        """Legge dal log i record non ancora coperti dall'indice"""
+        if st.st_size <= self._log_end:
+            return
+        with open(self.path, 'rb') as f:
+            f.seek(self._log_end)
+            offset = self._log_end
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # Scrittura in corso o interrotta
+                try:
+                    record = json.loads(line)
+                    if record.get('op') == 'add':
+                        entry = record['entry']
+                        self._apply('add', entry['id'], offset, len(line), entry)
+                    else:
+                        self._apply('del', record['id'], offset, len(line))
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    self._log_end = offset + len(line)
+                offset += len(line)
+
+    def _reset(self):
+        """Svuota lo stato in memoria (forza una ricarica completa)"""
+        self._index = None
+        self._entries = {}
+        self._meta = {}
+        self._stat_key = None
+        self._log_end = 0
+        self._idx_offset = 0
+        self._idx_ident = None
+        self._idx_covered = 0
+        self._records = 0
+        if self._changes is not None:
+            # Gli indici vengono svuotati: le variazioni raccolte non servono più
+            self._changes[0].clear()
+            self._changes[1].clear()
+        for subscriber in self._subscribers:
+            subscriber.reset()
+
+    def _refresh(self):
+        """
+        Allinea lo stato in memoria al log. A cache calda costa un solo stat:
+        se il log è cresciuto si leggono solo le righe nuove dell'indice, se è
+        stato sostituito (compattazione, altro processo) si ricarica l'indice.
+        """
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            self._reset()
+            self._index = {}
+            return self._index
+
+        same_file = self._index is not None and self._stat_key is not None and \
+            self._stat_key[0] == (st.st_dev, st.st_ino)
+        if same_file and st.st_size == self._log_end and st.st_mtime_ns == self._stat_key[1]:
+            return self._index
+        if not same_file or st.st_size < self._log_end:
+            self._reset()
+            self._index = {}
+
+        with OPERATION_SECONDS.misura(operation='refresh'), self._batched_changes():
+            self._read_index(st)
+            self._scan_log(st)
+        self._stat_key = ((st.st_dev, st.st_ino), st.st_mtime_ns)
+        return self._index
+
+    def _read_entry(self, f, entry_id, cache=True):
+        """
+        Legge dal log il solo record di una entry tramite l'indice
+        (con cache=False l'entry non resta in memoria dopo la lettura)
+        """
+        offset, length = self._index[entry_id]
+        f.seek(offset)
+        try:
+            record = json.loads(f.read(length))
+            entry = record['entry']
+        except (ValueError, KeyError, TypeError):
+            entry = None
+        if entry is None or entry.get('id') != entry_id:
+            # Indice non coerente col log: ricostruzione dal log
+            st = os.stat(self.path)
+            self._reset()
+            self._index = {}
+            self._scan_log(st)
+            self._stat_key = ((st.st_dev, st.st_ino), st.st_mtime_ns)
+            return self._entries.get(entry_id)
+        if cache:
+            self._entries[entry_id] = entry
+        return entry
+
+    def _write_index(self):
+        """
+        Riscrive il file indice a partire dallo stato in memoria. I tratti
+        del log tra le entry vive (sostituite, cancellate, tombstone)
+        diventano righe 'gap', così l'indice copre il log senza buchi e
+        conserva il numero di record morti per la compattazione.
+        """
+        st = os.stat(self.path)
+        lines = []
+        gaps = []
+        position = 0
+        for entry_id, (offset, length) in self._index.items():
+            if offset > position:
+                gaps.append(len(lines))
+                lines.append((position, offset))
+            lines.append(_index_line('add', entry_id, offset, length, self._meta.get(entry_id)))
+            position = offset + length
+        if self._log_end > position:
+            gaps.append(len(lines))
+            lines.append((position, self._log_end))
+        # Ogni tratto contiene almeno un record morto (salvo righe illeggibili):
+        # uno per tratto e il resto sull'ultimo, così il totale è esatto
+        dead = self._records - len(self._index)
+        for n, i in enumerate(gaps):
+            count = dead if n == len(gaps) - 1 else min(dead, 1)
+            dead -= count
+            start, end = lines[i]
+            lines[i] = _index_line('gap', '-', start, end - start, {'r': count})
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self._index_header(st))
+            f.writelines(lines)
+            self._idx_offset = f.tell()
+            idx_st = os.fstat(f.fileno())
+        os.replace(tmp_path, self.index_path)
+        self._idx_ident = (idx_st.st_dev, idx_st.st_ino)
+        self._idx_covered = self._log_end
+
+    def _append_records(self, records, cache=True):
+        """
+        Accoda uno o più record al log in una singola write durevole (con lock);
+        con cache=False le entry scritte non restano in memoria
+        """
+        self._refresh()
+        if self._idx_covered != self._log_end or not os.path.exists(self.index_path):
+            if os.path.exists(self.path):
+                # Sotto lock nessuna scrittura è in corso: record del log non
+                # indicizzati (crash, log senza indice) richiedono una ricostruzione
+                self._write_index()
+
+        encoded = [_encode(r) for r in records]
+        with open(self.path, 'a+b') as f:
+            # Sotto lock nessun altro scrive: byte oltre l'ultima riga completa
+            # sono una scrittura interrotta e vengono scartati
+            if f.seek(0, os.SEEK_END) > self._log_end:
+                f.truncate(self._log_end)
+            f.write(b''.join(encoded))
+            f.flush()
+            os.fsync(f.fileno())
+
+        if not os.path.exists(self.index_path):
+            self._write_index()
+        index_lines = []
+        offset = self._log_end
+        with self._batched_changes():
+            for record, data in zip(records, encoded):
+                if record['op'] == 'add':
+                    entry_id, entry = record['entry']['id'], record['entry']
+                    meta = entry_meta(entry)
+                else:
+                    entry_id, entry, meta = record['id'], None, None
+                index_lines.append(_index_line(record['op'], entry_id, offset, len(data), meta))
+                self._apply(record['op'], entry_id, offset, len(data), entry, meta, cache)
+                offset += len(data)
+        with open(self.index_path, 'ab') as f:
+            f.write(b''.join(index_lines))
+            self._idx_offset = f.tell()
+        self._idx_covered = self._log_end
+
+    def _write_log(self, entries):
+        """Riscrive atomicamente log e indice con le sole entry fornite (ordine cronologico)"""
+        tmp_path = self.path + '.tmp'
+        tmp_index_path = self.index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            index_lines = []
+            for entry in entries:
+                data = _encode({'op': 'add', 'entry': entry})
+                index_lines.append(_index_line('add', entry['id'], f.tell(), len(data), entry_meta(entry)))
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+            st = os.fstat(f.fileno())  # L'inode resta lo stesso dopo il replace
+        with open(tmp_index_path, 'wb') as f:
+            f.write(self._index_header(st))
+            f.write(b''.join(index_lines))
+        os.replace(tmp_index_path, self.index_path)
+        os.replace(tmp_path, self.path)
+        _fsync_dir(self.path)
+        self._reset()  # Il file è cambiato: ricarica alla prossima lettura
+
+    def subscribe(self, subscriber):
+        """Registra un indice secondario e lo allinea allo stato corrente"""
+        with self._lock:
+            self._subscribers.append(subscriber)
+            subscriber.reset()
+            if hasattr(subscriber, 'add_many'):
+                subscriber.add_many(list(self._meta.items()))
+            else:
+                for entry_id, meta in self._meta.items():
+                    subscriber.add(entry_id, meta)
+
+    def refresh(self):
+        """Allinea lo stato in memoria (e gli indici secondari) al disco"""
+        with self._lock:
+            self._refresh()
+
+    def load(self):
+        """Ritorna lo storico come lista, dalla entry più recente alla più vecchia"""
+        with OPERATION_SECONDS.misura(operation='load'), self._lock:
+            index = self._refresh()
+            missing = [entry_id for entry_id in index if entry_id not in self._entries]
+            if missing:
+                with open(self.path, 'rb') as f:
+                    for entry_id in missing:
+                        if entry_id in self._index and entry_id not in self._entries:
+                            self._read_entry(f, entry_id)
+                index = self._index
+            return [self._entries[entry_id] for entry_id in reversed(index)
+                    if entry_id in self._entries]
+
+    def get(self, entry_id):
+        """Ritorna la entry con l'id indicato (None se assente), senza leggere le altre"""
+        with self._lock:
+            index = self._refresh()
+            if entry_id not in index:
+                return None
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                with open(self.path, 'rb') as f:
+                    entry = self._read_entry(f, entry_id)
+            return entry
+
+    def get_many(self, entry_ids):
+        """
+        Entry con gli id indicati, nello stesso ordine (le assenti sono
+        saltate). Le entry lette dal disco non vengono tenute in memoria:
+        adatto a scorrere lo storico a blocchi (es. esportazioni).
+        """
+        with self._lock:
+            index = self._refresh()
+            entries = []
+            if not index:
+                return entries
+            with open(self.path, 'rb') as f:
+                for entry_id in entry_ids:
+                    if entry_id not in index:
+                        continue
+                    entry = self._entries.get(entry_id)
+                    if entry is None:
+                        entry = self._read_entry(f, entry_id, cache=False)
+                    if entry is not None:
+                        entries.append(entry)
+            return entries
+
+    def existing(self, entry_ids):
+        """Sottoinsieme degli id indicati presenti nello storico"""
+        with self._lock:
+            index = self._refresh()
+            return {entry_id for entry_id in entry_ids if entry_id in index}
+
+    def count(self):
+        """Numero di entry nello storico"""
+        with self._lock:
+            return len(self._refresh())
+
+    def append(self, entry):
+        """Aggiunge una entry allo storico (append O(1))"""
+        with OPERATION_SECONDS.misura(operation='append'), self._file_lock():
+            self._append_records([{'op': 'add', 'entry': entry}])
+        return entry
+
+    def append_many(self, entries):
+        """
+        Aggiunge più entry con una sola scrittura e un solo fsync (import a
+        blocchi). Le entry non restano nella cache in memoria: si rileggono
+        dal log quando servono.
+        """
+        if not entries:
+            return 0
+        with OPERATION_SECONDS.misura(operation='append_many'), self._file_lock():
+            self._append_records([{'op': 'add', 'entry': entry} for entry in entries], cache=False)
+        return len(entries)
+
+    def delete(self, entry_id):
+        """
+        Cancella una entry accodando un tombstone; i record morti vengono
+        rimossi più tardi dalla compattazione in background.
+        Ritorna False se la entry non esiste.
+        """
+        with OPERATION_SECONDS.misura(operation='delete'), self._file_lock():
+            if entry_id not in self._refresh():
+                return False
+            self._append_records([{'op': 'del', 'id': entry_id}])
+        self.compact_if_needed(background=True)
+        return True
+
+    def replace_all(self, history):
+        """
+        Sostituisce l'intero storico (lista dalla più recente alla più vecchia,
+        stesso formato di load()).
+        """
+        with OPERATION_SECONDS.misura(operation='replace_all'), self._file_lock():
+            self._write_log(list(reversed(history)))
+        return True
+
+    def needs_compaction(self):
+        """Verifica se i record morti superano la soglia configurata"""
+        with self._lock:
+            live = len(self._refresh())  # Prima: aggiorna anche _records
+            records = self._records
+        return records >= self.compact_min_records and records - live > records * self.compact_ratio
+
+    def compact(self):
+        """Riscrive il log mantenendo solo le entry vive"""
+        with OPERATION_SECONDS.misura(operation='compact'), self._file_lock():
+            self._write_log(list(reversed(self.load())))
+
+    def compact_if_needed(self, background=False):
+        """
+        Compatta il log se la soglia di record morti è superata.
+        Con background=True la compattazione gira in un thread separato.
+        """
+        if not self.needs_compaction():
+            return False
+        if not background:
+            self.compact()
+            return True
+        with self._lock:
+            if self._compactor is None or not self._compactor.is_alive():
+                self._compactor = threading.Thread(target=self.compact, daemon=True)
+                self._compactor.start()
+        return True
+
+    def migrate_from_json(self, json_path):
+        """
+        Importa il vecchio health_history.json (lista dalla più recente alla più
+        vecchia) se il log non esiste ancora. Gli id duplicati (stesso secondo)
+        vengono riscritti; il file originale viene rinominato in .migrated per
+        evitare una seconda importazione.
+        Ritorna il numero di entry migrate.
+        """
+        with self._file_lock():
+            if not os.path.exists(json_path):
+                return 0
+            if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+                return 0
+            try:
+                with open(json_path, 'r', encoding='utf-8') as f:
+                    history = json.load(f)
+            except (OSError, ValueError):
+                return 0
+            entries = list(reversed(history))
+            dedupe_ids(entries)
+            self._write_log(entries)
+            os.replace(json_path, json_path + '.migrated')
+            _fsync_dir(json_path)
+            return len(history)
+
+    def fix_duplicate_ids(self):
+        """
+        Riscrittura una tantum degli id duplicati. Nel log una entry con id già
+        usato sostituiva la precedente: qui le entry vengono recuperate e le
+        collisioni ricevono un nuovo id. Un tombstone cancella tutte le entry
+        con quell'id, come faceva la vecchia cancellazione.
+        Ritorna il numero di id riscritti.
+        """
+        with self._file_lock():
+            if not os.path.exists(self.path):
+                return 0
+            entries = []
+            positions = {}
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get('op') == 'add':
+                        positions.setdefault(record['entry']['id'], []).append(len(entries))
+                        entries.append(record['entry'])
+                    elif record.get('op') == 'del':
+                        for position in positions.pop(record.get('id'), []):
+                            entries[position] = None
+            live = [entry for entry in entries if entry is not None]
+            rewritten = dedupe_ids(live)
+            if rewritten:
+                self._write_log(live)
+            return rewritten
+
+
+def main():
+    """Manutenzione dello storico da riga di comando (--migrate, --fix-ids, --compact, --gc-photos)"""
+    data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+    store = HistoryStore(os.path.join(data_dir, 'health_history.jsonl'))
+
+    if '--migrate' in sys.argv:
+        migrated = store.migrate_from_json(os.path.join(data_dir, 'health_history.json'))
+        print(f"✅ Entry migrate: {migrated}")
+    if '--fix-ids' in sys.argv:
+        rewritten = store.fix_duplicate_ids()
+        print(f"✅ Id duplicati riscritti: {rewritten}")
+    if '--compact' in sys.argv:
+        store.compact()
+        print(f"✅ Storico compattato: {store.count()} entry")
+    if '--gc-photos' in sys.argv:
+        from history_index import PhotoRefIndex
+        from utils import PhotoManager
+        dry_run = '--dry-run' in sys.argv
+        result = PhotoManager.collect_garbage(PhotoRefIndex(store).referenced(), dry_run=dry_run)
+        print(f"✅ Foto {'da eliminare' if dry_run else 'eliminate'}: {result['removed']} "
+              f"(varianti {result['variants']}, temporanei {result['partial']}, "
+              f"{result['bytes'] / (1024 * 1024):.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,19 +8,27 @@ import os
 import json
 import csv
 import io
+import time
+import zlib
 import base64
+import hashlib
 from datetime import datetime
-import matplotlib
-matplotlib.use('Agg')  # Backend non interattivo per server
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-from flask import make_response
+import threading
+from collections import OrderedDict
+from flask import Response
+from werkzeug.exceptions import RequestEntityTooLarge
 
-# Sintomi critici che richiedono notifica immediata
-CRITICAL_SYMPTOMS = [
-    'vomito', 'diarrea', 'sangue', 'letargia', 'febbre', 'convulsioni',
-    'difficolta respiratorie', 'perdita coscienza', 'collasso'
-]
+from ids import new_id
+from symptom_matcher import classifica_sintomi
+from metrics import REGISTRO
+
+# Metriche di grafici ed esportazioni (esportate su /metrics)
+CHART_SECONDS = REGISTRO.istogramma(
+    'animal_diary_chart_render_seconds', "Durata del disegno di un grafico con Matplotlib", ('kind', 'format'))
+EXPORT_SECONDS = REGISTRO.istogramma(
+    'animal_diary_export_seconds',
+    "Tempo di costruzione di un export, senza le attese dell'invio al client", ('format',))
+EXPORT_BYTES = REGISTRO.contatore('animal_diary_export_bytes_total', "Byte esportati", ('format',))
 
 class EmailAlert:
     """Simulatore di notifiche email per sintomi critici"""
@@ -28,20 +36,12 @@ class EmailAlert:
     @staticmethod
     def check_critical_symptoms(sintomi_str):
         """
-        Verifica se ci sono sintomi critici
+        Verifica se ci sono sintomi critici (gravi secondo symptom_matcher)
         Ritorna: (has_critical, critical_list)
         """
-        if not sintomi_str or sintomi_str.lower() == 'nessuno':
-            return False, []
-        
-        sintomi = [s.strip().lower() for s in sintomi_str.split(',')]
-        critical_found = []
-        
-        for sintomo in sintomi:
-            for critical in CRITICAL_SYMPTOMS:
-                if critical in sintomo:
-                    critical_found.append(sintomo)
-                    break
+        sintomi = classifica_sintomi(sintomi_str)
+        critical_found = [sintomo.lower() for sintomo, gravita, _ in sintomi['segmenti']
+                          if gravita == 'grave']
         
         return len(critical_found) > 0, critical_found
     
@@ -63,25 +63,73 @@ class EmailAlert:
         
         return message
 
+def _figure(**kwargs):
+    """
+    Nuova Figure di Matplotlib. Matplotlib viene importato al primo grafico
+    e non all'avvio: l'API a oggetti non usa pyplot né richiede di
+    scegliere un backend (PNG e SVG sono resi senza display).
+    """
+    from matplotlib.figure import Figure
+    return Figure(**kwargs)
+
+
 class ChartGenerator:
     """Generatore di grafici con Matplotlib"""
     
     @staticmethod
-    def generate_weight_chart(history_data, animal_name=None):
+    def generate_weight_chart(history_data, animal_name=None, series=None):
         """
         Genera grafico dell'andamento del peso nel tempo
+        Con series (SeriesIndex) legge i punti già pronti dell'animale
+        invece di filtrare history_data e rileggere ogni timestamp
         Ritorna: stringa base64 dell'immagine PNG
         """
-        if not history_data:
+        if series is not None:
+            times, weights = series.weights(animal_name)
+            dates = [datetime.fromtimestamp(t) for t in times]
+        else:
+            dates, weights = ChartGenerator._weight_points(history_data, animal_name)
+        
+        if len(dates) < 2:
             return None
         
+        image = ChartGenerator.render_weight_chart(dates, weights, animal_name)
+        return f"data:image/png;base64,{base64.b64encode(image).decode()}"
+    
+    @staticmethod
+    def render_weight_chart(dates, weights, animal_name=None, fmt='png'):
+        """
+        Disegna l'andamento del peso con l'API a oggetti di Matplotlib
+        (una Figure per chiamata, nessuno stato globale di pyplot: sicuro
+        con più thread)
+        Ritorna: bytes dell'immagine nel formato fmt (png o svg)
+        """
+        with CHART_SECONDS.misura(kind='weight', format=fmt):
+            fig = _figure(figsize=(10, 6))
+            ax = fig.subplots()
+            ax.plot(dates, weights, marker='o', linestyle='-', linewidth=2, markersize=8)
+            ax.set_xlabel('Data', fontsize=12)
+            ax.set_ylabel('Peso (kg)', fontsize=12)
+            title = f'Andamento Peso - {animal_name}' if animal_name else 'Andamento Peso'
+            ax.set_title(title, fontsize=14, fontweight='bold')
+            ax.grid(True, alpha=0.3)
+            
+            # Formatta asse x per date
+            fig.autofmt_xdate()
+            fig.tight_layout()
+            
+            return ChartGenerator._figure_bytes(fig, fmt)
+    
+    @staticmethod
+    def _weight_points(history_data, animal_name=None):
+        """Date e pesi dallo storico completo (dal più vecchio al più recente)"""
+        if not history_data:
+            return [], []
+        
         # Filtra per animale specifico se richiesto
         if animal_name:
             history_data = [e for e in history_data if e.get('dati', {}).get('nome') == animal_name]
         
-        if not history_data or len(history_data) < 2:
-            return None
-        
         # Estrai date e pesi
         dates = []
         weights = []
@@ -99,102 +147,161 @@ class ChartGenerator:
             except:
                 continue
         
-        if len(dates) < 2:
-            return None
-        
-        # Crea il grafico
-        plt.figure(figsize=(10, 6))
-        plt.plot(dates, weights, marker='o', linestyle='-', linewidth=2, markersize=8)
-        plt.xlabel('Data', fontsize=12)
-        plt.ylabel('Peso (kg)', fontsize=12)
-        title = f'Andamento Peso - {animal_name}' if animal_name else 'Andamento Peso'
-        plt.title(title, fontsize=14, fontweight='bold')
-        plt.grid(True, alpha=0.3)
-        plt.tight_layout()
-        
-        # Formatta asse x per date
-        plt.gcf().autofmt_xdate()
-        
-        # Converti in base64
-        buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=100, bbox_inches='tight')
-        buffer.seek(0)
-        image_base64 = base64.b64encode(buffer.read()).decode()
-        plt.close()
-        
-        return f"data:image/png;base64,{image_base64}"
+        return dates, weights
     
     @staticmethod
-    def generate_activity_chart(history_data, animal_name=None):
+    def generate_activity_chart(history_data, animal_name=None, series=None):
         """
         Genera grafico dell'attività registrata
+        Con series (SeriesIndex) usa i conteggi mantenuti dall'indice
         Ritorna: stringa base64 dell'immagine PNG
         """
-        if not history_data:
-            return None
-        
-        # Filtra per animale specifico se richiesto
-        if animal_name:
-            history_data = [e for e in history_data if e.get('dati', {}).get('nome') == animal_name]
-        
-        if not history_data:
-            return None
-        
-        # Conta le attività
-        activity_counts = {}
-        
-        for entry in history_data:
-            data = entry.get('dati', {})
-            attivita = data.get('attivita', 'Non specificata')
-            activity_counts[attivita] = activity_counts.get(attivita, 0) + 1
+        if series is not None:
+            activity_counts = series.activity(animal_name)
+        else:
+            if not history_data:
+                return None
+            
+            # Filtra per animale specifico se richiesto
+            if animal_name:
+                history_data = [e for e in history_data if e.get('dati', {}).get('nome') == animal_name]
+            
+            # Conta le attività
+            activity_counts = {}
+            
+            for entry in history_data:
+                data = entry.get('dati', {})
+                attivita = data.get('attivita', 'Non specificata')
+                activity_counts[attivita] = activity_counts.get(attivita, 0) + 1
         
         if not activity_counts:
             return None
         
-        # Crea il grafico a barre
-        plt.figure(figsize=(10, 6))
-        activities = list(activity_counts.keys())
-        counts = list(activity_counts.values())
-        
-        plt.bar(activities, counts, color='steelblue', alpha=0.8)
-        plt.xlabel('Livello Attività', fontsize=12)
-        plt.ylabel('Numero Registrazioni', fontsize=12)
-        title = f'Distribuzione Attività - {animal_name}' if animal_name else 'Distribuzione Attività'
-        plt.title(title, fontsize=14, fontweight='bold')
-        plt.grid(True, alpha=0.3, axis='y')
-        plt.tight_layout()
-        
-        # Converti in base64
+        image = ChartGenerator.render_activity_chart(activity_counts, animal_name)
+        return f"data:image/png;base64,{base64.b64encode(image).decode()}"
+    
+    @staticmethod
+    def render_activity_chart(activity_counts, animal_name=None, fmt='png'):
+        """
+        Disegna la distribuzione delle attività con l'API a oggetti
+        Ritorna: bytes dell'immagine nel formato fmt (png o svg)
+        """
+        with CHART_SECONDS.misura(kind='activity', format=fmt):
+            fig = _figure(figsize=(10, 6))
+            ax = fig.subplots()
+            activities = list(activity_counts.keys())
+            counts = list(activity_counts.values())
+            
+            ax.bar(activities, counts, color='steelblue', alpha=0.8)
+            ax.set_xlabel('Livello Attività', fontsize=12)
+            ax.set_ylabel('Numero Registrazioni', fontsize=12)
+            title = f'Distribuzione Attività - {animal_name}' if animal_name else 'Distribuzione Attività'
+            ax.set_title(title, fontsize=14, fontweight='bold')
+            ax.grid(True, alpha=0.3, axis='y')
+            fig.tight_layout()
+            
+            return ChartGenerator._figure_bytes(fig, fmt)
+    
+    @staticmethod
+    def _figure_bytes(fig, fmt):
+        """Salva la figura in memoria nel formato richiesto"""
         buffer = io.BytesIO()
-        plt.savefig(buffer, format='png', dpi=100, bbox_inches='tight')
-        buffer.seek(0)
-        image_base64 = base64.b64encode(buffer.read()).decode()
-        plt.close()
-        
-        return f"data:image/png;base64,{image_base64}"
-
-class DataExporter:
-    """Esportatore dati in vari formati"""
+        fig.savefig(buffer, format=fmt, dpi=100, bbox_inches='tight')
+        return buffer.getvalue()
     
     @staticmethod
-    def export_to_csv(history_data):
+    def render_chart(series, animal_name, kind, fmt='png'):
         """
-        Esporta lo storico in formato CSV
-        Ritorna: Response Flask con il file CSV
+        Grafico di un animale dalle serie di SeriesIndex
+        kind: 'weight' o 'activity'; fmt: 'png' o 'svg'
+        Ritorna: bytes dell'immagine, o None se i dati non bastano
         """
-        output = io.StringIO()
-        
-        if not history_data:
+        if kind == 'weight':
+            times, weights = series.weights(animal_name)
+            if len(times) < 2:
+                return None
+            dates = [datetime.fromtimestamp(t) for t in times]
+            return ChartGenerator.render_weight_chart(dates, weights, animal_name, fmt)
+        activity_counts = series.activity(animal_name)
+        if not activity_counts:
             return None
-        
-        # Header CSV
-        fieldnames = ['ID', 'Data', 'Nome', 'Specie', 'Peso (kg)', 'Età (anni)', 
-                     'Alimentazione', 'Attività', 'Sintomi', 'Note']
-        writer = csv.DictWriter(output, fieldnames=fieldnames)
+        return ChartGenerator.render_activity_chart(activity_counts, animal_name, fmt)
+
+
+class ChartCache:
+    """
+    Cache LRU limitata delle immagini dei grafici. Ogni immagine è salvata
+    con lo stamp della serie da cui è stata disegnata: quando arrivano
+    nuovi dati lo stamp cambia e l'immagine viene scartata alla lettura.
+    """
+    
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+    
+    def get(self, key, stamp):
+        """Immagine in cache per key se disegnata con lo stesso stamp, altrimenti None"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] != stamp:
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+    
+    def put(self, key, stamp, image):
+        """Salva un'immagine, eliminando le meno usate oltre max_entries"""
+        with self._lock:
+            self._items[key] = (stamp, image)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+    
+    def info(self):
+        """Statistiche della cache"""
+        with self._lock:
+            return {
+                'entries': len(self._items),
+                'max_entries': self.max_entries,
+                'bytes': sum(len(image) for _, image in self._items.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+class DataExporter:
+    """
+    Esportatore dati in vari formati. Le esportazioni sono in streaming:
+    le entry vengono lette da un iterabile (es. TimelineIndex.scan) e
+    scritte a blocchi nella response, con memoria costante rispetto alla
+    dimensione dello storico.
+    """
+    
+    CSV_FIELDS = ['ID', 'Data', 'Nome', 'Specie', 'Peso (kg)', 'Età (anni)',
+                  'Alimentazione', 'Attività', 'Sintomi', 'Note']
+    
+    FORMATS = {
+        'csv': 'text/csv; charset=utf-8',
+        'json': 'application/json; charset=utf-8',
+        'jsonl': 'application/x-ndjson; charset=utf-8',
+    }
+    
+    # Byte accumulati prima di inviare un blocco della response
+    CHUNK_SIZE = 64 * 1024
+    
+    @staticmethod
+    def _csv_rows(entries):
+        """Righe CSV (header compreso), una stringa per entry"""
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=DataExporter.CSV_FIELDS)
         writer.writeheader()
         
-        # Scrivi i dati
-        for entry in history_data:
+        for entry in entries:
             dati = entry.get('dati', {})
             writer.writerow({
                 'ID': entry.get('id', ''),
@@ -208,19 +315,101 @@ class DataExporter:
                 'Sintomi': dati.get('sintomi', ''),
                 'Note': dati.get('note', '')
             })
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
         
-        # Crea la response
-        csv_data = output.getvalue()
-        output.close()
-        
-        response = make_response(csv_data)
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-        response.headers['Content-Disposition'] = 'attachment; filename=animal_health_history.csv'
-        
+        if output.tell():
+            yield output.getvalue()  # Solo header: storico vuoto
+    
+    @staticmethod
+    def _json_rows(entries):
+        """Array JSON indentato come json.dumps(storico, indent=2), un elemento alla volta"""
+        separator = '[\n'
+        for entry in entries:
+            record = json.dumps(entry, ensure_ascii=False, indent=2)
+            yield separator + '  ' + record.replace('\n', '\n  ')
+            separator = ',\n'
+        yield '[]' if separator == '[\n' else '\n]'
+    
+    @staticmethod
+    def _jsonl_rows(entries):
+        """Una entry JSON per riga"""
+        for entry in entries:
+            yield json.dumps(entry, ensure_ascii=False) + '\n'
+    
+    @staticmethod
+    def _chunks(rows, compress=False):
+        """Raggruppa le righe in blocchi da ~CHUNK_SIZE byte, compressi in gzip se richiesto"""
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None  # 31: formato gzip
+        buffer = []
+        size = 0
+        for row in rows:
+            data = row.encode('utf-8')
+            buffer.append(data)
+            size += len(data)
+            if size >= DataExporter.CHUNK_SIZE:
+                chunk = b''.join(buffer)
+                buffer, size = [], 0
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                if chunk:
+                    yield chunk
+        chunk = b''.join(buffer)
+        if compressor:
+            chunk = compressor.compress(chunk) + compressor.flush()
+        if chunk:
+            yield chunk
+    
+    @staticmethod
+    def _measured(chunks, label):
+        """Blocchi dell'export, misurando solo il tempo per costruirli (non l'invio) e i byte"""
+        elapsed, size = 0.0, 0
+        try:
+            start = time.perf_counter()
+            for chunk in chunks:
+                elapsed += time.perf_counter() - start
+                size += len(chunk)
+                yield chunk
+                start = time.perf_counter()
+            elapsed += time.perf_counter() - start
+        finally:
+            EXPORT_SECONDS.osserva(elapsed, format=label)
+            EXPORT_BYTES.inc(size, format=label)
+    
+    @staticmethod
+    def stream(entries, fmt='csv', compress=False):
+        """
+        Esporta le entry in streaming
+        fmt: 'csv', 'json' o 'jsonl'; compress: file .gz compresso al volo
+        Ritorna: Response Flask con il corpo generato man mano
+        """
+        rows = getattr(DataExporter, f'_{fmt}_rows')(entries)
+        filename = f'animal_health_history_{new_id()}.{fmt}'
+        if compress:
+            mimetype = 'application/gzip'
+            filename += '.gz'
+        else:
+            mimetype = DataExporter.FORMATS[fmt]
+        
+        chunks = DataExporter._measured(DataExporter._chunks(rows, compress), fmt + ('.gz' if compress else ''))
+        response = Response(chunks, mimetype=mimetype)
+        response.headers['Content-Disposition'] = f'attachment; filename={filename}'
         return response
     
     @staticmethod
-    def export_to_json(history_data):
+    def export_to_csv(history_data, compress=False):
+        """
+        Esporta lo storico in formato CSV
+        Ritorna: Response Flask con il file CSV
+        """
+        if not history_data:
+            return None
+        
+        return DataExporter.stream(history_data, 'csv', compress)
+    
+    @staticmethod
+    def export_to_json(history_data, compress=False):
         """
         Esporta lo storico in formato JSON
         Ritorna: Response Flask con il file JSON
@@ -228,28 +417,92 @@ class DataExporter:
         if not history_data:
             return None
         
-        json_data = json.dumps(history_data, ensure_ascii=False, indent=2)
-        
-        response = make_response(json_data)
-        response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        response.headers['Content-Disposition'] = 'attachment; filename=animal_health_history.json'
+        return DataExporter.stream(history_data, 'json', compress)
+    
+    @staticmethod
+    def export_to_jsonl(history_data, compress=False):
+        """
+        Esporta lo storico in formato JSONL (una entry per riga)
+        Ritorna: Response Flask con il file JSONL
+        """
+        if not history_data:
+            return None
         
-        return response
+        return DataExporter.stream(history_data, 'jsonl', compress)
 
 class PhotoManager:
-    """Gestore upload foto (simulazione)"""
+    """
+    Gestore upload foto: scrittura a blocchi con limite di dimensione,
+    riconoscimento del formato dal contenuto e varianti ridotte (miniature
+    WebP) generate in background.
+
+    Le foto sono salvate per contenuto: il nome è lo SHA-256 dei byte
+    (`<hash>.<ext>`) in sottocartelle `ab/cd/` date dalle prime cifre, così
+    la stessa immagine caricata più volte occupa un solo file e nessuna
+    cartella cresce senza limite. I riferimenti sono le liste 'foto' delle
+    entry (PhotoRefIndex); collect_garbage() elimina i file non più usati.
+    """
+    
+    PHOTOS_DIR = os.path.join(os.path.dirname(__file__), 'data', 'photos')
+    
+    # Dimensione massima di default di una foto (byte)
+    MAX_BYTES = 10 * 1024 * 1024
+    
+    CHUNK_SIZE = 64 * 1024
+    
+    # Firme dei formati accettati: (offset, byte attesi) -> estensione
+    SIGNATURES = (
+        ((0, b'\x89PNG\r\n\x1a\n'), 'png'),
+        ((0, b'\xff\xd8\xff'), 'jpg'),
+        ((0, b'GIF87a'), 'gif'),
+        ((0, b'GIF89a'), 'gif'),
+        ((8, b'WEBP'), 'webp'),
+    )
+    
+    MIMETYPES = {'png': 'image/png', 'jpg': 'image/jpeg', 'gif': 'image/gif', 'webp': 'image/webp'}
+    
+    # Varianti ridotte: nome -> lato massimo in pixel
+    VARIANTS = {'thumb': 320, 'medium': 1280}
+    
+    # File non referenziati più recenti di così (secondi) non vengono
+    # eliminati: upload appena scritti e non ancora aggiunti alla entry
+    GC_GRACE = 3600
     
     @staticmethod
-    def save_photo(file, entry_id):
+    def sniff_type(header):
+        """Estensione del formato immagine riconosciuto dai primi byte, o None"""
+        for (offset, signature), ext in PhotoManager.SIGNATURES:
+            if header[offset:offset + len(signature)] == signature:
+                if ext == 'webp' and not header.startswith(b'RIFF'):
+                    continue
+                return ext
+        return None
+    
+    @staticmethod
+    def is_content_name(filename):
+        """True se il nome è quello di una foto salvata per contenuto (<sha256>.<ext>)"""
+        stem, _, ext = (filename or '').partition('.')
+        return len(stem) == 64 and ext in PhotoManager.MIMETYPES and \
+            all(c in '0123456789abcdef' for c in stem)
+    
+    @staticmethod
+    def _shard(filename):
+        """Sottocartelle di una foto salvata per contenuto ('ab/cd'); '' per i vecchi nomi"""
+        if not PhotoManager.is_content_name(filename):
+            return ''
+        return os.path.join(filename[:2], filename[2:4])
+    
+    @staticmethod
+    def save_photo(file, max_bytes=None):
         """
-        Salva una foto associata a un'entry
+        Salva una foto caricata (FileStorage)
         Ritorna: (success, filename/error_message)
         """
         if not file:
             return False, "Nessun file fornito"
         
         # Verifica estensione
-        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif'}
+        allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
         filename = file.filename
         
         if '.' not in filename:
@@ -257,27 +510,169 @@ class PhotoManager:
         
         ext = filename.rsplit('.', 1)[1].lower()
         if ext not in allowed_extensions:
-            return False, f"Estensione non supportata. Usa: {', '.join(allowed_extensions)}"
+            return False, f"Estensione non supportata. Usa: {', '.join(sorted(allowed_extensions))}"
         
-        # Crea directory photos se non esiste
-        photos_dir = os.path.join(os.path.dirname(__file__), 'data', 'photos')
-        os.makedirs(photos_dir, exist_ok=True)
-        
-        # Genera nome file unico
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        safe_filename = f"{entry_id}_{timestamp}.{ext}"
-        filepath = os.path.join(photos_dir, safe_filename)
+        return PhotoManager.save_stream(file.stream, max_bytes,
+                                        expected='jpg' if ext == 'jpeg' else ext)
+    
+    @staticmethod
+    def save_stream(stream, max_bytes=None, expected=None):
+        """
+        Salva una foto leggendola a blocchi da uno stream (es. corpo della
+        richiesta), senza tenerla in memoria, e calcolandone l'hash durante
+        la scrittura. Il formato è riconosciuto dai primi byte; oltre
+        max_bytes la scrittura si interrompe, il file parziale viene
+        eliminato e si solleva RequestEntityTooLarge (413, come per un
+        Content-Length eccessivo). Se la stessa immagine è già salvata il
+        file temporaneo viene scartato e si riusa quello esistente.
+        Ritorna: (success, filename/error_message)
+        """
+        max_bytes = max_bytes or PhotoManager.MAX_BYTES
+        os.makedirs(PhotoManager.PHOTOS_DIR, exist_ok=True)
+        
+        # Primi byte per riconoscere il formato (un read può restituirne meno)
+        header = b''
+        while len(header) < 16:
+            chunk = stream.read(16 - len(header))
+            if not chunk:
+                break
+            header += chunk
+        ext = PhotoManager.sniff_type(header)
+        if ext is None:
+            return False, "Il contenuto non è un'immagine PNG, JPEG, GIF o WebP"
+        if expected and expected != ext:
+            return False, f"Il contenuto ({ext}) non corrisponde all'estensione ({expected})"
+        
+        # Il nome definitivo si conosce solo alla fine: file temporaneo unico
+        tmp_path = os.path.join(PhotoManager.PHOTOS_DIR, f"{new_id()}.part")
+        digest = hashlib.sha256(header)
         
         try:
-            file.save(filepath)
-            return True, safe_filename
+            size = len(header)
+            with open(tmp_path, 'wb') as f:
+                f.write(header)
+                while True:
+                    chunk = stream.read(PhotoManager.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise RequestEntityTooLarge(f"File troppo grande (massimo {max_bytes // (1024 * 1024)} MB)")
+                    digest.update(chunk)
+                    f.write(chunk)
+            
+            filename = f"{digest.hexdigest()}.{ext}"
+            filepath = PhotoManager.get_photo_path(filename)
+            os.makedirs(os.path.dirname(filepath), exist_ok=True)
+            if os.path.exists(filepath):
+                # Già presente: si rinnova la data di modifica, così il
+                # garbage collector non la elimina prima che la entry la citi
+                os.utime(filepath)
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, filepath)
+            return True, filename
         except Exception as e:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            if isinstance(e, RequestEntityTooLarge):
+                raise
             return False, str(e)
     
+    @staticmethod
+    def variant_path(filename, variant):
+        """Path di una variante ridotta (WebP) di una foto"""
+        stem = filename.rsplit('.', 1)[0]
+        return os.path.join(PhotoManager.PHOTOS_DIR, variant, PhotoManager._shard(filename), f"{stem}.webp")
+    
+    @staticmethod
+    def make_variants(filename):
+        """
+        Genera le varianti ridotte mancanti di una foto (eseguito dai worker
+        in background). Richiede Pillow (pip install pillow): senza, le
+        pagine mostrano l'originale.
+        Ritorna: nomi delle varianti generate
+        """
+        try:
+            from PIL import Image
+        except ImportError:
+            return []
+        
+        # Dalla variante più grande alla più piccola, ognuna ricavata dalla precedente
+        missing = [(variant, size) for variant, size in
+                   sorted(PhotoManager.VARIANTS.items(), key=lambda item: -item[1])
+                   if not os.path.exists(PhotoManager.variant_path(filename, variant))]
+        if not missing:
+            return []
+        
+        with Image.open(PhotoManager.get_photo_path(filename)) as image:
+            # Per i JPEG la decodifica avviene già a scala ridotta
+            image.draft('RGB', (missing[0][1], missing[0][1]))
+            for variant, size in missing:
+                image.thumbnail((size, size))
+                output = image
+                if output.mode not in ('RGB', 'RGBA'):
+                    output = output.convert('RGBA' if 'transparency' in output.info else 'RGB')
+                target = PhotoManager.variant_path(filename, variant)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                output.save(target + '.part', 'WEBP', quality=80, method=4)
+                os.replace(target + '.part', target)
+        return [variant for variant, _ in missing]
+    
     @staticmethod
     def get_photo_path(filename):
         """
-        Ottieni il path completo di una foto
+        Ottieni il path completo di una foto (sottocartelle per contenuto,
+        o cartella principale per le foto salvate con i vecchi nomi)
+        """
+        if not filename:
+            return None
+        return os.path.join(PhotoManager.PHOTOS_DIR, PhotoManager._shard(filename), filename)
+    
+    @staticmethod
+    def collect_garbage(referenced, grace=None, dry_run=False):
+        """
+        Elimina le foto non citate da nessuna entry, con le loro varianti,
+        e i file temporanei rimasti da upload interrotti. I file modificati
+        negli ultimi `grace` secondi vengono lasciati (upload in corso). Le
+        sottocartelle restano anche vuote (al più 256 x 256): un upload
+        concorrente potrebbe starci scrivendo.
+        
+        Args:
+            referenced: Insieme dei nomi delle foto in uso (PhotoRefIndex.referenced())
+            grace: Secondi di tolleranza (default GC_GRACE)
+            dry_run: Conta soltanto, senza eliminare
+        
+        Ritorna: dizionario con removed, variants, partial, bytes, kept
         """
-        photos_dir = os.path.join(os.path.dirname(__file__), 'data', 'photos')
-        return os.path.join(photos_dir, filename) if filename else None
+        grace = PhotoManager.GC_GRACE if grace is None else grace
+        cutoff = time.time() - grace
+        stems = {filename.rsplit('.', 1)[0] for filename in referenced}
+        result = {'removed': 0, 'variants': 0, 'partial': 0, 'bytes': 0, 'kept': 0}
+        
+        for root, dirs, files in os.walk(PhotoManager.PHOTOS_DIR):
+            relative = os.path.relpath(root, PhotoManager.PHOTOS_DIR).split(os.sep)
+            variant = relative[0] in PhotoManager.VARIANTS
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.part'):
+                    kind = 'partial'
+                elif variant:
+                    kind = 'variants' if name.rsplit('.', 1)[0] not in stems else None
+                else:
+                    kind = 'removed' if name not in referenced else None
+                if kind is None:
+                    result['kept'] += 1
+                    continue
+                try:
+                    st = os.stat(path)
+                    if st.st_mtime > cutoff:
+                        result['kept'] += 1
+                        continue
+                    if not dry_run:
+                        os.remove(path)
+                except FileNotFoundError:
+                    continue  # Eliminato nel frattempo (altro processo)
+                result[kind] += 1
+                result['bytes'] += st.st_size
+        return result